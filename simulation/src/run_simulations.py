@@ -1,25 +1,94 @@
 import os
-import pandas as pd
+import multiprocessing
 import pickle
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from urllib.parse import quote
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from datetime import datetime
 from simulation.src.load_excel_dicts import load_excel_dicts
 from simulation.src.load_yaml_dicts import load_yaml_dicts
+from src.base_model.load_dsms import load_dsms, get_dsms_store_path
 from src.base_model.run_simson import run_simson
-from src.tools.config import cfg
+from src.tools.config import cfg, create_config, use_config
+from src.odym_extension.SimDiGraph_MFAsystem import BlockFlow
 from src.read_data.load_data import load_region_names_list
 from src.visualisation.test_visualisations.master_visualisation import get_scrap_share_china_plt, get_production_plt
 
+_RESULT_DIMENSION_COLUMNS = {'r': 'Region', 'g': 'In-Use category', 'w': 'Recycling category'}
+# all partitions share one schema, columns of dimensions a flow or stock does not have are null
+_RESULT_SCHEMA = pa.schema([('Year', pa.int16())] +
+                           [(column_name, pa.dictionary(pa.int16(), pa.string()))
+                            for column_name in _RESULT_DIMENSION_COLUMNS.values()] +
+                           [('Value', pa.float64())])
 
-def run_simulations():
+# Simulations run in parallel worker processes, each run with its own frozen config (see config.use_config). The DSMs
+# of all distinct stock configurations are calculated first (in parallel as well) and stored, the simulation runs then
+# share them as read-only memory maps. Workers are reused, so later runs of a worker also reuse its pipeline stages if
+# possible.
+
+
+def run_simulations(n_workers=None):
+    """
+    Runs all simulations configured in the excel and yaml interface and saves each in its own simulation folder.
+
+    :param n_workers: Number of worker processes, all CPU cores are used if None, 1 runs all simulations in this
+    process one after another.
+    :return: List of the simulation folder paths.
+    """
     config_dicts = _load_config_dicts()
+    if n_workers == 1:
+        for config_dict in config_dicts:
+            _prepare_dsms(config_dict)
+        return [_run_and_save_simulation(config_dict) for config_dict in config_dicts]
+
+    dsm_config_dicts = _get_config_dicts_with_distinct_dsms(config_dicts)
+    mp_context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=mp_context) as executor:
+        _run_in_parallel(executor, _prepare_dsms, dsm_config_dicts)
+        sim_paths = _run_in_parallel(executor, _run_and_save_simulation, config_dicts)
+    return sim_paths
+
+
+def _run_in_parallel(executor, function, config_dicts):
+    futures = {executor.submit(function, config_dict): config_dict['simulation_name'] for config_dict in config_dicts}
+    results = []
+    failed_sim_names = []
+    for future in as_completed(futures):
+        sim_name = futures[future]
+        try:
+            results.append(future.result())
+        except Exception as exception:
+            print(f'Simulation {sim_name} failed: {exception!r}')
+            failed_sim_names.append(sim_name)
+    if failed_sim_names:
+        raise RuntimeError(f'{function.__name__} failed for the simulations {failed_sim_names}.')
+    return results
+
+
+def _get_config_dicts_with_distinct_dsms(config_dicts):
+    """
+    Returns one config dict for every distinct DSM store, so that each store is only calculated once and no two
+    workers write the same store.
+    """
+    dsm_config_dicts = {}
     for config_dict in config_dicts:
-        _run_and_save_simulation(config_dict)
+        with use_config(create_config(config_dict)):
+            dsm_config_dicts.setdefault(get_dsms_store_path(country_specific=False), config_dict)
+    return list(dsm_config_dicts.values())
+
+
+def _prepare_dsms(config_dict):
+    with use_config(create_config(config_dict)):
+        load_dsms(country_specific=False, recalculate=False)
 
 
 def _run_and_save_simulation(config_dict):
     sim_name = config_dict['simulation_name']
-    model = run_simson(config_dict)
-    _save_simulation(sim_name, model)
+    model = run_simson(config_dict)  # installs the config of the run itself
+    with use_config(create_config(config_dict)):  # the saved data and figures depend on the config as well
+        return _save_simulation(sim_name, model)
 
 
 def _save_simulation(sim_name, model):
@@ -30,6 +99,7 @@ def _save_simulation(sim_name, model):
     _save_simulation_model(sim_path, sim_name, model)
     _save_simulation_data(sim_name, model, data_path)
     _save_simulation_figures(model, sim_name, figure_path)
+    return sim_path
 
 
 def _save_simulation_model(sim_path, sim_name, model):
@@ -39,24 +109,17 @@ def _save_simulation_model(sim_path, sim_name, model):
 
 
 def _save_simulation_data(sim_name, model, data_path):
-    flows = list(model.FlowDict.values())
-    stocks = list(model.StockDict.values())
-    flows_and_stocks = flows + stocks
+    """
+    Writes all flows and stocks in long format (one row per year, region and category) to one Parquet dataset,
+    partitioned by flow or stock name and scenario, e.g. '<sim_name>_results/name=<flow name>/scenario=SSP2/'.
+    Flows are converted and written one at a time. The dataset can be queried selectively, e.g. with
+    pyarrow.dataset.dataset(path, partitioning='hive').filter(...).
+    """
+    dataset_path = os.path.join(data_path, f'{sim_name}_results')
+    dimension_items = {'r': load_region_names_list(), 'g': cfg.in_use_categories, 'w': cfg.recycling_categories}
+    flows_and_stocks = list(model.FlowDict.values()) + list(model.StockDict.values())
     for flow_or_stock in flows_and_stocks:
-        flow_or_stock_name = flow_or_stock.Name
-        flow_or_stock_values = flow_or_stock.Values[:, 0]
-        dim2 = 1
-        for i in flow_or_stock_values.shape[1:]:
-            dim2 *= i
-        flow_or_stock_values = flow_or_stock_values.reshape(flow_or_stock_values.shape[0], dim2)
-
-        multi_index = _get_multi_index_from_indices(flow_or_stock.Indices)
-
-        df_values = pd.DataFrame(flow_or_stock_values, index=cfg.years, columns=multi_index)
-        df_values = df_values.transpose()
-
-        flow_or_stock_path = os.path.join(data_path, f'{sim_name}_{flow_or_stock_name}.csv')
-        df_values.to_csv(flow_or_stock_path)
+        _write_flow_or_stock_data(dataset_path, flow_or_stock, dimension_items)
 
 
 def _save_simulation_figures(model, sim_name, figure_path):
@@ -73,30 +136,51 @@ def _get_fig_path(figure_path, sim_name, fig_name):
     return os.path.join(figure_path, f'{sim_name}_{fig_name}.png')
 
 
-def _get_multi_index_from_indices(flow_or_stock_indices):
-    multi_index_array = []
-    multi_index_names = []
-    for char in flow_or_stock_indices[4:]:
-        if char == 'r':
-            multi_index_array.append(load_region_names_list())
-            multi_index_names.append('Region')
-        elif char == 'g':
-            multi_index_array.append(cfg.in_use_categories)
-            multi_index_names.append('In-Use category')
-        elif char == 'w':
-            multi_index_array.append(cfg.recycling_categories)
-            multi_index_names.append('Recycling category')
-        elif char == 's':
-            multi_index_array.append(cfg.scenarios)
-            multi_index_names.append('Scenario')
-    return pd.MultiIndex.from_product(iterables=multi_index_array, names=multi_index_names)
+def _write_flow_or_stock_data(dataset_path, flow_or_stock, dimension_items):
+    indices = flow_or_stock.Indices.split(',')
+    if indices[:2] != ['t', 'e'] or indices[-1] != 's':
+        raise RuntimeError(f"Indices '{flow_or_stock.Indices}' of {flow_or_stock.Name} can not be saved, they need "
+                           f"to start with time and element and end with scenario.")
+    is_block_flow = isinstance(flow_or_stock, BlockFlow)
+    # block flows are only made dense one scenario at a time
+    values = flow_or_stock.block_values[:, 0] if is_block_flow else flow_or_stock.Values[:, 0]
+    scenario_value_indices = ','.join(indices[:1] + indices[2:-1])
+    dense_shape = flow_or_stock.shape if is_block_flow else flow_or_stock.Values.shape
+    shape = dense_shape[:1] + dense_shape[2:-1]
+    positions = np.indices(shape).reshape(len(shape), -1)  # position of every row along every axis but scenario
+
+    columns = {'Year': pa.array(cfg.years[positions[0]].astype('int16'))}
+    for dimension, column_name in _RESULT_DIMENSION_COLUMNS.items():
+        column_type = _RESULT_SCHEMA.field(column_name).type
+        if dimension in indices:
+            axis = indices.index(dimension) - 1  # element axis is removed
+            columns[column_name] = pa.DictionaryArray.from_arrays(positions[axis].astype('int16'),
+                                                                  pa.array(dimension_items[dimension]))
+        else:
+            columns[column_name] = pa.nulls(positions.shape[1], type=column_type)
+
+    flow_or_stock_path = os.path.join(dataset_path, f'name={quote(flow_or_stock.Name, safe="")}')
+    for scenario_idx, scenario in enumerate(cfg.scenarios):
+        scenario_values = values[..., scenario_idx]
+        if is_block_flow:
+            scenario_values = flow_or_stock.to_dense(scenario_values, scenario_value_indices)
+        columns['Value'] = pa.array(scenario_values.reshape(-1))
+        table = pa.Table.from_pydict(columns, schema=_RESULT_SCHEMA)
+        partition_path = os.path.join(flow_or_stock_path, f'scenario={scenario}')
+        os.makedirs(partition_path)
+        pq.write_table(table, os.path.join(partition_path, 'part-0.parquet'), compression='zstd')
 
 
 def _create_simulation_folder_structure(sim_path):
-    sim_path = _check_sim_path(sim_path)
+    while True:
+        sim_path = _check_sim_path(sim_path)
+        try:
+            os.mkdir(sim_path)
+            break
+        except FileExistsError:  # created by a parallel run with the same name in the meantime
+            continue
     data_path = os.path.join(sim_path, 'data')
     figure_path = os.path.join(sim_path, 'figures')
-    os.mkdir(sim_path)
     os.mkdir(data_path)
     os.mkdir(figure_path)
     return sim_path, data_path, figure_path
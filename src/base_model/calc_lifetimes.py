@@ -6,7 +6,9 @@ from src.read_data.load_data import load_stocks, load_regions, load_region_names
 from src.tools.config import cfg
 
 
-def load_np_lifetimes(lifetime_source=cfg.lifetime_data_source, country_specific=False):
+def load_np_lifetimes(lifetime_source=None, country_specific=False):
+    if lifetime_source is None:
+        lifetime_source = cfg.lifetime_data_source
     if lifetime_source == 'Pauliuk_c':
         df = get_pauliuk_lifetimes_approach_c()
         return df
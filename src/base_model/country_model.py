@@ -0,0 +1,217 @@
+import os
+import numpy as np
+from src.tools.config import cfg
+from src.tools.array_store import array_store_exists, save_array_store, load_array_store, load_array_store_manifest
+from src.tools.cache_fingerprint import get_cache_fingerprint, BASE_MODEL_CONFIG_ATTRIBUTES
+from src.base_model.model_tools import calc_change_timeline, get_stock_data_country_specific_areas
+from src.base_model.load_dsms import create_dsm
+from src.base_model.load_params import get_cullen_fabrication_yield
+from src.base_model.simson_base_model import get_upper_cycle_trade, calc_upper_cycle_from_trade
+from src.predict.calc_steel_stocks import get_np_steel_stocks_with_prediction
+from src.read_data.load_data import load_lifetimes, load_regions, load_region_names_list
+
+# The country level model calculates the DSMs and upper cycle of all countries in chunks of cfg.n_countries_per_chunk
+# countries, as the cohort matrices of the DSMs of all countries at once do not fit into memory. The results of each
+# chunk are written to their own array store, the regional aggregates are summed up chunk by chunk.
+# Stock prediction and trade are calculated for all countries at once: the prediction curves are fitted across all
+# countries and trade is balanced across all countries, but both only need arrays without cohort or waste dimension.
+
+COUNTRY_MODEL_ARRAYS = ['stocks', 'inflows', 'outflows', 'production', 'forming_fabrication', 'fabrication_use',
+                        'imports', 'exports', 'indirect_imports', 'indirect_exports']
+_REGIONS_STORE_NAME = 'regions'
+
+
+def load_country_model(recalculate=None):
+    """
+    Calculates the country level model if it is not stored with the current config yet.
+
+    :param recalculate: Whether to recalculate stored results, cfg.recalculate_data is used if None.
+    :return: Path of the country model store, see load_country_results and load_regional_results.
+    """
+    if recalculate is None:
+        recalculate = cfg.recalculate_data
+    fingerprint = _get_country_model_fingerprint()
+    store_path = get_country_model_store_path(fingerprint)
+    regions_store_path = os.path.join(store_path, _REGIONS_STORE_NAME)
+    if recalculate or not array_store_exists(regions_store_path, fingerprint):
+        calc_country_model(store_path, fingerprint=fingerprint)
+    return store_path
+
+
+def get_country_model_store_path(fingerprint=None):
+    if fingerprint is None:
+        fingerprint = _get_country_model_fingerprint()
+    store_name = f'country_model_{fingerprint[:16]}'
+    return os.path.join(cfg.data_path, 'models', store_name)
+
+
+def calc_country_model(store_path, n_countries_per_chunk=None, fingerprint=None):
+    """
+    Calculates stocks, inflows, outflows and upper cycle flows (t,c,...) of all countries chunk by chunk and their
+    sums by region (t,r,...). The regional aggregates are saved last, their store marks a complete country model.
+
+    :param store_path: Directory of the country model, every chunk and the regional aggregates are saved to their own
+    array store within it.
+    :param n_countries_per_chunk: Number of countries per chunk, cfg.n_countries_per_chunk is used if None.
+    :param fingerprint: Fingerprint the regional aggregates are saved with, the one of the current config if None.
+    :return:
+    """
+    if n_countries_per_chunk is None:
+        n_countries_per_chunk = cfg.n_countries_per_chunk
+    if fingerprint is None:
+        fingerprint = _get_country_model_fingerprint()
+    countries = get_stock_data_country_specific_areas(country_specific=True)
+    region_indices = get_region_indices_of_countries(countries)
+    chunks = _get_chunks(len(countries), n_countries_per_chunk)
+
+    stocks = get_np_steel_stocks_with_prediction(country_specific=True, get_per_capita=False)
+    mean, std_dev = load_lifetimes()
+    mean, std_dev = mean[region_indices], std_dev[region_indices]
+
+    inflow_change_timeline = None
+    if cfg.do_change_inflow:
+        inflow_change_timeline = calc_change_timeline(cfg.inflow_change_factor, cfg.inflow_change_base_year)
+        inflow_change_timeline = np.expand_dims(inflow_change_timeline, axis=1)  # copy across countries
+    reuse_factor_timeline = None
+    if cfg.do_change_reuse and not cfg.do_model_approaches:  # as in simson_base_model.calc_flows
+        # one is substracted as one was added to multiply scenario and category reuse changes
+        reuse_factor_timeline = calc_change_timeline(cfg.reuse_factor, cfg.reuse_change_base_year) - 1
+
+    total_demand = np.zeros((cfg.n_years, len(countries), cfg.n_scenarios))
+    for chunk_idx, chunk in enumerate(chunks):
+        dsm = create_dsm(stocks[:, chunk], mean[chunk], std_dev[chunk], inflow_change_timeline)
+        inflows, outflows = _subtract_reuse(dsm.i, dsm.o, reuse_factor_timeline)
+        total_demand[:, chunk] = np.sum(inflows, axis=2)
+        save_array_store(_get_chunk_store_path(store_path, chunk_idx),
+                         {'stocks': dsm.s, 'inflows': dsm.i, 'outflows': dsm.o})
+        del dsm  # the cohort matrices are not needed anymore
+
+    # trade data covers other countries than the stock data, it is selected by country code in the stock data order
+    imports, exports, indirect_imports, indirect_exports = get_upper_cycle_trade(country_specific=True,
+                                                                                 total_demand=total_demand,
+                                                                                 countries=countries)
+    fabrication_yield = np.array(get_cullen_fabrication_yield())
+
+    n_regions = len(load_region_names_list())
+    regional_results = {}
+    for chunk_idx, chunk in enumerate(chunks):
+        chunk_store_path = _get_chunk_store_path(store_path, chunk_idx)
+        arrays, _ = load_array_store(chunk_store_path)
+        inflows, outflows = _subtract_reuse(arrays['inflows'], arrays['outflows'], reuse_factor_timeline)
+        production, forming_fabrication, fabrication_use = \
+            calc_upper_cycle_from_trade(inflows, fabrication_yield, imports[:, chunk], exports[:, chunk],
+                                        indirect_imports[:, chunk], indirect_exports[:, chunk])
+        results = {'stocks': arrays['stocks'], 'inflows': arrays['inflows'], 'outflows': arrays['outflows'],
+                   'production': production, 'forming_fabrication': forming_fabrication,
+                   'fabrication_use': fabrication_use, 'imports': imports[:, chunk], 'exports': exports[:, chunk],
+                   'indirect_imports': indirect_imports[:, chunk], 'indirect_exports': indirect_exports[:, chunk]}
+        save_array_store(chunk_store_path, results, metadata={'countries': [countries[idx] for idx in chunk]})
+
+        for name, values in results.items():
+            regional_values = aggregate_countries_to_regions(values, region_indices[chunk], n_regions)
+            if name in regional_results:
+                regional_results[name] += regional_values
+            else:
+                regional_results[name] = regional_values
+
+    save_array_store(os.path.join(store_path, _REGIONS_STORE_NAME), regional_results,
+                     metadata={'regions': load_region_names_list(), 'n_chunks': len(chunks)},
+                     fingerprint=fingerprint)
+
+
+def load_country_results(store_path=None, names=None):
+    """
+    Loads country level results of all chunks.
+
+    :param store_path: Directory of the country model, the one of the current config if None.
+    :param names: Names of the results to load (see COUNTRY_MODEL_ARRAYS), all results are loaded if None.
+    :return: Dictionary of result names and arrays (t,c,...), list of countries.
+    """
+    if store_path is None:
+        store_path = get_country_model_store_path()
+    if names is None:
+        names = COUNTRY_MODEL_ARRAYS
+    n_chunks = load_array_store_manifest(os.path.join(store_path, _REGIONS_STORE_NAME))['metadata']['n_chunks']
+    chunk_results = {name: [] for name in names}
+    countries = []
+    for chunk_idx in range(n_chunks):
+        arrays, metadata = load_array_store(_get_chunk_store_path(store_path, chunk_idx), names=names)
+        for name in names:
+            chunk_results[name].append(arrays[name])
+        countries += metadata['countries']
+    results = {name: np.concatenate(values, axis=1) for name, values in chunk_results.items()}
+    return results, countries
+
+
+def load_regional_results(store_path=None, names=None):
+    """
+    Loads the sums of the country level results by region.
+
+    :param store_path: Directory of the country model, the one of the current config if None.
+    :param names: Names of the results to load (see COUNTRY_MODEL_ARRAYS), all results are loaded if None.
+    :return: Dictionary of result names and arrays (t,r,...), list of regions.
+    """
+    if store_path is None:
+        store_path = get_country_model_store_path()
+    arrays, metadata = load_array_store(os.path.join(store_path, _REGIONS_STORE_NAME), names=names)
+    return arrays, metadata['regions']
+
+
+def get_region_indices_of_countries(countries):
+    """
+    Returns the index of the region of every country in the region names list of the current region data source.
+    """
+    df_regions = load_regions()
+    missing_countries = sorted(set(countries) - set(df_regions.index))
+    if missing_countries:
+        raise RuntimeError(f'The countries {missing_countries} are not part of any {cfg.region_data_source} region.')
+    region_names = load_region_names_list()
+    country_regions = df_regions.loc[countries, df_regions.columns[0]]
+    return np.array([region_names.index(region) for region in country_regions])
+
+
+def aggregate_countries_to_regions(values, region_indices, n_regions):
+    """
+    Sums up country values (t,c,...) to region values (t,r,...).
+
+    :param values: Country values with the countries as second axis.
+    :param region_indices: Region index of every country, see get_region_indices_of_countries.
+    :param n_regions:
+    :return:
+    """
+    membership = np.zeros((len(region_indices), n_regions))
+    membership[np.arange(len(region_indices)), region_indices] = 1
+    region_values = np.tensordot(values, membership, axes=([1], [0]))
+    return np.moveaxis(region_values, -1, 1)
+
+
+def _subtract_reuse(inflows, outflows, reuse_factor_timeline):
+    if reuse_factor_timeline is None:
+        return inflows, outflows
+    reuse = np.einsum('trgs,tgs->trgs', outflows, reuse_factor_timeline)
+    return inflows - reuse, outflows - reuse
+
+
+def _get_chunks(n_countries, n_countries_per_chunk):
+    return [np.arange(start, min(start + n_countries_per_chunk, n_countries))
+            for start in range(0, n_countries, n_countries_per_chunk)]
+
+
+def _get_chunk_store_path(store_path, chunk_idx):
+    return os.path.join(store_path, f'chunk_{chunk_idx:04d}')
+
+
+def _get_country_model_fingerprint():
+    return get_cache_fingerprint(BASE_MODEL_CONFIG_ATTRIBUTES, extra={'country_specific': True})
+
+
+def _test():
+    store_path = load_country_model(recalculate=True)
+    country_results, countries = load_country_results(store_path, names=['production'])
+    regional_results, regions = load_regional_results(store_path, names=['production'])
+    print(f'Production of {len(countries)} countries: {country_results["production"].shape}, '
+          f'of {len(regions)} regions: {regional_results["production"].shape}')
+
+
+if __name__ == '__main__':
+    _test()
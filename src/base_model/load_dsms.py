@@ -1,60 +1,95 @@
 import os
-import pickle
 import numpy as np
-from src.odym_extension.MultiDim_DynamicStockModel import MultiDim_DynamicStockModel
+from src.odym_extension.Batch_DynamicStockModel import Batch_DynamicStockModel, save_batch_dsm, load_batch_dsm
+from src.odym_extension.lifetime_kernels import save_lifetime_kernels
+from src.tools.array_store import array_store_exists
+from src.tools.cache_fingerprint import get_cache_fingerprint, STOCK_CONFIG_ATTRIBUTES
 from src.tools.config import cfg
 from src.base_model.model_tools import calc_change_timeline
 from src.predict.calc_steel_stocks import get_np_steel_stocks_with_prediction
-from src.read_data.load_data import load_lifetimes, load_region_names_list
+from src.read_data.load_data import load_lifetimes
 
 
-def load_dsms(country_specific, recalculate=cfg.recalculate_data):
-    file_name_end = '_countries' if country_specific else f'_{cfg.region_data_source}_regions'
-    file_name = f"dsms_{file_name_end}.p"
-    file_path = os.path.join(cfg.data_path, 'models', file_name)
-    if os.path.exists(file_path) and not recalculate:
-        dsms = pickle.load(open(file_path, "rb"))
+def load_dsms(country_specific, recalculate=None, stocks=None):
+    """
+    Loads the stored DSMs or calculates and stores them.
+
+    :param country_specific:
+    :param recalculate: Whether to calculate the DSMs even if they are stored, cfg.recalculate_data is used if None.
+    :param stocks: Total stocks (t,r,g,s) with prediction the DSMs are calculated from, they are predicted if None.
+    :return: Batch_DynamicStockModel
+    """
+    if recalculate is None:
+        recalculate = cfg.recalculate_data
+    fingerprint = _get_dsms_fingerprint()  # calculated once, the inputs may change while the DSMs are calculated
+    store_path = get_dsms_store_path(country_specific, fingerprint)
+    if array_store_exists(store_path, fingerprint) and not recalculate:
+        dsms = load_batch_dsm(store_path)
         return dsms
     else:
-        dsms = _get_dsms(country_specific)
-        pickle.dump(dsms, open(file_path, "wb"))
+        dsms = _get_dsms(country_specific, stocks)
+        save_batch_dsm(dsms, store_path, fingerprint)
+        save_lifetime_kernels()
         return dsms
 
 
-def _get_dsms(country_specific):
-    stocks_data = get_np_steel_stocks_with_prediction(country_specific=country_specific,
-                                                      get_per_capita=False)
-    area_names = load_region_names_list()
+def get_dsms_store_path(country_specific, fingerprint=None):
+    """
+    DSMs of different stock configurations (e.g. of the runs of a scenario sweep) are stored side by side, the store
+    name contains the start of their fingerprint. The fingerprint of the current config is calculated if None.
+    """
+    if fingerprint is None:
+        fingerprint = _get_dsms_fingerprint()
+    file_name_end = '_countries' if country_specific else f'_{cfg.region_data_source}_regions'
+    store_name = f"dsms_{file_name_end}_{fingerprint[:16]}"
+    return os.path.join(cfg.data_path, 'models', store_name)
+
+
+def dsms_are_stored(country_specific):
+    fingerprint = _get_dsms_fingerprint()
+    return array_store_exists(get_dsms_store_path(country_specific, fingerprint), fingerprint)
+
+
+def _get_dsms_fingerprint():
+    return get_cache_fingerprint(STOCK_CONFIG_ATTRIBUTES)
+
+
+def _get_dsms(country_specific, stocks_data=None):
+    if stocks_data is None:
+        stocks_data = get_np_steel_stocks_with_prediction(country_specific=country_specific,
+                                                          get_per_capita=False)
     mean, std_dev = load_lifetimes()
 
+    inflow_change_timeline = None
     if cfg.do_change_inflow:
         inflow_change_timeline = calc_change_timeline(cfg.inflow_change_factor, cfg.inflow_change_base_year)
+        inflow_change_timeline = np.expand_dims(inflow_change_timeline, axis=1)  # copy across regions
 
-    dsms = [[[_create_dsm(stocks_data[:, area_idx, cat_idx, scenario_idx],
-                          mean[area_idx, cat_idx], std_dev[area_idx, cat_idx],
-                          inflow_change_timeline[:, cat_idx, scenario_idx] if cfg.do_change_inflow else None)
-              for scenario_idx in range(cfg.n_scenarios)]
-             for cat_idx in range(cfg.n_use_categories)]
-            for area_idx, area_name in enumerate(area_names)]
+    dsms = create_dsm(stocks_data, mean, std_dev, inflow_change_timeline)
     return dsms
 
 
-def _create_dsm(stocks, lifetime, st_dev, inflow_change=None):
+def create_dsm(stocks, lifetime, st_dev, inflow_change=None):
+    """
+    Creates one batch dynamic stock model for all regions, in-use categories and scenarios.
+    Lifetimes are given by region and category and shared across scenarios.
+    """
     time = np.array(range(cfg.n_years))
-    steel_stock_dsm = MultiDim_DynamicStockModel(t=time,
-                                                 s=stocks,
-                                                 lt={'Type': 'Normal', 'Mean': [lifetime],
-                                                     'StdDev': [st_dev]})
+    lt = {'Type': 'Normal', 'Mean': np.expand_dims(lifetime, axis=0),
+          'StdDev': np.expand_dims(st_dev, axis=0)}
+    steel_stock_dsm = Batch_DynamicStockModel(t=time,
+                                              s=stocks,
+                                              lt=lt)
 
     steel_stock_dsm.compute_all_stock_driven()
 
     if inflow_change is not None:
         inflows = steel_stock_dsm.i
         inflows = inflows * inflow_change
-        steel_stock_dsm = MultiDim_DynamicStockModel(t=time,
-                                                     i=inflows,
-                                                     lt={'Type': 'Normal', 'Mean': [lifetime],
-                                                         'StdDev': [st_dev]})
+        steel_stock_dsm = Batch_DynamicStockModel(t=time,
+                                                  i=inflows,
+                                                  lt=steel_stock_dsm.lt,
+                                                  sf=steel_stock_dsm.sf)
         steel_stock_dsm.compute_all_inflow_driven()
 
     return steel_stock_dsm
@@ -16,17 +16,8 @@ def calc_change_timeline(factor, base_year, get_timeline_from_baseyear=False):
 
 
 def get_dsm_data(dsms):
-    stocks = np.array([[[dsm_scenario.s for dsm_scenario in dsms_category] for dsms_category in dsms_region]
-                       for dsms_region in dsms])
-    inflows = np.array([[[dsm_scenario.i for dsm_scenario in dsms_category] for dsms_category in dsms_region]
-                        for dsms_region in dsms])
-    outflows = np.array([[[dsm_scenario.o for dsm_scenario in dsms_category] for dsms_category in dsms_region]
-                         for dsms_region in dsms])
-    stocks = np.moveaxis(stocks, -1, 0)
-    inflows = np.moveaxis(inflows, -1, 0)
-    outflows = np.moveaxis(outflows, -1, 0)
-
-    return stocks, inflows, outflows
+    # copies are returned as callers edit the data in place
+    return dsms.s.copy(), dsms.i.copy(), dsms.o.copy()
 
 
 def get_stock_data_country_specific_areas(country_specific):
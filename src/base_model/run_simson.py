@@ -1,12 +1,10 @@
-from src.base_model.simson_base_model import create_base_model
-from src.economic_model.simson_econ_model import create_economic_model
-from src.tools.config import cfg
+from src.base_model.simson_pipeline import run_simson_pipeline
+from src.tools.config import cfg, create_config, use_config
 
 
 def run_simson(config_dict):
-    cfg.customize(config_dict)
-    model = create_economic_model(country_specific=False, recalculate_dsms=False) if cfg.do_model_economy \
-        else create_base_model(country_specific=False, recalculate_dsms=True)
+    with use_config(create_config(config_dict)):
+        model = run_simson_pipeline(country_specific=False)
     return model
 
 
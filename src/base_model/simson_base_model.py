@@ -2,10 +2,12 @@ import numpy as np
 import pandas as pd
 import os
 import sys
-import pickle
 from ODYM.odym.modules.ODYM_Classes import MFAsystem, Classification, Process, Parameter
-from src.odym_extension.SimDiGraph_MFAsystem import SimDiGraph_MFAsystem
+from src.odym_extension.SimDiGraph_MFAsystem import SimDiGraph_MFAsystem, save_mfa_system_values, \
+    load_mfa_system_values, MFA_VALUES_VERSION
 from src.tools.config import cfg
+from src.tools.array_store import array_store_exists
+from src.tools.cache_fingerprint import get_cache_fingerprint, BASE_MODEL_CONFIG_ATTRIBUTES, MODEL_CONFIG_ATTRIBUTES
 from src.base_model.model_tools import get_dsm_data, get_stock_data_country_specific_areas, calc_change_timeline
 from src.base_model.load_dsms import load_dsms
 from src.base_model.load_params import get_cullen_fabrication_yield, get_wittig_distributions
@@ -30,18 +32,41 @@ DISNOTCOL_PID = 9
 
 
 def load_simson_base_model(country_specific=False, recalculate=False, recalculate_dsms=False) -> SimDiGraph_MFAsystem:
-    file_name_end = 'countries' if country_specific else f'{cfg.region_data_source}_regions'
-    file_name = f'main_model_{file_name_end}.p'
-    file_path = os.path.join(cfg.data_path, 'models', file_name)
-    do_load_existing = os.path.exists(file_path) and not recalculate
+    store_path = get_base_model_store_path(country_specific)
+    fingerprint = get_model_fingerprint()
+    do_load_existing = array_store_exists(store_path, fingerprint) and not recalculate
     if do_load_existing:
-        model = pickle.load(open(file_path, "rb"))
+        model = load_model_from_store(store_path, country_specific)
     else:
         model = create_base_model(country_specific, recalculate_dsms)
-        pickle.dump(model, open(file_path, "wb"))
+        save_mfa_system_values(model, store_path, fingerprint)
     return model
 
 
+def get_model_fingerprint(do_econ_model=False):
+    """
+    The base model does not depend on the steel prices and the parameters of the economic model, so sweeps of these
+    only recalculate the economic model.
+    """
+    config_attributes = MODEL_CONFIG_ATTRIBUTES if do_econ_model else BASE_MODEL_CONFIG_ATTRIBUTES
+    return get_cache_fingerprint(config_attributes, extra={'mfa_values_version': MFA_VALUES_VERSION})
+
+
+def get_base_model_store_path(country_specific):
+    store_name_end = 'countries' if country_specific else f'{cfg.region_data_source}_regions'
+    return os.path.join(cfg.data_path, 'models', f'main_model_{store_name_end}')
+
+
+def load_model_from_store(store_path, country_specific):
+    """
+    Sets up the MFA system and links its flow and stock values to the (memory mapped) arrays of the store.
+    """
+    areas = get_stock_data_country_specific_areas(country_specific)
+    main_model = set_up_model(areas)
+    initiate_model(main_model, store_path=store_path)
+    return main_model
+
+
 def create_base_model(country_specific, recalculate_dsms):
     dsms = load_dsms(country_specific, recalculate_dsms)
     model, balance_message = create_model(country_specific, dsms)
@@ -49,8 +74,20 @@ def create_base_model(country_specific, recalculate_dsms):
     return model
 
 
-def create_model(country_specific, dsms, scrap_share_in_production=None):
-    n_regions = len(dsms)
+def create_model(country_specific, dsms, scrap_share_in_production=None, trade_data=None, model_dsms=None):
+    """
+    Creates the MFA system from the DSMs and checks its mass balance.
+
+    :param country_specific:
+    :param dsms:
+    :param scrap_share_in_production:
+    :param trade_data: Net trade data by 'crude', 'indirect' and 'scrap' trade, see e.g.
+    calc_trade.get_net_trade_1970_2021. Trade data that is not given is loaded.
+    :param model_dsms: The past and future DSMs of the model type with modelling approaches, see
+    compute_upper_cycle. They are loaded if None.
+    :return: The MFA system and the message of the mass balance check.
+    """
+    n_regions = dsms.i.shape[1]
     max_scrap_share_in_production = _calc_max_scrap_share(scrap_share_in_production, n_regions)
     # load data
     areas = get_stock_data_country_specific_areas(country_specific)
@@ -61,7 +98,7 @@ def create_model(country_specific, dsms, scrap_share_in_production=None):
 
     # compute stocks and flows
     inflows, outflows = compute_flows(main_model, country_specific, inflows, outflows,
-                                      max_scrap_share_in_production)
+                                      max_scrap_share_in_production, trade_data, model_dsms)
     compute_stocks(main_model, inflows, outflows)
 
     # check base_model
@@ -70,13 +107,39 @@ def create_model(country_specific, dsms, scrap_share_in_production=None):
     return main_model, balance_message
 
 
-def initiate_model(main_model):
+def create_model_flows(country_specific, dsms, scrap_share_in_production=None, trade_data=None, model_dsms=None):
+    """
+    Lightweight alternative to create_model that only calculates the flow values, without setting up the
+    ODYM MFA system with its flows and stocks and without checking it.
+
+    :param country_specific:
+    :param dsms:
+    :param scrap_share_in_production:
+    :param trade_data: See create_model.
+    :param model_dsms: See create_model.
+    :return: Dictionary of the flow values by (origin, destination) process IDs, indexed like the values of
+    get_flowV without the element axis.
+    """
+    n_regions = dsms.i.shape[1]
+    max_scrap_share_in_production = _calc_max_scrap_share(scrap_share_in_production, n_regions)
+    stocks, inflows, outflows = get_dsm_data(dsms)
+    use_eol_distribution, eol_recycle_distribution, fabrication_yield = _load_params()
+    flows, inflows, outflows = calc_flows(country_specific, inflows, outflows, max_scrap_share_in_production,
+                                          use_eol_distribution, eol_recycle_distribution, fabrication_yield,
+                                          trade_data, model_dsms)
+    return flows
+
+
+def initiate_model(main_model, store_path=None):
     initiate_processes(main_model)
     initiate_parameters(main_model)
     initiate_flows(main_model)
     initiate_stocks(main_model)
-    main_model.Initialize_FlowValues()
-    main_model.Initialize_StockValues()
+    if store_path is None:
+        main_model.Initialize_FlowValues()
+        main_model.Initialize_StockValues()
+    else:
+        load_mfa_system_values(main_model, store_path)
     check_consistency(main_model)
 
 
@@ -139,26 +202,32 @@ def initiate_processes(main_model):
 def initiate_parameters(main_model):
     parameter_dict = {}
 
-    use_recycling_params, recycling_usable_params = get_wittig_distributions()
-    fabrication_yield = get_cullen_fabrication_yield()
+    use_eol_distribution, eol_recycle_distribution, fabrication_yield = _load_params()
 
     parameter_dict['Fabrication_Yield'] = Parameter(Name='Fabrication_Yield', ID=0,
                                                     P_Res=FABR_PID, MetaData=None, Indices='g',
-                                                    Values=np.array(fabrication_yield), Unit='1')
+                                                    Values=fabrication_yield, Unit='1')
 
     parameter_dict['Use-EOL_Distribution'] = Parameter(Name='End-of-Life_Distribution', ID=1, P_Res=USE_PID,
                                                        MetaData=None, Indices='gw',
-                                                       Values=np.array(use_recycling_params).transpose(), Unit='1')
+                                                       Values=use_eol_distribution, Unit='1')
 
     parameter_dict['EOL-Recycle_Distribution'] = Parameter(Name='EOL-Recycle_Distribution', ID=2,
                                                            P_Res=SCRAP_PID,
                                                            MetaData=None, Indices='w',
-                                                           Values=np.array(recycling_usable_params), Unit='1')
+                                                           Values=eol_recycle_distribution, Unit='1')
 
     main_model.ParameterDict = parameter_dict
 
 
 def initiate_flows(main_model):
+    # scrap flows of forming and fabrication only have values in their waste category, in-use flows to scrap and
+    # to dissipative/not collectable only in the categories before and after 'Dis' respectively
+    form_idx = cfg.recycling_categories.index('Form')
+    fabr_idx = cfg.recycling_categories.index('Fabr')
+    dis_idx = cfg.recycling_categories.index('Dis')
+    n_waste_categories = len(cfg.recycling_categories)
+
     main_model.init_flow('Iron scaler - BOF scaler', ENV_PID, BOF_PID, 't,e,r,s')
     main_model.init_flow('Recycling - BOF scaler', RECYCLE_PID, BOF_PID, 't,e,r,s')
     main_model.init_flow('BOF scaler - Forming', BOF_PID, FORM_PID, 't,e,r,s')
@@ -166,13 +235,15 @@ def initiate_flows(main_model):
     main_model.init_flow('EAF scaler - Forming', EAF_PID, FORM_PID, 't,e,r,s')
 
     main_model.init_flow('Forming - Fabrication', FORM_PID, FABR_PID, 't,e,r,s')
-    main_model.init_flow('Forming - Scrap', FORM_PID, SCRAP_PID, 't,e,r,w,s')
+    main_model.init_flow('Forming - Scrap', FORM_PID, SCRAP_PID, 't,e,r,w,s', block=('w', form_idx, form_idx + 1))
     main_model.init_flow('Fabrication - In-Use', FABR_PID, USE_PID, 't,e,r,g,s')
-    main_model.init_flow('Fabrication - Scrap', FABR_PID, SCRAP_PID, 't,e,r,w,s')
+    main_model.init_flow('Fabrication - Scrap', FABR_PID, SCRAP_PID, 't,e,r,w,s',
+                         block=('w', fabr_idx, fabr_idx + 1))
 
     main_model.init_flow('In-Use - Reuse', USE_PID, USE_PID, 't,e,r,g,s')
-    main_model.init_flow('In-Use - Scrap', USE_PID, SCRAP_PID, 't,e,r,g,w,s')
-    main_model.init_flow('In-Use - Dis./Not col.', USE_PID, DISNOTCOL_PID, 't,e,r,g,w,s')
+    main_model.init_flow('In-Use - Scrap', USE_PID, SCRAP_PID, 't,e,r,g,w,s', block=('w', 0, dis_idx))
+    main_model.init_flow('In-Use - Dis./Not col.', USE_PID, DISNOTCOL_PID, 't,e,r,g,w,s',
+                         block=('w', dis_idx, n_waste_categories))
     main_model.init_flow('Scrap - Recycling', SCRAP_PID, RECYCLE_PID, 't,e,r,s')
     main_model.init_flow('Scrap - Waste', SCRAP_PID, WASTE_PID, 't,e,r,s')
 
@@ -205,7 +276,8 @@ def check_consistency(main_model: MFAsystem):
 
 
 def compute_flows(model: MFAsystem, country_specific: bool,
-                  inflows: np.ndarray, outflows: np.ndarray, max_scrap_share_in_production: np.ndarray):
+                  inflows: np.ndarray, outflows: np.ndarray, max_scrap_share_in_production: np.ndarray,
+                  trade_data: dict = None, model_dsms: tuple = None):
     """
 
     :param model: The MFA system
@@ -213,26 +285,56 @@ def compute_flows(model: MFAsystem, country_specific: bool,
     :param inflows:
     :param outflows:
     :param max_scrap_share_in_production:
+    :param trade_data: See create_model.
+    :param model_dsms: See create_model.
     :return:
     """
+    use_eol_distribution, eol_recycle_distribution, fabrication_yield = _get_params(model)
+    flows, inflows, outflows = calc_flows(country_specific, inflows, outflows, max_scrap_share_in_production,
+                                          use_eol_distribution, eol_recycle_distribution, fabrication_yield,
+                                          trade_data, model_dsms)
+    edit_flows(model, flows)
+
+    return inflows, outflows
+
+
+def calc_flows(country_specific: bool, inflows: np.ndarray, outflows: np.ndarray,
+               max_scrap_share_in_production: np.ndarray, use_eol_distribution: np.ndarray,
+               eol_recycle_distribution: np.ndarray, fabrication_yield: np.ndarray, trade_data: dict = None,
+               model_dsms: tuple = None):
+    """
+    Calculates the values of all flows of the MFA system without needing the MFA system itself.
+
+    :param country_specific:
+    :param inflows:
+    :param outflows:
+    :param max_scrap_share_in_production:
+    :param use_eol_distribution:
+    :param eol_recycle_distribution:
+    :param fabrication_yield:
+    :param trade_data: See create_model.
+    :param model_dsms: See create_model.
+    :return: Dictionary of the flow values by (origin, destination) process IDs, inflows and outflows.
+    """
 
     # Compute upper cycle
     # production, trade, forming_fabrication, fabrication_use, indirect_trade, inflows, stocks, outflows
 
-    use_eol_distribution, eol_recycle_distribution, fabrication_yield = _get_params(model)
-
+    if trade_data is None:
+        trade_data = {}
     reuse = None
     if cfg.do_change_reuse and not cfg.do_model_approaches:
         # one is substracted as one was added to multiply scenario and category reuse changes
         reuse_factor_timeline = calc_change_timeline(cfg.reuse_factor, cfg.reuse_change_base_year) - 1
         reuse = np.einsum('trgs,tgs->trgs', outflows, reuse_factor_timeline)
-        inflows -= reuse
-        outflows -= reuse
+        inflows = inflows - reuse
+        outflows = outflows - reuse
 
     production, forming_fabrication, imports, exports, fabrication_use, indirect_imports, indirect_exports, \
-    inflows, outflows = compute_upper_cycle_base_model(country_specific, inflows, outflows, fabrication_yield) \
+    inflows, outflows = compute_upper_cycle_base_model(country_specific, inflows, outflows, fabrication_yield,
+                                                       trade_data) \
         if not cfg.do_model_approaches \
-        else compute_upper_cycle_modelling_approaches()
+        else compute_upper_cycle_modelling_approaches(model_dsms)
 
     direct_demand = np.sum(fabrication_use, axis=2)
     fabrication_scrap = forming_fabrication - direct_demand
@@ -253,7 +355,8 @@ def compute_flows(model: MFAsystem, country_specific: bool,
     available_scrap[:, :, cfg.recycling_categories.index('Fabr'), :] = fabrication_scrap
 
     scrap_imports, scrap_exports = get_scrap_trade(country_specific=country_specific, scaler=production,
-                                                   available_scrap_by_category=available_scrap)
+                                                   available_scrap_by_category=available_scrap,
+                                                   scrap_trade_1971_2022=trade_data.get('scrap'))
 
     total_scrap = available_scrap + scrap_imports - scrap_exports
 
@@ -274,16 +377,18 @@ def compute_flows(model: MFAsystem, country_specific: bool,
     scrap_in_production = scrap_in_bof + eaf_production
     waste = np.sum(total_scrap, axis=2) - scrap_in_production
 
-    edit_flows(model, iron_production, scrap_in_bof, bof_production, eaf_production, forming_fabrication, forming_scrap,
-               imports, exports, fabrication_use, reuse, fabrication_scrap, use_eol, use_env, scrap_imports,
-               scrap_exports, scrap_in_production, waste, indirect_imports, indirect_exports)
+    flows = _get_flows_dict(iron_production, scrap_in_bof, bof_production, eaf_production, forming_fabrication,
+                            forming_scrap, imports, exports, fabrication_use, reuse, fabrication_scrap, use_eol,
+                            use_env, scrap_imports, scrap_exports, scrap_in_production, waste, indirect_imports,
+                            indirect_exports)
 
-    return inflows, outflows
+    return flows, inflows, outflows
 
 
-def compute_upper_cycle_modelling_approaches():
+def compute_upper_cycle_modelling_approaches(model_dsms=None):
+    past_dsms, future_dsms = (None, None) if model_dsms is None else model_dsms
     production, trade, forming_fabrication, fabrication_use, indirect_trade, inflows, stocks, outflows = \
-        compute_upper_cycle(model_type=cfg.model_type)
+        compute_upper_cycle(model_type=cfg.model_type, past_dsms=past_dsms, future_dsms=future_dsms)
     imports, exports = get_imports_and_exports_from_net_trade(trade)
     indirect_imports, indirect_exports = get_imports_and_exports_from_net_trade(indirect_trade)
 
@@ -291,52 +396,101 @@ def compute_upper_cycle_modelling_approaches():
            inflows, outflows
 
 
-def compute_upper_cycle_base_model(country_specific, inflows, outflows, fabrication_yield):
+def compute_upper_cycle_base_model(country_specific, inflows, outflows, fabrication_yield, trade_data=None):
     total_demand = np.sum(inflows, axis=2)
+    imports, exports, indirect_imports, indirect_exports = get_upper_cycle_trade(country_specific, total_demand,
+                                                                                 inflows, outflows,
+                                                                                 trade_data=trade_data)
+    production, forming_fabrication, fabrication_use = calc_upper_cycle_from_trade(inflows, fabrication_yield,
+                                                                                   imports, exports,
+                                                                                   indirect_imports,
+                                                                                   indirect_exports)
+    return production, forming_fabrication, imports, exports, fabrication_use, indirect_imports, indirect_exports, \
+           inflows, outflows
+
 
+def get_upper_cycle_trade(country_specific, total_demand, inflows=None, outflows=None, countries=None,
+                          trade_data=None):
+    """
+    Trade is balanced across all areas, hence it needs the total demand (t,r,s) of all areas. Inflows and outflows
+    are only needed if indirect trade is not split into categories by real data. If countries are given, the trade
+    data of these countries is selected by country code in the order of the total demand. Given trade data (see
+    create_model) has to be of the areas of the total demand.
+    """
+    if trade_data is None:
+        trade_data = {}
     indirect_imports, indirect_exports = get_indirect_trade(country_specific=country_specific,
                                                             scaler=total_demand,
                                                             inflows=inflows,
-                                                            outflows=outflows)
+                                                            outflows=outflows,
+                                                            countries=countries,
+                                                            net_indirect_trade_2001_2019=trade_data.get('indirect'))
+    imports, exports = get_trade(country_specific=country_specific, scaler=total_demand, countries=countries,
+                                 net_trade_1970_2021=trade_data.get('crude'))
+    return imports, exports, indirect_imports, indirect_exports
+
+
+def calc_upper_cycle_from_trade(inflows, fabrication_yield, imports, exports, indirect_imports, indirect_exports):
+    """
+    Given the trade, the upper cycle of every area only depends on its own inflows, so it can be calculated for
+    subsets of areas, e.g. chunks of countries.
+    """
     fabrication_use = inflows - indirect_imports + indirect_exports
 
     inverse_fabrication_yield = 1 / fabrication_yield
     fabrication_by_category = np.einsum('trgs,g->trgs', fabrication_use, inverse_fabrication_yield)
     forming_fabrication = np.sum(fabrication_by_category, axis=2)
 
-    imports, exports = get_trade(country_specific=country_specific, scaler=total_demand)
-
     production_plus_trade = forming_fabrication * (1 / cfg.forming_yield)
     production = production_plus_trade + exports - imports
 
-    return production, forming_fabrication, imports, exports, fabrication_use, indirect_imports, indirect_exports, \
-           inflows, outflows
+    return production, forming_fabrication, fabrication_use
+
+
+def _get_flows_dict(iron_production, scrap_in_bof, bof_production, eaf_production, forming_fabrication,
+                    forming_scrap, imports, exports, fabrication_use, reuse, fabrication_scrap, use_eol, use_env,
+                    scrap_imports, scrap_exports, scrap_in_production, waste, indirect_imports, indirect_exports):
+    forming_scrap_by_waste = np.zeros_like(scrap_imports)
+    forming_scrap_by_waste[:, :, cfg.recycling_categories.index('Form')] = forming_scrap
+    fabrication_scrap_by_waste = np.zeros_like(scrap_imports)
+    fabrication_scrap_by_waste[:, :, cfg.recycling_categories.index('Fabr')] = fabrication_scrap
+
+    flows = {(ENV_PID, BOF_PID): iron_production,
+             (RECYCLE_PID, BOF_PID): scrap_in_bof,
+             (BOF_PID, FORM_PID): bof_production,
+             (RECYCLE_PID, EAF_PID): eaf_production,
+             (EAF_PID, FORM_PID): eaf_production,
+             (FORM_PID, FABR_PID): forming_fabrication,
+             (FORM_PID, SCRAP_PID): forming_scrap_by_waste,
+             (ENV_PID, FORM_PID): imports,
+             (FORM_PID, ENV_PID): exports,
+             (FABR_PID, USE_PID): fabrication_use,
+             (ENV_PID, USE_PID): indirect_imports,
+             (USE_PID, ENV_PID): indirect_exports,
+             (FABR_PID, SCRAP_PID): fabrication_scrap_by_waste,
+             (USE_PID, SCRAP_PID): use_eol,
+             (USE_PID, DISNOTCOL_PID): use_env,
+             (ENV_PID, SCRAP_PID): scrap_imports,
+             (SCRAP_PID, ENV_PID): scrap_exports,
+             (SCRAP_PID, RECYCLE_PID): scrap_in_production,
+             (SCRAP_PID, WASTE_PID): waste}
+    if reuse is not None:
+        flows[(USE_PID, USE_PID)] = reuse
+    return flows
 
 
-def edit_flows(model, iron_production, scrap_in_bof, bof_production, eaf_production, forming_fabrication, forming_scrap,
-               imports, exports, fabrication_use, reuse, fabrication_scrap, use_eol, use_env, scrap_imports,
-               scrap_exports, scrap_in_production, waste, indirect_imports, indirect_exports):
-    model.get_flowV(ENV_PID, BOF_PID)[:, 0] = iron_production
-    model.get_flowV(RECYCLE_PID, BOF_PID)[:, 0] = scrap_in_bof
-    model.get_flowV(BOF_PID, FORM_PID)[:, 0] = bof_production
-    model.get_flowV(RECYCLE_PID, EAF_PID)[:, 0] = eaf_production
-    model.get_flowV(EAF_PID, FORM_PID)[:, 0] = eaf_production
-    model.get_flowV(FORM_PID, FABR_PID)[:, 0] = forming_fabrication
-    model.get_flowV(FORM_PID, SCRAP_PID)[:, 0, :, cfg.recycling_categories.index('Form')] = forming_scrap
-    model.get_flowV(ENV_PID, FORM_PID)[:, 0] = imports
-    model.get_flowV(FORM_PID, ENV_PID)[:, 0] = exports
-    model.get_flowV(FABR_PID, USE_PID)[:, 0] = fabrication_use
-    model.get_flowV(ENV_PID, USE_PID)[:, 0] = indirect_imports
-    model.get_flowV(USE_PID, ENV_PID)[:, 0] = indirect_exports
-    model.get_flowV(FABR_PID, SCRAP_PID)[:, 0, :, cfg.recycling_categories.index('Fabr')] = fabrication_scrap
-    if reuse is not None:
-        model.get_flowV(USE_PID, USE_PID)[:, 0] = reuse
-    model.get_flowV(USE_PID, SCRAP_PID)[:, 0] = use_eol
-    model.get_flowV(USE_PID, DISNOTCOL_PID)[:, 0] = use_env
-    model.get_flowV(ENV_PID, SCRAP_PID)[:, 0] = scrap_imports
-    model.get_flowV(SCRAP_PID, ENV_PID)[:, 0] = scrap_exports
-    model.get_flowV(SCRAP_PID, RECYCLE_PID)[:, 0] = scrap_in_production
-    model.get_flowV(SCRAP_PID, WASTE_PID)[:, 0] = waste
+def edit_flows(model, flows):
+    for (origin_pid, destination_pid), values in flows.items():
+        model.set_flowV(origin_pid, destination_pid, values)
+
+
+def _load_params():
+    use_recycling_params, recycling_usable_params = get_wittig_distributions()
+    fabrication_yield = get_cullen_fabrication_yield()
+    use_eol_distribution = np.array(use_recycling_params).transpose()
+    eol_recycle_distribution = np.array(recycling_usable_params)
+
+    return use_eol_distribution, eol_recycle_distribution, np.array(fabrication_yield)
 
 
 def _get_params(model):
@@ -372,33 +526,28 @@ def compute_stocks(model, inflows, outflows):
     model.get_stock_changeV(WASTE_PID)[:] = inflow_waste
     model.calculate_stock_values_from_stock_change(WASTE_PID)
 
-    inflow_disnotcol = model.get_flowV(USE_PID, DISNOTCOL_PID)
-    inflow_disnotcol = np.sum(inflow_disnotcol, axis=3)
+    inflow_disnotcol = model.get_flow_sum(USE_PID, DISNOTCOL_PID, 't,e,r,w,s')
     model.get_stock_changeV(DISNOTCOL_PID)[:] = inflow_disnotcol
     model.calculate_stock_values_from_stock_change(DISNOTCOL_PID)
 
     return model
 
 
-def mass_balance_plausible(main_model):
+def mass_balance_plausible(main_model, n_sample_years=None, seed=None):
     """
     Checks if a given mass balance is plausible.
+    :param main_model: The MFA system
+    :param n_sample_years: If given, only a random sample of this many years is checked, e.g. for large sweeps.
+    :param seed: Seed of the sample of years, cfg.mass_balance_check_seed is used if None.
     :return: True if the mass balance for all processes is below 1t of steel, False otherwise.
     """
+    if n_sample_years is None:
+        n_sample_years = cfg.n_mass_balance_check_years
+    if seed is None:
+        seed = cfg.mass_balance_check_seed
+    balance_by_cell, time_idx = main_model.calc_mass_balance(n_sample_years=n_sample_years, seed=seed)
 
-    fabrication_use = main_model.get_flowV(FABR_PID, USE_PID)[:, 0]
-    indirect_imports = main_model.get_flowV(ENV_PID, USE_PID)[:, 0]
-    indirect_exports = main_model.get_flowV(USE_PID, ENV_PID)[:, 0]
-    use_disnotcol = np.sum(main_model.get_flowV(USE_PID, DISNOTCOL_PID)[:, 0], axis=-2)
-    use_scrap = np.sum(main_model.get_flowV(USE_PID, SCRAP_PID)[:, 0], axis=-2)
-    stock_change = main_model.get_stock_changeV(USE_PID)[:, 0]
-    inflows = fabrication_use + indirect_imports - indirect_exports
-    outflows = use_disnotcol + use_scrap
-    stock_change2 = inflows - outflows
-
-    balance = main_model.MassBalance()
-
-    balance = np.abs(np.sum(balance, axis=(0, 2)))
+    balance = np.abs(np.sum(balance_by_cell.reshape(balance_by_cell.shape[0], -1), axis=1))
     error = balance > 1
     if np.any(error):
         error_message = f"Error in mass balance of model\n"
@@ -408,6 +557,9 @@ def mass_balance_plausible(main_model):
             if error_occured:
                 error_message += f"\nError in process {idx} '{main_model.ProcessList[idx].Name}': {balance[idx]}"
         error_message += f"\n\nBalance summary: {balance}"
+        error_message += f"\n\nWorst cells:"
+        for cell in main_model.get_worst_mass_balance_cells(balance_by_cell, time_idx):
+            error_message += f"\n{cell}"
         raise RuntimeError(error_message)
     else:
         return f"Success - Model loaded and checked. \nBalance: {balance}.\n"
@@ -0,0 +1,199 @@
+import functools
+import numpy as np
+from src.tools.config import cfg
+from src.tools.pipeline import Pipeline, PipelineStage
+from src.tools.cache_fingerprint import STOCK_CONFIG_ATTRIBUTES, BASE_MODEL_CONFIG_ATTRIBUTES, \
+    STEEL_PRICE_CONFIG_ATTRIBUTES, ECON_CONFIG_ATTRIBUTES, MODEL_DSMS_CONFIG_ATTRIBUTES
+from src.base_model.load_dsms import load_dsms, dsms_are_stored
+from src.base_model.simson_base_model import create_model
+from src.base_model.country_model import load_country_model
+from src.calc_trade.calc_trade import get_net_trade_1970_2021
+from src.calc_trade.calc_scrap_trade import get_net_scrap_trade_1971_2022
+from src.calc_trade.calc_indirect_trade import get_net_indirect_trade_2001_2019
+from src.economic_model.econ_model_tools import get_steel_prices, get_base_scrap_price
+from src.economic_model.load_econ_dsms import calc_econ_dsms
+from src.economic_model.simson_econ_model import calc_scrap_share
+from src.modelling_approaches.load_model_dsms import load_model_dsms
+from src.predict.calc_steel_stocks import get_np_steel_stocks_with_prediction, SCENARIO_STRATEGIES
+
+# The SIMSON model as a dependency graph of stages. Stages only run again if a config attribute they depend on, the
+# input data or one of their inputs changed, e.g. changing only an elasticity of the economic model in a sweep reruns
+# the scrap share and economic model stages, but reuses the DSMs and steel prices. Independent stages run in
+# parallel: the stock predictions of the scenarios, the crude, indirect and scrap trade data, the steel prices and,
+# with modelling approaches, the DSMs of the model type. Stage outputs are shared between runs and must not be
+# changed. With do_calc_country_model, the country level model is calculated alongside and saved to its own store,
+# see country_model.
+
+_simson_pipelines = {}  # stock prediction stage names -> pipeline
+
+_MODEL_INPUTS = ['country_specific', 'crude_trade_data', 'indirect_trade_data', 'scrap_trade_data',
+                 'past_model_dsms', 'future_model_dsms']
+
+
+def get_simson_pipeline():
+    # the stock prediction stages depend on the scenarios and the curve strategy, see _get_stock_stage_names
+    stock_stage_names = tuple(_get_stock_stage_names())
+    if stock_stage_names not in _simson_pipelines:
+        _simson_pipelines[stock_stage_names] = Pipeline(_get_stages(stock_stage_names))
+    return _simson_pipelines[stock_stage_names]
+
+
+def run_simson_pipeline(country_specific=False, do_model_economy=None):
+    """
+    Calculates the base or economic SIMSON model with the current config, reusing the results of all stages that are
+    not affected by changes of the config since the last run.
+
+    :param country_specific:
+    :param do_model_economy: Whether to calculate the economic model, cfg.do_model_economy is used if None.
+    :return: SimDiGraph_MFAsystem
+    """
+    if do_model_economy is None:
+        do_model_economy = cfg.do_model_economy
+    target = 'econ_model' if do_model_economy else 'base_model'
+    targets = [target, 'country_model'] if cfg.do_calc_country_model else [target]
+    pipeline = get_simson_pipeline()
+    results = pipeline.run(targets, country_specific=country_specific)
+    pipeline.print_timings()
+    return results[target]
+
+
+def _get_stages(stock_stage_names):
+    price_config_attributes = ['start_year', 'end_year', 'scenarios'] + STEEL_PRICE_CONFIG_ATTRIBUTES
+    model_dsms_config_attributes = MODEL_DSMS_CONFIG_ATTRIBUTES + ['do_model_approaches', 'model_type']
+    stock_stages = [PipelineStage(name, functools.partial(_predict_stocks, scenario_idx=scenario_idx),
+                                  inputs=['country_specific'], config_attributes=STOCK_CONFIG_ATTRIBUTES)
+                    for scenario_idx, name in _enumerate_scenarios(stock_stage_names)]
+    return stock_stages + \
+        [PipelineStage('dsms', _load_dsms, inputs=['country_specific'] + list(stock_stage_names),
+                       config_attributes=STOCK_CONFIG_ATTRIBUTES),
+         PipelineStage('crude_trade_data', get_net_trade_1970_2021, inputs=['country_specific'],
+                       config_attributes=['region_data_source', 'production_data_source', 'use_data_source']),
+         PipelineStage('indirect_trade_data', get_net_indirect_trade_2001_2019, inputs=['country_specific'],
+                       config_attributes=['region_data_source', 'indirect_trade_source']),
+         PipelineStage('scrap_trade_data', get_net_scrap_trade_1971_2022, inputs=['country_specific'],
+                       config_attributes=['region_data_source', 'scrap_trade_data_source']),
+         PipelineStage('past_model_dsms', _load_past_model_dsms, inputs=['country_specific'],
+                       config_attributes=model_dsms_config_attributes),
+         PipelineStage('future_model_dsms', _load_future_model_dsms, inputs=['country_specific', 'past_model_dsms'],
+                       config_attributes=model_dsms_config_attributes),
+         PipelineStage('base_model', _create_model, inputs=_MODEL_INPUTS + ['dsms'],
+                       config_attributes=BASE_MODEL_CONFIG_ATTRIBUTES),
+         PipelineStage('steel_prices', _load_steel_prices, outputs=['p_steel', 'p_0_scrap'],
+                       config_attributes=price_config_attributes),
+         PipelineStage('econ_dsms', _calc_econ_dsms, inputs=['dsms', 'p_steel'],
+                       config_attributes=['elasticity_steel']),
+         PipelineStage('scrap_share', _calc_scrap_share, inputs=_MODEL_INPUTS + ['econ_dsms', 'p_steel', 'p_0_scrap'],
+                       config_attributes=BASE_MODEL_CONFIG_ATTRIBUTES + ECON_CONFIG_ATTRIBUTES),
+         PipelineStage('econ_model', _create_econ_model, inputs=_MODEL_INPUTS + ['econ_dsms', 'scrap_share'],
+                       config_attributes=BASE_MODEL_CONFIG_ATTRIBUTES),
+         PipelineStage('country_model', _load_country_model,
+                       config_attributes=BASE_MODEL_CONFIG_ATTRIBUTES + ['n_countries_per_chunk'])]
+
+
+def _get_stock_stage_names():
+    """
+    The stocks of every scenario are predicted in their own stage if the curve strategy predicts the scenarios
+    independently, all scenarios are predicted in one stage otherwise.
+    """
+    if cfg.include_gdp_and_pop_scenarios_in_prediction and cfg.curve_strategy in SCENARIO_STRATEGIES:
+        return [f'stocks_{scenario}' for scenario in cfg.scenarios]
+    return ['stocks']
+
+
+def _enumerate_scenarios(stock_stage_names):
+    if len(stock_stage_names) == 1:
+        return [(None, stock_stage_names[0])]
+    return enumerate(stock_stage_names)
+
+
+def _predict_stocks(country_specific, scenario_idx):
+    # the stocks are only needed to calculate the DSMs, the prediction is skipped if they are stored
+    if dsms_are_stored(country_specific):
+        return None
+    return get_np_steel_stocks_with_prediction(country_specific, scenario_idx=scenario_idx)
+
+
+def _load_dsms(country_specific, **stocks_by_stage):
+    # stored DSMs are only reused if they were calculated with the current config, see cache_fingerprint
+    stocks = list(stocks_by_stage.values())  # in the order of the stage inputs, i.e. of the scenarios
+    if any(scenario_stocks is None for scenario_stocks in stocks):
+        stocks = None  # the DSMs were stored when the stocks were predicted, or they are predicted by load_dsms
+    elif len(stocks) == 1:
+        stocks = stocks[0]
+    else:
+        stocks = np.stack(stocks, axis=-1)
+    return load_dsms(country_specific, recalculate=False, stocks=stocks)
+
+
+def _load_past_model_dsms(country_specific):
+    # the DSMs of the model type are only used with modelling approaches, see simson_base_model.calc_flows
+    if not cfg.do_model_approaches:
+        return None
+    return load_model_dsms(country_specific, do_past_not_future=True, do_econ_model=False, recalculate=False)
+
+
+def _load_future_model_dsms(country_specific, past_model_dsms):
+    if not cfg.do_model_approaches:
+        return None
+    return load_model_dsms(country_specific, do_past_not_future=False, do_econ_model=False, recalculate=False,
+                           past_dsms=past_model_dsms)
+
+
+def _create_model(country_specific, crude_trade_data, indirect_trade_data, scrap_trade_data, past_model_dsms,
+                  future_model_dsms, dsms):
+    model, balance_message = create_model(country_specific, dsms,
+                                          trade_data=_get_trade_data(crude_trade_data, indirect_trade_data,
+                                                                     scrap_trade_data),
+                                          model_dsms=_get_model_dsms(past_model_dsms, future_model_dsms))
+    print(balance_message)
+    return model
+
+
+def _load_country_model():
+    # the results are stored by the fingerprint of the config, the stage returns the path of the store
+    return load_country_model(recalculate=False)
+
+
+def _load_steel_prices():
+    return get_steel_prices(), get_base_scrap_price()
+
+
+def _calc_econ_dsms(dsms, p_steel):
+    return calc_econ_dsms(dsms, p_steel, p_steel[0])
+
+
+def _calc_scrap_share(country_specific, crude_trade_data, indirect_trade_data, scrap_trade_data, past_model_dsms,
+                      future_model_dsms, econ_dsms, p_steel, p_0_scrap):
+    return calc_scrap_share(econ_dsms, country_specific, p_steel, p_0_scrap,
+                            trade_data=_get_trade_data(crude_trade_data, indirect_trade_data, scrap_trade_data),
+                            model_dsms=_get_model_dsms(past_model_dsms, future_model_dsms))
+
+
+def _create_econ_model(country_specific, crude_trade_data, indirect_trade_data, scrap_trade_data, past_model_dsms,
+                       future_model_dsms, econ_dsms, scrap_share):
+    model, balance_message = create_model(country_specific, econ_dsms, scrap_share_in_production=scrap_share,
+                                          trade_data=_get_trade_data(crude_trade_data, indirect_trade_data,
+                                                                     scrap_trade_data),
+                                          model_dsms=_get_model_dsms(past_model_dsms, future_model_dsms))
+    print(balance_message)
+    return model
+
+
+def _get_trade_data(crude_trade_data, indirect_trade_data, scrap_trade_data):
+    return {'crude': crude_trade_data, 'indirect': indirect_trade_data, 'scrap': scrap_trade_data}
+
+
+def _get_model_dsms(past_model_dsms, future_model_dsms):
+    if past_model_dsms is None:
+        return None
+    return past_model_dsms, future_model_dsms
+
+
+def _test():
+    run_simson_pipeline(do_model_economy=True)
+    cfg.elasticity_dissassembly *= 1.1
+    run_simson_pipeline(do_model_economy=True)
+
+
+if __name__ == '__main__':
+    _test()
@@ -1,12 +1,16 @@
 import numpy as np
 from src.calc_trade.calc_trade_tools import get_trade_category_percentages, scale_trade, \
-    expand_trade_to_past_and_future, get_imports_and_exports_from_net_trade, get_trade_test_data, visualize_trade
-from src.tools.tools import get_np_from_df
+    expand_trade_to_past_and_future, get_imports_and_exports_from_net_trade, get_trade_test_data, visualize_trade, \
+    get_np_trade_data
 from src.read_data.load_data import load_indirect_trade_2001_2019, load_indirect_trade_category_quantities
 
 
-def get_indirect_trade(country_specific, scaler, inflows, outflows, split_categories_by_real_data=True):
-    net_indirect_trade_2001_2019 = _get_net_indirect_trade_2001_2019(country_specific)
+def get_indirect_trade(country_specific, scaler, inflows, outflows, split_categories_by_real_data=True,
+                       countries=None, net_indirect_trade_2001_2019=None):
+    # countries: if country specific, the countries of the scaler, see calc_trade.get_trade
+    # the net indirect trade data is loaded if it is not given, see get_net_indirect_trade_2001_2019
+    if net_indirect_trade_2001_2019 is None:
+        net_indirect_trade_2001_2019 = get_net_indirect_trade_2001_2019(country_specific, countries)
     net_indirect_trade = expand_trade_to_past_and_future(net_indirect_trade_2001_2019,
                                                          scaler=scaler,
                                                          first_available_year=2001,
@@ -17,13 +21,14 @@ def get_indirect_trade(country_specific, scaler, inflows, outflows, split_catego
                                                                                    country_specific,
                                                                                    indirect_imports,
                                                                                    indirect_exports,
-                                                                                   inflows, outflows)
+                                                                                   inflows, outflows,
+                                                                                   countries=countries)
     return indirect_imports, indirect_exports
 
 
 def get_scaled_past_indirect_trade(country_specific, scaler, split_categories_by_real_data=True):
     scaler = scaler[:102]  # only use scaler up to 2001
-    net_indirect_trade_2001_2019 = _get_net_indirect_trade_2001_2019(country_specific)
+    net_indirect_trade_2001_2019 = get_net_indirect_trade_2001_2019(country_specific)
     net_indirect_trade_1900_2000 = scale_trade(trade=net_indirect_trade_2001_2019,
                                                scaler=scaler,
                                                do_past_not_future=True)
@@ -42,10 +47,10 @@ def get_scaled_past_indirect_trade(country_specific, scaler, split_categories_by
     return net_indirect_trade
 
 
-def _get_net_indirect_trade_2001_2019(country_specific):
+def get_net_indirect_trade_2001_2019(country_specific, countries=None):
     df_indirect_imports, df_indirect_exports = load_indirect_trade_2001_2019(country_specific=country_specific)
-    indirect_imports = get_np_from_df(df_indirect_imports, data_split_into_categories=False)
-    indirect_exports = get_np_from_df(df_indirect_exports, data_split_into_categories=False)
+    indirect_imports = get_np_trade_data(df_indirect_imports, countries)
+    indirect_exports = get_np_trade_data(df_indirect_exports, countries)
 
     net_indirect_trade = indirect_imports - indirect_exports
     net_indirect_trade = net_indirect_trade.transpose()
@@ -55,7 +60,7 @@ def _get_net_indirect_trade_2001_2019(country_specific):
 
 def _split_indirect_trade_into_use_categories(split_categories_by_real_data, country_specific,
                                               indirect_imports, indirect_exports,
-                                              inflows=None, outflows=None, do_scenarios=True):
+                                              inflows=None, outflows=None, do_scenarios=True, countries=None):
     if not split_categories_by_real_data and (inflows is None or outflows is None):
         raise RuntimeWarning('With no inflows and outflows given, '
                              'indirect trade can not be split by real category data.')
@@ -64,7 +69,7 @@ def _split_indirect_trade_into_use_categories(split_categories_by_real_data, cou
         df_shares = load_indirect_trade_category_quantities(country_specific=country_specific)
         df_shares = df_shares.divide(df_shares.sum(axis=1), axis=0)
         df_shares['Construction'] = 0  # to not allow negative zeros, not necessary but more elegant
-        shares = get_np_from_df(df_shares, data_split_into_categories=False)
+        shares = get_np_trade_data(df_shares, countries)
         scenario_dim = ''
         if do_scenarios:
             scenario_dim = 's'
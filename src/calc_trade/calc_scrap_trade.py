@@ -5,8 +5,10 @@ from src.tools.tools import get_np_from_df
 from src.read_data.load_data import load_scrap_trade_1971_2022
 
 
-def get_scrap_trade(country_specific, scaler, available_scrap_by_category):
-    scrap_trade_1971_2022 = _get_net_scrap_trade_1971_2022(country_specific)
+def get_scrap_trade(country_specific, scaler, available_scrap_by_category, scrap_trade_1971_2022=None):
+    # the net scrap trade data is loaded if it is not given, see get_net_scrap_trade_1971_2022
+    if scrap_trade_1971_2022 is None:
+        scrap_trade_1971_2022 = get_net_scrap_trade_1971_2022(country_specific)
     net_scrap_trade = expand_trade_to_past_and_future(scrap_trade_1971_2022,
                                                       scaler=scaler,
                                                       first_available_year=1971,
@@ -20,7 +22,7 @@ def get_scrap_trade(country_specific, scaler, available_scrap_by_category):
     return scrap_imports, scrap_exports
 
 
-def _get_net_scrap_trade_1971_2022(country_specific):
+def get_net_scrap_trade_1971_2022(country_specific):
     df_scrap_imports, df_scrap_exports = load_scrap_trade_1971_2022(country_specific=country_specific)
     scrap_imports = get_np_from_df(df_scrap_imports, data_split_into_categories=False)
     scrap_exports = get_np_from_df(df_scrap_exports, data_split_into_categories=False)
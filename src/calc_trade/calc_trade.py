@@ -1,12 +1,23 @@
 import numpy as np
 from src.read_data.load_data import load_production, load_use_1970_2021
-from src.tools.tools import get_np_from_df
 from src.calc_trade.calc_trade_tools import expand_trade_to_past_and_future, get_imports_and_exports_from_net_trade, \
-    get_trade_test_data, visualize_trade, scale_trade
-
-
-def get_trade(country_specific, scaler):
-    net_trade_1970_2021 = _get_net_trade_1970_2021(country_specific)
+    get_trade_test_data, visualize_trade, scale_trade, get_np_trade_data
+
+
+def get_trade(country_specific, scaler, countries=None, net_trade_1970_2021=None):
+    """
+    Calculates imports and exports (t,r,s) from the net trade of 1970 to 2021, scaled with the scaler in the other
+    years.
+
+    :param country_specific:
+    :param scaler: Scaler (t,r,s), e.g. the total demand.
+    :param countries: If country specific, the countries of the scaler, trade is selected by their country code. All
+    countries of the trade data are used if None.
+    :param net_trade_1970_2021: Net trade of the areas of the scaler, see get_net_trade_1970_2021. Loaded if None.
+    :return:
+    """
+    if net_trade_1970_2021 is None:
+        net_trade_1970_2021 = get_net_trade_1970_2021(country_specific, countries)
     net_trade = expand_trade_to_past_and_future(net_trade_1970_2021,
                                                 scaler=scaler,
                                                 first_available_year=1970,
@@ -19,7 +30,7 @@ def get_trade(country_specific, scaler):
 
 def get_scaled_past_trade(country_specific, scaler):
     scaler = scaler[:71]  # only use scaler up to 1970
-    net_trade_1970_2021 = _get_net_trade_1970_2021(country_specific)
+    net_trade_1970_2021 = get_net_trade_1970_2021(country_specific)
     net_trade_1900_1969 = scale_trade(trade=net_trade_1970_2021,
                                       scaler=scaler,
                                       do_past_not_future=True)
@@ -28,12 +39,12 @@ def get_scaled_past_trade(country_specific, scaler):
     return trade
 
 
-def _get_net_trade_1970_2021(country_specific):
+def get_net_trade_1970_2021(country_specific, countries=None):
     df_use = load_use_1970_2021(country_specific=country_specific)
     df_production = load_production(country_specific=country_specific)
 
-    use_1970_2021 = get_np_from_df(df_use, data_split_into_categories=False)
-    production_1900_2022 = get_np_from_df(df_production, data_split_into_categories=False)
+    use_1970_2021 = get_np_trade_data(df_use, countries)
+    production_1900_2022 = get_np_trade_data(df_production, countries)
     production_1970_2021 = production_1900_2022[:, 70:122]
 
     net_trade_1970_2021 = use_1970_2021 - production_1970_2021
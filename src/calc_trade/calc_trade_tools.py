@@ -2,6 +2,24 @@ import numpy as np
 from src.tools.config import cfg
 from matplotlib import pyplot as plt
 from src.read_data.load_data import load_region_names_list
+from src.tools.tools import get_np_from_df
+
+
+def get_np_trade_data(df, countries=None):
+    """
+    Converts trade data of all areas (r,...) to numpy like get_np_from_df.
+
+    :param df: Trade data with the areas as (first) index.
+    :param countries: If given, only these countries are selected by their country code and in their order, e.g. to
+    match the countries of the stock data.
+    :return:
+    """
+    if countries is None:
+        return get_np_from_df(df, data_split_into_categories=False)
+    missing_countries = sorted(set(countries) - set(df.index.unique(level=0)))
+    if missing_countries:
+        raise RuntimeError(f'Trade data is missing for the countries {missing_countries} of the stock data.')
+    return df.loc[countries].to_numpy()
 
 
 def get_trade_category_percentages(trade_data, category_axis):
@@ -88,8 +106,7 @@ def get_trade_test_data(country_specific):
     bof_production = model.FlowDict['F_' + str(BOF_PID) + '_' + str(FORM_PID)].Values[:, 0]
     eaf_production = model.FlowDict['F_' + str(EAF_PID) + '_' + str(FORM_PID)].Values[:, 0]
     production = bof_production + eaf_production
-    available_scrap_by_category = np.sum(model.FlowDict['F_' + str(USE_PID) + '_' + str(SCRAP_PID)].Values[:, 0],
-                                         axis=2)
+    available_scrap_by_category = model.get_flow_sum(USE_PID, SCRAP_PID, 't,e,r,w,s')[:, 0]
 
     return production, demand, available_scrap_by_category
 
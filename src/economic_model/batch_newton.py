@@ -0,0 +1,84 @@
+import numpy as np
+
+
+def solve_batch_newton(f, f_prime, x_0, x_lower, x_upper, tol=1.48e-08, max_iter=50):
+    """
+    Finds the roots of a monotonically increasing function in every cell of an array with a safeguarded
+    Newton method: each cell keeps a bracket [x_lower, x_upper] around its root, and Newton steps that leave
+    the bracket are replaced by bisection steps. Only cells that have not converged yet are evaluated.
+
+    :param f: Function f(x, active) returning the function values at x of the cells in the boolean mask 'active'.
+    :param f_prime: Function f_prime(x, active) returning the derivatives in the same way.
+    :param x_0: Initial guesses, need to lie within the brackets.
+    :param x_lower: Lower bracket of the roots, f needs to be non-positive here.
+    :param x_upper: Upper bracket of the roots, f needs to be non-negative here.
+    :param tol: A cell has converged when its step size is below this tolerance.
+    :param max_iter: Maximum number of iterations.
+    :return: Roots, number of iterations per cell and residuals (function values at the roots).
+    """
+    x = np.array(x_0, dtype='float64')
+    lower = np.array(np.broadcast_to(x_lower, x.shape), dtype='float64')
+    upper = np.array(np.broadcast_to(x_upper, x.shape), dtype='float64')
+    n_iterations = np.zeros(x.shape, dtype=int)
+    active = np.ones(x.shape, dtype=bool)
+    residuals = np.zeros_like(x)
+    residuals[active] = f(x[active], active)
+    active[residuals == 0] = False
+
+    for _ in range(max_iter):
+        if not np.any(active):
+            break
+        x_active = x[active]
+        residuals_active = residuals[active]
+        lower_active = np.where(residuals_active < 0, x_active, lower[active])
+        upper_active = np.where(residuals_active > 0, x_active, upper[active])
+
+        x_new = x_active - residuals_active / f_prime(x_active, active)
+        # a step below the floating point resolution lands on the bracket bound, it must not start a bisection
+        is_outside_bracket = ~((x_new >= lower_active) & (x_new <= upper_active))  # also catches nan values
+        x_new[is_outside_bracket] = (lower_active[is_outside_bracket] + upper_active[is_outside_bracket]) / 2
+
+        x[active] = x_new
+        lower[active] = lower_active
+        upper[active] = upper_active
+        n_iterations[active] += 1
+        residuals[active] = f(x_new, active)
+        is_converged = (np.abs(x_new - x_active) < tol) | (residuals[active] == 0)
+        active[active] = ~is_converged
+
+    if np.any(active):
+        raise RuntimeError(f'\nNewton solver did not converge for {np.sum(active)} cells within {max_iter} '
+                           f'iterations. Maximum residual: {np.max(np.abs(residuals[active]))}')
+
+    return x, n_iterations, residuals
+
+
+def _test(n_cells=1000, tolerance=1e-9):
+    """
+    Compares the roots of a monotonically increasing function per cell to scipy's Newton method, which the economic
+    model used before.
+    """
+    from scipy.optimize import newton
+
+    rng = np.random.default_rng(0)
+    a = rng.uniform(0.1, 100, n_cells)
+    b = rng.uniform(0.5, 5, n_cells)
+
+    def f(x, active):
+        return x ** 3 + b[active] * x - a[active]
+
+    def f_prime(x, active):
+        return 3 * x ** 2 + b[active]
+
+    roots, n_iterations, residuals = solve_batch_newton(f, f_prime, np.zeros(n_cells), 0, a / b)
+    reference_roots = np.array([newton(lambda x: x ** 3 + b_cell * x - a_cell, 0., fprime=lambda x: 3 * x ** 2 + b_cell)
+                                for a_cell, b_cell in zip(a, b)])
+    max_difference = np.max(np.abs(roots - reference_roots))
+    print(f'Maximum difference of the roots to scipy.optimize.newton: {max_difference:.2e}, '
+          f'maximum number of iterations: {np.max(n_iterations)}, maximum residual: {np.max(np.abs(residuals)):.2e}')
+    if max_difference > tolerance:
+        raise RuntimeError(f'The batch Newton roots differ from scipy.optimize.newton by {max_difference}.')
+
+
+if __name__ == '__main__':
+    _test()
@@ -1,29 +1,29 @@
-from ODYM.odym.modules import dynamic_stock_model as dsm
+import numpy as np
+from src.odym_extension.Batch_DynamicStockModel import Batch_DynamicStockModel
 from src.base_model.load_dsms import load_dsms
 from src.tools.config import cfg
 
 
 def load_econ_dsms(country_specific, p_st, p_0_st, recalculate):
     dsms = load_dsms(country_specific, recalculate)
+    return calc_econ_dsms(dsms, p_st, p_0_st)
+
+
+def calc_econ_dsms(dsms, p_st, p_0_st):
+    """
+    Adapts the future inflows of the base DSMs to the steel price with the steel price elasticity and recalculates
+    stocks and outflows. The base DSMs are not changed.
+    """
     factor = (p_st / p_0_st) ** cfg.elasticity_steel
-    for region_dsms in dsms:
-        for category_dsms in region_dsms:
-            for scenario_idx, scenario_dsm in enumerate(category_dsms):
-                scenario_dsm.i[cfg.econ_base_year - cfg.start_year + 1:] *= factor[:, scenario_idx]
-                new_scenarion_dsm = dsm.DynamicStockModel(t=scenario_dsm.t,
-                                                          i=scenario_dsm.i,
-                                                          lt=scenario_dsm.lt)
-                new_scenarion_dsm.compute_s_c_inflow_driven()
-                new_scenarion_dsm.compute_o_c_from_s_c()
-                new_scenarion_dsm.compute_stock_total()
-                new_scenarion_dsm.compute_outflow_total()
-                new_scenarion_dsm.compute_stock_change()
-                scenario_dsm.i = new_scenarion_dsm.i
-                scenario_dsm.o = new_scenarion_dsm.o
-                scenario_dsm.o_c = new_scenarion_dsm.o_c
-                scenario_dsm.s = new_scenarion_dsm.s
-                scenario_dsm.s_c = new_scenarion_dsm.s_c
-    return dsms
+    factor = np.expand_dims(factor, axis=(1, 2))  # copy across regions and in-use categories
+    inflows = dsms.i.copy()
+    inflows[cfg.econ_start_index:] *= factor
+    econ_dsms = Batch_DynamicStockModel(t=dsms.t,
+                                        i=inflows,
+                                        lt=dsms.lt,
+                                        sf=dsms.sf)
+    econ_dsms.compute_all_inflow_driven()
+    return econ_dsms
 
 
 def _test():
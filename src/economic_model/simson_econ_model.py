@@ -1,35 +1,39 @@
 import os
-import pickle
-from scipy.optimize import newton
 import numpy as np
-from src.odym_extension.SimDiGraph_MFAsystem import SimDiGraph_MFAsystem
-from src.base_model.simson_base_model import create_model, ENV_PID, BOF_PID, EAF_PID, FORM_PID, FABR_PID, RECYCLE_PID, \
-    USE_PID, SCRAP_PID
+from src.odym_extension.SimDiGraph_MFAsystem import SimDiGraph_MFAsystem, save_mfa_system_values
+from src.base_model.simson_base_model import create_model, create_model_flows, load_model_from_store, \
+    get_model_fingerprint, ENV_PID, BOF_PID, EAF_PID, FORM_PID, FABR_PID, RECYCLE_PID, USE_PID, SCRAP_PID
 from src.tools.config import cfg
+from src.tools.array_store import array_store_exists
 from src.economic_model.econ_model_tools import get_steel_prices, get_base_scrap_price
 from src.economic_model.load_econ_dsms import load_econ_dsms
+from src.economic_model.batch_newton import solve_batch_newton
 
 
 def load_simson_econ_model(recalculate=False, recalculate_dsms=False, country_specific=False) -> SimDiGraph_MFAsystem:
-    file_name_end = 'countries' if country_specific else f'{cfg.region_data_source}_regions'
-    file_name = f'main_economic_model_{file_name_end}.p'
-    file_path = os.path.join(cfg.data_path, 'models', file_name)
-    do_load_existing = os.path.exists(file_path) and not recalculate
+    store_path = get_econ_model_store_path(country_specific)
+    fingerprint = get_model_fingerprint(do_econ_model=True)
+    do_load_existing = array_store_exists(store_path, fingerprint) and not recalculate
     if do_load_existing:
-        model = pickle.load(open(file_path, "rb"))
+        model = load_model_from_store(store_path, country_specific)
     else:
         model = create_economic_model(country_specific, recalculate_dsms)
-        pickle.dump(model, open(file_path, "wb"))
+        save_mfa_system_values(model, store_path, fingerprint)
     return model
 
 
+def get_econ_model_store_path(country_specific):
+    store_name_end = 'countries' if country_specific else f'{cfg.region_data_source}_regions'
+    return os.path.join(cfg.data_path, 'models', f'main_economic_model_{store_name_end}')
+
+
 def create_economic_model(country_specific, recalculate_dsms):
     #  load data
     p_steel = get_steel_prices()
     p_0_scrap = get_base_scrap_price()
     dsms = load_econ_dsms(country_specific=country_specific, p_st=p_steel, p_0_st=p_steel[0],
                           recalculate=recalculate_dsms)
-    scrap_share = _calc_scrap_share(dsms, country_specific, p_steel, p_0_scrap)
+    scrap_share = calc_scrap_share(dsms, country_specific, p_steel, p_0_scrap)
     econ_model, balance_message = create_model(country_specific=country_specific,
                                                dsms=dsms,
                                                scrap_share_in_production=scrap_share)
@@ -37,15 +41,18 @@ def create_economic_model(country_specific, recalculate_dsms):
     return econ_model
 
 
-def _calc_scrap_share(dsms, country_specific, p_steel, p_0_scrap):
-    interim_model, balance_message = create_model(country_specific=country_specific, dsms=dsms)
-    q_st = _calc_q_st(interim_model)
-    q_eol = _calc_q_eol(interim_model)
+def calc_scrap_share(dsms, country_specific, p_steel, p_0_scrap, trade_data=None, model_dsms=None):
+    # only the flows of the interim model are needed, hence it is not built as a full MFA system
+    # trade_data and model_dsms: see simson_base_model.create_model
+    interim_flows = create_model_flows(country_specific=country_specific, dsms=dsms, trade_data=trade_data,
+                                       model_dsms=model_dsms)
+    q_st = _calc_q_st(interim_flows)
+    q_eol = _calc_q_eol(interim_flows)
     p_0_steel = p_steel[0]
     p_0_diss = p_0_steel - p_0_scrap - cfg.exog_eaf_USD98
     e_recov = cfg.elasticity_scrap_recovery_rate
     e_diss = cfg.elasticity_dissassembly
-    q_0_st, q_0_sest, s_0_se, r_0_recov = get_initial_values(interim_model, q_eol)
+    q_0_st, q_0_sest, s_0_se, r_0_recov = get_initial_values(interim_flows, q_eol)
     a_scrap = _get_a_recov(r_0_recov)
     a_dis = _get_a_diss(s_0_se)
 
@@ -63,22 +70,28 @@ def _calc_scrap_share(dsms, country_specific, p_steel, p_0_scrap):
 
 
 def _solve_for_scrap_share(alpha, beta, gamma, q, e_recov, e_dis, x_upper_limit):
-    def f(x):
-        term_2 = beta * (1 - q * x) ** (1 / e_recov)
-        term_3 = gamma * (1 - x) ** (1 / e_dis)
-        return alpha + term_2 + term_3
-
-    def f_prime(x):
-        term_1 = beta * q * (1 / e_recov) * (1 - q * x) ** (1 / e_recov - 1)
-        term_2 = gamma * (1 / e_dis) * (1 - x) ** (1 / e_dis - 1)
+    alpha, beta, gamma, q, x_upper_limit = np.broadcast_arrays(alpha, beta, gamma, q, x_upper_limit)
+
+    def f(x, active):
+        term_2 = beta[active] * (1 - q[active] * x) ** (1 / e_recov)
+        term_3 = gamma[active] * (1 - x) ** (1 / e_dis)
+        return alpha[active] + term_2 + term_3
+
+    def f_prime(x, active):
+        term_1 = beta[active] * q[active] * (1 / e_recov) * (1 - q[active] * x) ** (1 / e_recov - 1)
+        term_2 = gamma[active] * (1 / e_dis) * (1 - x) ** (1 / e_dis - 1)
         result = - term_1 - term_2
         if not np.all(result > 0):
             raise RuntimeError('\nF_prime should be always positive in the chosen x intervall. \n'
                                'There has been an error.')
         return result
 
-    x_0 = _calc_x_0(f, x_upper_limit)
-    scrap_share = newton(f, x_0, fprime=f_prime)
+    all_cells = np.ones(alpha.shape, dtype=bool)
+    if np.any(f(np.zeros(np.sum(all_cells)), all_cells) > 0):
+        _raise_error_wrong_values('Final scrap share')  # root, i.e. the scrap share, would be negative
+    x_lower, x_0 = _calc_x_0(f, x_upper_limit)
+    # the solver raises an error for cells that do not converge
+    scrap_share, _, _ = solve_batch_newton(f, f_prime, x_0, x_lower, x_0)
 
     if np.any(scrap_share < 0) or np.any(scrap_share > 1):
         _raise_error_wrong_values('Final scrap share')
@@ -86,16 +99,24 @@ def _solve_for_scrap_share(alpha, beta, gamma, q, e_recov, e_dis, x_upper_limit)
     return scrap_share
 
 
-def _calc_x_0(f, x_upper_limit):
+def _calc_x_0(f, x_upper_limit, max_iter=100):
+    """
+    Finds a bracket [x_lower, x_0] of the scrap share for every cell where f(x_lower) <= 0 <= f(x_0) by moving
+    x_0 half way towards the upper limit as long as f(x_0) is negative. Only those cells are evaluated again.
+    """
+    x_lower = np.zeros_like(x_upper_limit)
     factor = np.ones(x_upper_limit.shape) * 0.5
-    test = f(x_upper_limit * factor)
-    negative_check = test < 0
-    while np.any(negative_check):
-        factor[negative_check] += 1
-        factor[negative_check] /= 2
-        test = f(factor * x_upper_limit)
-        negative_check = test < 0
-    return factor * x_upper_limit
+    active = np.ones(x_upper_limit.shape, dtype=bool)
+    for _ in range(max_iter):
+        negative_check = f(factor[active] * x_upper_limit[active], active) < 0
+        x_lower[active] = np.where(negative_check, factor[active] * x_upper_limit[active], x_lower[active])
+        active[active] = negative_check
+        if not np.any(active):
+            return x_lower, factor * x_upper_limit
+        factor[active] += 1
+        factor[active] /= 2
+    raise RuntimeError(f'\nNo initial scrap share with a positive function value could be found for '
+                       f'{np.sum(active)} cells.')
 
 
 def _calc_alpha(p_steel, p_0_scrap, p_0_diss, a_scrap, a_dis):
@@ -121,12 +142,12 @@ def _calc_beta_gamma(p_0, a, values_0, e_values):
     return result
 
 
-def get_initial_values(interim_model, q_eol):
-    q_0_bof = interim_model.get_flowV(BOF_PID, FORM_PID)[cfg.econ_start_index:, 0]
-    q_0_eaf = interim_model.get_flowV(EAF_PID, FORM_PID)[cfg.econ_start_index:, 0]
+def get_initial_values(interim_flows, q_eol):
+    q_0_bof = interim_flows[(BOF_PID, FORM_PID)][cfg.econ_start_index:]
+    q_0_eaf = interim_flows[(EAF_PID, FORM_PID)][cfg.econ_start_index:]
     q_0_st = q_0_bof + q_0_eaf
 
-    q_0_sest = interim_model.get_flowV(SCRAP_PID, RECYCLE_PID)[cfg.econ_start_index:, 0]
+    q_0_sest = interim_flows[(SCRAP_PID, RECYCLE_PID)][cfg.econ_start_index:]
     s_0_se = q_0_sest / q_0_st
     r_0_recov = q_0_sest / q_eol
 
@@ -184,24 +205,24 @@ def _calc_x_upper_limit(q_st, q_eol):
     return x_upper_limit
 
 
-def _calc_q_st(interim_model):
-    q_st = interim_model.get_flowV(FABR_PID, USE_PID)
-    q_st = q_st[cfg.econ_start_index:, 0]
+def _calc_q_st(interim_flows):
+    q_st = interim_flows[(FABR_PID, USE_PID)]
+    q_st = q_st[cfg.econ_start_index:]
     q_st = np.sum(q_st, axis=2)
     return q_st
 
 
-def _calc_q_eol(interim_model):
-    form_scrap_inflow = interim_model.get_flowV(FORM_PID, SCRAP_PID)
-    fabr_scrap_inflow = interim_model.get_flowV(FABR_PID, SCRAP_PID)
-    eol_scrap_inflow = interim_model.get_flowV(USE_PID, SCRAP_PID)
-    scrap_exports = interim_model.get_flowV(SCRAP_PID, ENV_PID)
-    scrap_imports = interim_model.get_flowV(ENV_PID, SCRAP_PID)
+def _calc_q_eol(interim_flows):
+    form_scrap_inflow = interim_flows[(FORM_PID, SCRAP_PID)]
+    fabr_scrap_inflow = interim_flows[(FABR_PID, SCRAP_PID)]
+    eol_scrap_inflow = interim_flows[(USE_PID, SCRAP_PID)]
+    scrap_exports = interim_flows[(SCRAP_PID, ENV_PID)]
+    scrap_imports = interim_flows[(ENV_PID, SCRAP_PID)]
 
-    scrap_inflow = np.sum(eol_scrap_inflow, axis=3) + form_scrap_inflow + fabr_scrap_inflow
+    scrap_inflow = np.sum(eol_scrap_inflow, axis=2) + form_scrap_inflow + fabr_scrap_inflow
     q_eol = scrap_inflow + scrap_imports - scrap_exports
-    q_eol = np.sum(q_eol, axis=3)
-    return q_eol[cfg.econ_start_index:, 0]
+    q_eol = np.sum(q_eol, axis=2)
+    return q_eol[cfg.econ_start_index:]
 
 
 def _test():
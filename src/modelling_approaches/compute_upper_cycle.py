@@ -8,7 +8,11 @@ from src.calc_trade.calc_trade_tools import scale_trade
 from src.base_model.load_params import get_cullen_fabrication_yield
 
 
-def compute_upper_cycle(model_type=cfg.model_type, country_specific=False):  # decide country_specific
+def compute_upper_cycle(model_type=None, country_specific=False, past_dsms=None, future_dsms=None):
+    # decide country_specific
+    # the past and future DSMs of the model type are loaded if None, see load_model_dsms
+    if model_type is None:
+        model_type = cfg.model_type
     if model_type == 'change':
         get_upper_cycle_function = get_change_driven_model_upper_cycle
     elif model_type == 'stock':
@@ -17,7 +21,7 @@ def compute_upper_cycle(model_type=cfg.model_type, country_specific=False):  # d
         get_upper_cycle_function = get_inflow_driven_model_upper_cycle
     past_production, past_trade, past_forming_fabrication, past_fabrication_use, past_indirect_trade, past_inflows, \
     past_stocks, past_outflows = \
-        get_upper_cycle_function(country_specific=country_specific)
+        get_upper_cycle_function(country_specific=country_specific, past_dsms=past_dsms)
 
     past_production = _add_scenario_dimension(past_production)
     past_trade = _add_scenario_dimension(past_trade)
@@ -28,10 +32,11 @@ def compute_upper_cycle(model_type=cfg.model_type, country_specific=False):  # d
     past_stocks = _add_scenario_dimension(past_stocks)
     past_outflows = _add_scenario_dimension(past_outflows)
 
-    future_dsms = load_model_dsms(country_specific=country_specific,
-                                  do_past_not_future=False,
-                                  model_type=model_type,
-                                  do_econ_model=False)
+    if future_dsms is None:
+        future_dsms = load_model_dsms(country_specific=country_specific,
+                                      do_past_not_future=False,
+                                      model_type=model_type,
+                                      do_econ_model=False)
 
     inflows, stocks, outflows = get_dsm_data(future_dsms)
 
@@ -63,7 +68,9 @@ def _add_scenario_dimension(data):
     return data
 
 
-def test(model_type=cfg.model_type):
+def test(model_type=None):
+    if model_type is None:
+        model_type = cfg.model_type
     production, trade, forming_fabrication, fabrication_use, indirect_trade, inflow, stocks, outflow = \
         compute_upper_cycle(model_type)
 
@@ -1,25 +1,26 @@
-from math import sqrt, pi, e
 import numpy as np
 from src.modelling_approaches.load_model_dsms import load_model_dsms, get_dsm_data
-from src.odym_extension.MultiDim_DynamicStockModel import MultiDim_DynamicStockModel
-from src.read_data.load_data import load_lifetimes, load_region_names_list
+from src.odym_extension.Batch_DynamicStockModel import Batch_DynamicStockModel
+from src.odym_extension.lifetime_kernels import get_lifetime_kernels
+from src.read_data.load_data import load_lifetimes
 from src.modelling_approaches.load_data_for_approaches import get_past_production_trade_forming_fabrication
 from src.base_model.load_params import get_cullen_fabrication_yield
 from src.modelling_approaches.load_region_sector_splits import get_region_sector_splits
 from src.tools.config import cfg
 
 
-def get_inflow_driven_model_upper_cycle(country_specific=False):
+def get_inflow_driven_model_upper_cycle(country_specific=False, past_dsms=None):
     production, trade, forming_fabrication, indirect_trade = \
         get_past_production_trade_forming_fabrication(country_specific)
 
-    past_dsms = load_model_dsms(country_specific=country_specific,
-                                do_past_not_future=True,
-                                model_type='inflow',
-                                do_econ_model=False,
-                                recalculate=True,
-                                forming_fabrication=forming_fabrication,
-                                indirect_trade=indirect_trade)
+    if past_dsms is None:
+        past_dsms = load_model_dsms(country_specific=country_specific,
+                                    do_past_not_future=True,
+                                    model_type='inflow',
+                                    do_econ_model=False,
+                                    recalculate=False,
+                                    forming_fabrication=forming_fabrication,
+                                    indirect_trade=indirect_trade)
     inflows, stocks, outflows = get_dsm_data(past_dsms)
     fabrication_use = inflows - indirect_trade
 
@@ -37,19 +38,20 @@ def get_inflow_driven_past_dsms(country_specific, fabrication=None, indirect_tra
     inflows = _calc_inflows_via_sector_splits(fabrication, indirect_trade, fabrication_yield, sector_splits,
                                               mean, std_dev)
 
-    inflows = np.moveaxis(inflows, 0, 2)  # move time axis to the end to iterate more easily through inflows
     years = np.arange(1900, 2009)
-    dsms = [[_create_inflow_driven_past_dsm(cat_inflows, years, mean[region_idx, cat_idx], std_dev[region_idx, cat_idx])
-             for cat_idx, cat_inflows in enumerate(region_inflows)]
-            for region_idx, region_inflows in enumerate(inflows)]
+    dsms = _create_inflow_driven_past_dsm(inflows, years, mean, std_dev)
 
     return dsms
 
 
 def _calc_inflows_via_sector_splits(fabrication, indirect_trade, fabrication_yield, sector_splits, mean, std_dev):
-    lifetime_matrix = _calc_lifetime_matrix(mean, std_dev)
-    l = np.einsum('trd,turg->turgd', sector_splits, 1 - lifetime_matrix)  # here 'u' denotes t_dash / t'
-    d_0_dividend = l[0, 0]
+    n_years = indirect_trade.shape[0]
+    # lifetimes are the same for all cohorts, hence the outflow share of a cohort only depends on its age
+    lifetime_pdf = _calc_lifetime_pdf_by_age(mean, std_dev, n_years)
+    lt = lifetime_pdf[0]  # outflow share of a cohort in its inflow year
+    y = fabrication_yield
+
+    d_0_dividend = np.einsum('rd,rg->rgd', sector_splits[0], 1 - lt)
     d_0 = np.einsum('rgd,rdg->rgd', d_0_dividend, 1 / d_0_dividend)
     initial_indirect_trade = np.repeat(np.expand_dims(indirect_trade[0], axis=2), cfg.n_use_categories, axis=2)
     b_0_dividend = initial_indirect_trade * d_0 - np.swapaxes(initial_indirect_trade, 1, 2)
@@ -65,17 +67,15 @@ def _calc_inflows_via_sector_splits(fabrication, indirect_trade, fabrication_yie
 
     inflows = np.zeros_like(indirect_trade)
     inflows[0] = i_0
-    fabrication_category_share = np.zeros_like(indirect_trade)
-    fabrication_category_share[0] = x_0
+    # outflows of all cohorts calculated so far in the current and all future years
+    future_outflows = np.zeros_like(indirect_trade)
+    _add_cohort_outflows(future_outflows, i_0, lifetime_pdf, 0)
 
-    for t in range(1, 109):
+    for t in range(1, n_years):
         f = fabrication[t]
-        s_prepare = np.einsum('trg,trg->trg', inflows[:t], lifetime_matrix[t, :t])
-        s_prepare = np.sum(s_prepare, axis=0)
+        s_prepare = future_outflows[t]
         c = sector_splits[t]
         it = indirect_trade[t]
-        lt = lifetime_matrix[t, t]
-        y = fabrication_yield
 
         m_1 = f * y[0] * (1 - lt[:, 0])
         m_2 = np.einsum('r,rg->rg', m_1, c)
@@ -96,51 +96,55 @@ def _calc_inflows_via_sector_splits(fabrication, indirect_trade, fabrication_yie
 
         min_x = np.einsum('rg,r,g->rg', -it, 1 / f, 1 / y)
         min_x = np.maximum(0, min_x)  # x should also never be zero
-        if np.any(x_t < min_x):
-            for region_idx in range(x_t.shape[0]):
-                xtr = x_t[region_idx]
-                minxr = min_x[region_idx]
-                if np.any(xtr < minxr):
-                    diff = xtr - minxr
-                    neg_pcts = np.minimum(0, diff)
-                    pos_pcts = np.maximum(0, diff)
-                    sum_factor = np.abs(np.sum(pos_pcts) / np.sum(neg_pcts))
-                    xtr = xtr - diff / sum_factor
-                    xtr[xtr < minxr] = minxr[xtr < minxr]
-                    x_t[region_idx] = xtr
-
-        fabrication_category_share[t] = x_t
+        x_t = _clip_x_to_min_x(x_t, min_x)
+
         inflows[t] = np.einsum('r,rg,g->rg', fabrication[t], x_t, fabrication_yield) + indirect_trade[t]
-    # fabrication_by_category = np.einsum('tr,trg->trg', fabrication, fabrication_category_share)
+        _add_cohort_outflows(future_outflows, inflows[t], lifetime_pdf, t)
 
     inflows[np.logical_and(inflows < 0,
                            inflows > -0.1)] = 0  # make inflows which are -0 or otherwise slightly negative positive 0
     return inflows
 
 
-def _calc_lifetime_matrix(mean, std_dev):
-    t = np.arange(0, 109)
-    t_dash = np.arange(0, 109)
-    t_matrix = np.subtract.outer(t, t_dash)
-    regions = load_region_names_list()
-    n_regions = len(regions)
-    new_t_matrix_shape = t_matrix.shape + (n_regions, cfg.n_use_categories)
-    t_matrix = np.broadcast_to(np.expand_dims(t_matrix, axis=(2, 3)), new_t_matrix_shape)
-    exponent = -(t_matrix - mean) ** 2 / (2 * std_dev ** 2)
-    lifetime_matrix = 1 / (sqrt(2) * pi * std_dev) * e ** exponent
-
-    # only use lower triangle of lifetime matrix as 'past' lifetimes of inflows are irrelevant
-    tri = np.tri(*lifetime_matrix.shape[:2])
-    lifetime_matrix = np.einsum('turg,tu->turg', lifetime_matrix, tri)
-
-    return lifetime_matrix
+def _clip_x_to_min_x(x_t, min_x):
+    """
+    Raises the category shares of all regions where a share is below its minimum. The difference is taken
+    proportionally from the shares above their minimum, so that the shares still add up to one.
+    """
+    is_below_min = np.any(x_t < min_x, axis=1)
+    if not np.any(is_below_min):
+        return x_t
+    x_t = x_t.copy()
+    xtr = x_t[is_below_min]
+    minxr = min_x[is_below_min]
+    diff = xtr - minxr
+    neg_pcts = np.minimum(0, diff)
+    pos_pcts = np.maximum(0, diff)
+    sum_factor = np.abs(np.sum(pos_pcts, axis=1) / np.sum(neg_pcts, axis=1))
+    xtr = xtr - diff / np.expand_dims(sum_factor, axis=1)
+    x_t[is_below_min] = np.maximum(xtr, minxr)
+    return x_t
+
+
+def _calc_lifetime_pdf_by_age(mean, std_dev, n_years):
+    lifetime_pdf = get_lifetime_kernels(mean, std_dev, n_years, kernel_type='pdf')
+    return np.moveaxis(lifetime_pdf, -1, 0)
+
+
+def _add_cohort_outflows(future_outflows, inflow_t, lifetime_pdf, t):
+    """
+    Adds the outflows of the cohort of year t to the running outflow sums of the years t until the last year,
+    so that the outflows of all past cohorts never have to be summed up again.
+    """
+    n_years = future_outflows.shape[0]
+    future_outflows[t:] += lifetime_pdf[:n_years - t] * inflow_t
 
 
 def _create_inflow_driven_past_dsm(inflows, years, lifetime_mean, lifetime_sd):
-    steel_stock_dsm = MultiDim_DynamicStockModel(t=years,
-                                                 i=inflows,
-                                                 lt={'Type': 'Normal', 'Mean': [lifetime_mean],
-                                                     'StdDev': [lifetime_sd]})
+    steel_stock_dsm = Batch_DynamicStockModel(t=years,
+                                              i=inflows,
+                                              lt={'Type': 'Normal', 'Mean': np.expand_dims(lifetime_mean, axis=0),
+                                                  'StdDev': np.expand_dims(lifetime_sd, axis=0)})
 
     steel_stock_dsm.compute_all_inflow_driven()
     return steel_stock_dsm
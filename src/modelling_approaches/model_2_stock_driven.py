@@ -7,11 +7,12 @@ from src.base_model.load_params import get_cullen_fabrication_yield
 from src.tools.config import cfg
 
 
-def get_stock_driven_model_upper_cycle(country_specific=False):
-    past_dsms = load_model_dsms(country_specific=country_specific,
-                                do_past_not_future=True,
-                                model_type='stock',
-                                do_econ_model=False)
+def get_stock_driven_model_upper_cycle(country_specific=False, past_dsms=None):
+    if past_dsms is None:
+        past_dsms = load_model_dsms(country_specific=country_specific,
+                                    do_past_not_future=True,
+                                    model_type='stock',
+                                    do_econ_model=False)
     inflows, stocks, outflows = get_dsm_data(past_dsms)
     scaler = np.sum(inflows, axis=2)
     trade = get_scaled_past_trade(country_specific=country_specific, scaler=scaler)[:109]
@@ -28,7 +29,7 @@ def get_stock_driven_model_upper_cycle(country_specific=False):
 
 def get_stock_driven_past_dsms(country_specific):
     stocks = get_past_stocks(country_specific=country_specific)
-    dsms = get_stock_based_dsms(stocks, 1900, 2008, do_scenarios=False)
+    dsms = get_stock_based_dsms(stocks, 1900, 2008)
     return dsms
 
 
@@ -4,21 +4,23 @@ from src.base_model.load_params import get_cullen_fabrication_yield
 from src.modelling_approaches.load_model_dsms import load_model_dsms, get_dsm_data
 from src.modelling_approaches.load_data_for_approaches import get_past_production_trade_forming_fabrication, \
     get_past_stocks
-from src.odym_extension.MultiDim_DynamicStockModel import MultiDim_DynamicStockModel
+from src.odym_extension.Batch_DynamicStockModel import Batch_DynamicStockModel
+from src.odym_extension.lifetime_kernels import calc_lifetime_kernels
 from src.read_data.load_data import load_lifetimes
 
 
-def get_change_driven_model_upper_cycle(country_specific=False):
+def get_change_driven_model_upper_cycle(country_specific=False, past_dsms=None):
     production, trade, forming_fabrication, indirect_trade = \
         get_past_production_trade_forming_fabrication(country_specific)
 
-    past_dsms = load_model_dsms(country_specific=country_specific,
-                                do_past_not_future=True,
-                                model_type='change',
-                                do_econ_model=False,
-                                recalculate=False,
-                                forming_fabrication=forming_fabrication,
-                                indirect_trade=indirect_trade)
+    if past_dsms is None:
+        past_dsms = load_model_dsms(country_specific=country_specific,
+                                    do_past_not_future=True,
+                                    model_type='change',
+                                    do_econ_model=False,
+                                    recalculate=False,
+                                    forming_fabrication=forming_fabrication,
+                                    indirect_trade=indirect_trade)
     inflows, stocks, outflows = get_dsm_data(past_dsms)
     fabrication_use = inflows - indirect_trade
 
@@ -47,25 +49,27 @@ def get_change_driven_past_dsms(country_specific, fabrication=None, indirect_tra
 
     # calculation year 0 (1900)
 
-    lifetime_matrix_shape = (stocks.shape[0],) + stocks.shape
-    lambda_matrix = np.zeros(lifetime_matrix_shape)
+    n_years = stocks.shape[0]
+    # outflows of all cohorts calculated so far in the current and all future years
+    future_outflows = np.zeros_like(stocks)
 
     mean = np.zeros_like(stocks)
     mean[0] = normal_lifetime_mean / 2
-    _update_lambda_matrix(lambda_matrix, mean[0], 0)
+    lambdas_1900 = _calc_cohort_lambdas(mean[0], n_years, 0)
 
     inflows = np.zeros_like(stocks)
-    inflows_1900 = stock_change[0] / (1 - lambda_matrix[0, 0])
+    inflows_1900 = stock_change[0] / (1 - lambdas_1900[0])
     direct_inflows_1900 = inflows_1900 - indirect_trade[0]
     fabrication_by_category_1900 = np.einsum('rg,g->rg', direct_inflows_1900,
                                              1 / fabrication_yield)
     fabrication[0] = np.sum(fabrication_by_category_1900, axis=1)
     inflows[0] = inflows_1900
+    _add_cohort_outflows(future_outflows, inflows_1900, lambdas_1900, 0)
 
     # iterative calculation up to 2008
 
-    for t in range(1, 109):
-        outflow_past_cohorts_t = _calc_outflow_past_cohorts_t(inflows, lambda_matrix, t)
+    for t in range(1, n_years):
+        outflow_past_cohorts_t = future_outflows[t].copy()
 
         mean_t, inflow_t, stock_change_t = _calc_time_step(t, outflow_past_cohorts_t,
                                                            stock_change[t],
@@ -73,7 +77,7 @@ def get_change_driven_past_dsms(country_specific, fabrication=None, indirect_tra
                                                            fabrication_yield,
                                                            min_lifetime_lambda,
                                                            max_lifetime_lambda,
-                                                           lambda_matrix)
+                                                           future_outflows)
 
         mean[t] = mean_t
         inflows[t] = inflow_t
@@ -82,22 +86,14 @@ def get_change_driven_past_dsms(country_specific, fabrication=None, indirect_tra
     outflows = inflows - stock_change
     stocks = np.cumsum(stock_change, axis=0)
 
-    inflows = np.moveaxis(inflows, 0, 2)  # move time axis to the end to iterate more easily through inflows
-
     years = np.arange(1900, 2009)
-    dsms = [[_create_change_driven_past_dsm(cat_inflows,
-                                            stocks[:, region_idx, cat_idx],
-                                            outflows[:, region_idx, cat_idx],
-                                            mean[:, region_idx, cat_idx],
-                                            years)
-             for cat_idx, cat_inflows in enumerate(region_inflows)]
-            for region_idx, region_inflows in enumerate(inflows)]
+    dsms = _create_change_driven_past_dsm(inflows, stocks, outflows, mean, years)
 
     return dsms
 
 
 def _calc_time_step(t, outflow_past_cohorts_t, stock_change_t, fabrication_t, indirect_trade_t, fabrication_yield,
-                    min_lifetime_lambda, max_lifetime_lambda, lambda_matrix):
+                    min_lifetime_lambda, max_lifetime_lambda, future_outflows):
     fx_for_x_calculation = (stock_change_t + outflow_past_cohorts_t - indirect_trade_t) / fabrication_yield
     x_t = _calc_x_as_share_from_fx(fx_for_x_calculation)
     inflow_t = np.einsum('r,rg,g->rg', fabrication_t, x_t, fabrication_yield) + indirect_trade_t
@@ -109,16 +105,11 @@ def _calc_time_step(t, outflow_past_cohorts_t, stock_change_t, fabrication_t, in
                              where=inflow_t != 0)
 
     mean_t = _switch_initial_lambda_mean(lambda_t)
-    _update_lambda_matrix(lambda_matrix, mean_t, t)
+    lambdas_t = _calc_cohort_lambdas(mean_t, future_outflows.shape[0], t)
+    _add_cohort_outflows(future_outflows, inflow_t, lambdas_t, t)
     return mean_t, inflow_t, stock_change_t
 
 
-def _calc_outflow_past_cohorts_t(inflows, lambda_matrix, t):
-    outflow_past_cohorts_t = inflows[:t] * lambda_matrix[t, :t]
-    outflow_past_cohorts_t = np.sum(outflow_past_cohorts_t, axis=0)
-    return outflow_past_cohorts_t
-
-
 def _switch_initial_lambda_mean(mean_or_lambda):
     # if either mean or lambda is zero, this means that the inflow is zero too and hence the other can be zero as well
     # to avoid nan values
@@ -149,28 +140,32 @@ def _adapt_stock_change_t(inflow_t, stock_change_t, outflow_past_cohorts_t, min_
     return stock_change_t
 
 
-def _update_lambda_matrix(lambda_matrix, mean_t, t):
-    sd_t = 0.3 * mean_t
-    future_t = np.arange(t, 109)
-    t_dash = t
+def _calc_cohort_lambdas(mean_t, n_years, t):
+    """
+    Calculates the lambdas (shares of the inflow leaving the stock) of the cohort of year t
+    for the years t until the last year. The lifetime means depend on the data, so the kernels are not stored.
+    """
+    lambdas_t = calc_lifetime_kernels(mean_t, 0.3 * mean_t, n_years, kernel_type='pdf')
+    lambdas_t = np.moveaxis(lambdas_t[..., :n_years - t], -1, 0)
+    return lambdas_t
 
-    factor = np.divide(1, sqrt(2) * pi * sd_t, out=np.zeros_like(mean_t, dtype='float64'), where=mean_t != 0)
-    prep_exponent_divident = np.expand_dims(np.expand_dims(future_t - t_dash, axis=1), axis=1)
-    exponent_divident = - (prep_exponent_divident - mean_t) ** 2
-    exponent_divisor = np.divide(1, 2 * sd_t ** 2, out=np.zeros_like(mean_t, dtype='float64'), where=mean_t != 0)
-    exponent = np.einsum('trg,rg->trg', exponent_divident, exponent_divisor)
 
-    new_lambdas = np.einsum('rg,trg->trg', factor, e ** exponent)
-    lambda_matrix[t:, t] = new_lambdas
+def _add_cohort_outflows(future_outflows, inflow_t, lambdas_t, t):
+    """
+    Adds the outflows of the cohort of year t to the running outflow sums of the years t until the last year,
+    so that the outflows of all past cohorts never have to be summed up again.
+    """
+    future_outflows[t:] += lambdas_t * inflow_t
 
 
 def _create_change_driven_past_dsm(inflows, stocks, outflows, lifetime_mean, years):
-    steel_stock_dsm = MultiDim_DynamicStockModel(t=years,
-                                                 i=inflows,
-                                                 s=stocks,
-                                                 o=outflows,
-                                                 lt={'Type': 'Normal', 'Mean': lifetime_mean,
-                                                     'StdDev': lifetime_mean * 0.3})
+    steel_stock_dsm = Batch_DynamicStockModel(t=years,
+                                              i=inflows,
+                                              s=stocks,
+                                              o=outflows,
+                                              lt={'Type': 'Normal', 'Mean': lifetime_mean,
+                                                  'StdDev': lifetime_mean * 0.3},
+                                              store_kernels=False)  # the lifetimes are calculated from the data
     steel_stock_dsm.compute_s_c_inflow_driven()
     steel_stock_dsm.compute_o_c_from_s_c()
     return steel_stock_dsm
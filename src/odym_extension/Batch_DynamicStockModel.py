@@ -0,0 +1,242 @@
+import numpy as np
+from scipy.signal import fftconvolve
+from src.odym_extension.lifetime_kernels import get_lifetime_matrix, get_lifetime_kernels, calc_lifetime_kernels
+from src.tools.array_store import save_array_store, load_array_store
+
+
+class Batch_DynamicStockModel:
+    """
+    A vectorised counterpart of the ODYM DynamicStockModel. Instead of one model per time series,
+    all series (e.g. every region, in-use category and scenario) are solved together. Inflows and
+    stocks have the time axis first, followed by any number of batch axes, e.g. 't,r,g,s'.
+    Cohort-specific results (s_c, o_c) follow the ODYM convention of time x cohort, followed by the
+    batch axes ('t,c,r,g,s').
+
+    Lifetimes are given per cohort with the batch axes they depend on, e.g. 'c,r,g'. A cohort axis of
+    length one is copied to all cohorts (like ODYM does for scalar lifetimes). The survival function
+    is computed once with these axes and broadcast across all remaining batch axes (e.g. scenarios).
+    Lifetimes calculated from the data need store_kernels=False, so that their lifetime kernels are not
+    added to the lifetime kernel store.
+    """
+
+    def __init__(self, t, i=None, s=None, o=None, lt=None, sf=None, store_kernels=True):
+        self.t = np.asarray(t)
+        self.i = None if i is None else np.asarray(i, dtype='float64')
+        self.s = None if s is None else np.asarray(s, dtype='float64')
+        self.o = None if o is None else np.asarray(o, dtype='float64')
+        self.lt = _expand_lifetimes_to_cohorts(lt, len(self.t))
+        self.sf = sf
+        self.store_kernels = store_kernels
+        self.s_c = None
+        self.o_c = None
+
+    def compute_all_stock_driven(self):
+        self.compute_stock_driven_model()
+        self.compute_outflow_total()
+        self.check_steel_stock_dsm()
+
+    def compute_all_inflow_driven(self):
+        if self.has_time_invariant_lifetimes():
+            self.compute_stock_and_outflow_by_convolution()
+        else:
+            self.compute_s_c_inflow_driven()
+            self.compute_o_c_from_s_c()
+            self.compute_stock_total()
+            self.compute_outflow_total()
+        self.check_steel_stock_dsm()
+
+    def has_time_invariant_lifetimes(self):
+        return np.all(self.lt['Mean'] == self.lt['Mean'][0]) and np.all(self.lt['StdDev'] == self.lt['StdDev'][0])
+
+    def compute_stock_and_outflow_by_convolution(self):
+        """
+        Fast path for lifetimes that are equal for all cohorts: the stock is then the convolution
+        of the inflows with the survival function, which is done for all series at once.
+        Cohort-specific stocks and outflows (s_c, o_c) are not computed.
+        """
+        get_kernels = get_lifetime_kernels if self.store_kernels else calc_lifetime_kernels
+        sf_kernel = get_kernels(self.lt['Mean'][0], self.lt['StdDev'][0], len(self.t), kernel_type='sf',
+                                distribution=self.lt['Type'])
+        sf_kernel = np.moveaxis(sf_kernel, -1, 0)
+        sf_kernel = sf_kernel.reshape(sf_kernel.shape + (1,) * (self.i.ndim - sf_kernel.ndim))
+        self.s, self.o = calc_stock_and_outflow_by_convolution(self.i, sf_kernel)
+        return self.s, self.o
+
+    def compute_sf(self):
+        """
+        Gets the survival function of all cohorts ('t,c' + lifetime batch axes) from the
+        lifetime kernel store (or calculates it if store_kernels is False). As in ODYM, cohorts with
+        a mean lifetime of zero have a survival function of zero.
+        """
+        if self.sf is None:
+            self.sf = get_lifetime_matrix(self.lt['Mean'], self.lt['StdDev'], len(self.t),
+                                          kernel_type='sf', distribution=self.lt['Type'], store=self.store_kernels)
+        return self.sf
+
+    def compute_stock_driven_model(self):
+        """
+        Determines inflows and cohort stocks from total stocks. The cohorts are solved one after
+        another, but each step covers all series at once.
+        """
+        sf = self._get_batch_sf()
+        n_years = len(self.t)
+        self.i = np.zeros_like(self.s)
+        self.s_c = np.zeros((n_years,) + self.s.shape)
+        sf_diagonal = sf[np.arange(n_years), np.arange(n_years)]
+        for m in range(n_years):
+            remaining_stock = self.s[m] - np.sum(self.s_c[m, :m], axis=0)
+            self.i[m] = np.divide(remaining_stock, sf_diagonal[m],
+                                  out=np.zeros_like(remaining_stock),
+                                  where=sf_diagonal[m] != 0)
+            self.s_c[m:, m] = self.i[m] * sf[m:, m]
+        self.compute_o_c_from_s_c()
+        return self.s_c, self.o_c, self.i
+
+    def compute_s_c_inflow_driven(self):
+        sf = self._get_batch_sf()
+        self.s_c = sf * np.expand_dims(self.i, axis=0)
+        return self.s_c
+
+    def compute_o_c_from_s_c(self):
+        n_years = len(self.t)
+        diagonal = (np.arange(n_years), np.arange(n_years))
+        self.o_c = np.zeros_like(self.s_c)
+        self.o_c[1:] = -np.diff(self.s_c, axis=0)
+        self.o_c[diagonal] = self.i - self.s_c[diagonal]
+        return self.o_c
+
+    def compute_stock_total(self):
+        self.s = np.sum(self.s_c, axis=1)
+        return self.s
+
+    def compute_outflow_total(self):
+        self.o = np.sum(self.o_c, axis=1)
+        return self.o
+
+    def compute_stock_change(self):
+        return np.diff(self.s, axis=0, prepend=0)
+
+    def check_stock_balance(self):
+        return self.i - self.o - self.compute_stock_change()
+
+    def check_steel_stock_dsm(self):
+        balance = self.check_stock_balance()
+        balance = np.abs(balance).sum(axis=0)
+        if np.any(balance > 1):  # 1 tonne accuracy
+            raise RuntimeError("Stock balance for dynamic stock base_model is too high: " + str(np.max(balance)))
+        elif np.any(balance > 0.001):
+            print("Stock balance for base_model dynamic stock base_model is noteworthy: " + str(np.max(balance)))
+
+    def _get_batch_sf(self):
+        """
+        Returns the survival function with trailing axes added so it broadcasts across all
+        batch axes that the lifetimes don't depend on (e.g. scenarios).
+        """
+        sf = self.compute_sf()
+        values = self.i if self.i is not None else self.s
+        n_missing_axes = values.ndim + 1 - sf.ndim
+        return sf.reshape(sf.shape + (1,) * n_missing_axes)
+
+
+def calc_stock_and_outflow_by_convolution(inflows, sf_kernel):
+    """
+    Calculates stocks and outflows of an inflow-driven model with time-invariant lifetimes.
+
+    :param inflows: Inflows with the time axis first.
+    :param sf_kernel: Survival function by cohort age (age axis first), broadcastable to the inflows.
+    :return: Stocks and outflows in the shape of the inflows.
+    """
+    n_years = inflows.shape[0]
+    stocks = fftconvolve(inflows, sf_kernel, axes=0)[:n_years]
+    outflows = inflows - np.diff(stocks, axis=0, prepend=0)
+    return stocks, outflows
+
+
+def save_batch_dsm(dsm: Batch_DynamicStockModel, store_path, fingerprint=None):
+    """
+    Saves time, inflows, stocks, outflows and lifetimes of a batch DSM to an array store. Cohort-specific
+    results and the survival function are not saved, the latter is taken from the lifetime kernel store if needed.
+    """
+    arrays = {'t': dsm.t, 'lt_mean': dsm.lt['Mean'], 'lt_sd': dsm.lt['StdDev']}
+    for name in ['i', 's', 'o']:
+        if getattr(dsm, name) is not None:
+            arrays[name] = getattr(dsm, name)
+    metadata = {'lifetime_type': dsm.lt['Type'], 'store_kernels': dsm.store_kernels}
+    save_array_store(store_path, arrays, metadata=metadata, fingerprint=fingerprint)
+
+
+def load_batch_dsm(store_path, mmap_mode='r') -> Batch_DynamicStockModel:
+    """
+    Loads a batch DSM saved with save_batch_dsm, its arrays are memory mapped (read only by default).
+    """
+    arrays, metadata = load_array_store(store_path, mmap_mode=mmap_mode)
+    lt = {'Type': metadata['lifetime_type'], 'Mean': arrays['lt_mean'], 'StdDev': arrays['lt_sd']}
+    return Batch_DynamicStockModel(t=arrays['t'], i=arrays.get('i'), s=arrays.get('s'), o=arrays.get('o'), lt=lt,
+                                   store_kernels=metadata.get('store_kernels', True))
+
+
+def _expand_lifetimes_to_cohorts(lt, n_years):
+    if lt is None:
+        return None
+    expanded_lt = {'Type': lt['Type']}
+    for key in ['Mean', 'StdDev']:
+        values = np.asarray(lt[key], dtype='float64')
+        if values.shape[0] == 1:
+            values = np.repeat(values, n_years, axis=0)
+        expanded_lt[key] = values
+    return expanded_lt
+
+
+def _test(n_years=60, tolerance=1e-9):
+    """
+    Compares the stock driven and the inflow driven batch DSM with cohort specific lifetimes to one ODYM
+    DynamicStockModel per series.
+    """
+    from ODYM.odym.modules.dynamic_stock_model import DynamicStockModel
+
+    rng = np.random.default_rng(0)
+    stocks = np.cumsum(rng.random((n_years, 3, 4, 2)), axis=0)
+    mean = rng.random((n_years, 3, 4)) * 40 + 10
+    lt = {'Type': 'Normal', 'Mean': mean, 'StdDev': 0.3 * mean}
+    stock_driven_dsm = Batch_DynamicStockModel(t=np.arange(n_years), s=stocks, lt=lt)
+    stock_driven_dsm.compute_all_stock_driven()
+    inflow_driven_dsm = Batch_DynamicStockModel(t=np.arange(n_years), i=stock_driven_dsm.i * 1.1, lt=lt)
+    inflow_driven_dsm.compute_all_inflow_driven()
+
+    differences = {}
+    for series_idx in np.ndindex(stocks.shape[1:]):
+        values_idx = (slice(None),) + series_idx
+        series_mean = mean[:, series_idx[0], series_idx[1]]
+        odym_stock_driven_dsm = DynamicStockModel(t=np.arange(n_years), s=stocks[values_idx],
+                                                  lt={'Type': 'Normal', 'Mean': series_mean,
+                                                      'StdDev': 0.3 * series_mean})
+        odym_stock_driven_dsm.compute_stock_driven_model()
+        odym_stock_driven_dsm.compute_outflow_total()
+        odym_inflow_driven_dsm = DynamicStockModel(t=np.arange(n_years), i=inflow_driven_dsm.i[values_idx],
+                                                   lt={'Type': 'Normal', 'Mean': series_mean,
+                                                       'StdDev': 0.3 * series_mean})
+        odym_inflow_driven_dsm.compute_s_c_inflow_driven()
+        odym_inflow_driven_dsm.compute_o_c_from_s_c()
+        odym_inflow_driven_dsm.compute_stock_total()
+        odym_inflow_driven_dsm.compute_outflow_total()
+
+        comparisons = {'stock driven inflows': (stock_driven_dsm.i, odym_stock_driven_dsm.i),
+                       'stock driven outflows': (stock_driven_dsm.o, odym_stock_driven_dsm.o),
+                       'inflow driven stocks': (inflow_driven_dsm.s, odym_inflow_driven_dsm.s),
+                       'inflow driven outflows': (inflow_driven_dsm.o, odym_inflow_driven_dsm.o)}
+        for name, (values, odym_values) in comparisons.items():
+            difference = _calc_relative_difference(values[values_idx], odym_values)
+            differences[name] = max(differences.get(name, 0), difference)
+
+    for name, difference in differences.items():
+        print(f'Maximum relative difference of the {name} to ODYM: {difference:.2e}')
+    if max(differences.values()) > tolerance:
+        raise RuntimeError('The batch DSM does not match the ODYM DynamicStockModel.')
+
+
+def _calc_relative_difference(values, reference_values):
+    return np.max(np.abs(values - reference_values)) / max(np.max(np.abs(reference_values)), 1e-12)
+
+
+if __name__ == '__main__':
+    _test()
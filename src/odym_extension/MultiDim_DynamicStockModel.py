@@ -1,5 +1,7 @@
 import numpy as np
 from ODYM.odym.modules.dynamic_stock_model import DynamicStockModel
+from src.odym_extension.Batch_DynamicStockModel import calc_stock_and_outflow_by_convolution
+from src.odym_extension.lifetime_kernels import get_lifetime_kernels
 
 
 class MultiDim_DynamicStockModel(DynamicStockModel):
@@ -10,12 +12,24 @@ class MultiDim_DynamicStockModel(DynamicStockModel):
         self.check_steel_stock_dsm()
 
     def compute_all_inflow_driven(self):
-        self.compute_s_c_inflow_driven()
-        self.compute_o_c_from_s_c()
-        self.compute_stock_total()
-        self.compute_outflow_total()
+        if self._has_time_invariant_lifetimes():
+            self._compute_stock_and_outflow_by_convolution()
+        else:
+            self.compute_s_c_inflow_driven()
+            self.compute_o_c_from_s_c()
+            self.compute_stock_total()
+            self.compute_outflow_total()
         self.check_steel_stock_dsm()
 
+    def _has_time_invariant_lifetimes(self):
+        mean = np.asarray(self.lt['Mean'])
+        std_dev = np.asarray(self.lt['StdDev'])
+        return self.lt['Type'] == 'Normal' and np.all(mean == mean[0]) and np.all(std_dev == std_dev[0])
+
+    def _compute_stock_and_outflow_by_convolution(self):
+        sf_kernel = get_lifetime_kernels(self.lt['Mean'][0], self.lt['StdDev'][0], len(self.t), kernel_type='sf')
+        self.s, self.o = calc_stock_and_outflow_by_convolution(np.asarray(self.i, dtype='float64'), sf_kernel)
+
     def check_steel_stock_dsm(self):
         balance = self.check_stock_balance()
         balance = np.abs(balance).sum()
@@ -25,8 +39,40 @@ class MultiDim_DynamicStockModel(DynamicStockModel):
             print("Stock balance for base_model dynamic stock base_model is noteworthy: " + str(balance))
 
 
-def _test():
-    return
+def _test(n_years=201, tolerance=1e-9):
+    """
+    Compares the stocks and outflows of the convolution fast path for time-invariant lifetimes to the cohort based
+    calculation of ODYM.
+    """
+    from src.odym_extension.Batch_DynamicStockModel import Batch_DynamicStockModel
+
+    rng = np.random.default_rng(0)
+    inflows = rng.random((n_years, 3, 4)) * 10
+    mean = rng.random((3, 4)) * 40 + 10
+    mean[0, 0] = 0  # products without lifetime leave the stock immediately
+    batch_lt = {'Type': 'Normal', 'Mean': np.expand_dims(mean, axis=0), 'StdDev': np.expand_dims(0.3 * mean, axis=0)}
+    batch_dsm = Batch_DynamicStockModel(t=np.arange(n_years), i=inflows, lt=batch_lt)
+    batch_dsm.compute_all_inflow_driven()
+
+    max_difference = 0
+    for series_idx in np.ndindex(inflows.shape[1:]):
+        values_idx = (slice(None),) + series_idx
+        lt = {'Type': 'Normal', 'Mean': [mean[series_idx]], 'StdDev': [0.3 * mean[series_idx]]}
+        dsm = MultiDim_DynamicStockModel(t=np.arange(n_years), i=inflows[values_idx], lt=dict(lt))
+        dsm.compute_all_inflow_driven()
+        odym_dsm = DynamicStockModel(t=np.arange(n_years), i=inflows[values_idx], lt=dict(lt))
+        odym_dsm.compute_s_c_inflow_driven()
+        odym_dsm.compute_o_c_from_s_c()
+        odym_dsm.compute_stock_total()
+        odym_dsm.compute_outflow_total()
+        for values, odym_values in [(dsm.s, odym_dsm.s), (dsm.o, odym_dsm.o), (batch_dsm.s[values_idx], odym_dsm.s),
+                                    (batch_dsm.o[values_idx], odym_dsm.o)]:
+            difference = np.max(np.abs(values - odym_values)) / max(np.max(np.abs(odym_values)), 1e-12)
+            max_difference = max(max_difference, difference)
+
+    print(f'Maximum relative difference of the convolution stocks and outflows to ODYM: {max_difference:.2e}')
+    if max_difference > tolerance:
+        raise RuntimeError('The convolution fast path does not match the ODYM DynamicStockModel.')
 
 
 if __name__ == '__main__':
@@ -1,5 +1,10 @@
+import copy
 import numpy as np
+from scipy.sparse import coo_matrix
 from ODYM.odym.modules.ODYM_Classes import MFAsystem, Flow, Stock
+from src.tools.array_store import save_array_store, load_array_store, load_array, load_array_store_manifest
+
+MFA_VALUES_VERSION = 2  # version of the value buffer layout, stored MFA system values of other versions are outdated
 
 
 class SimDiGraph_MFAsystem(MFAsystem):
@@ -7,24 +12,102 @@ class SimDiGraph_MFAsystem(MFAsystem):
     An adoption of the ODYM MFA system where flows are defined by their start and end processes rather than
     their names. This means no two flows can start AND end at the same processes, but allows for more
     natural processing.
+
+    Flow and stock values are not allocated one by one: all flows (or stocks) with the same indices share one
+    contiguous value buffer, their values are views of it. Flows are found via an integer-indexed flow table.
+    Flows that are only non-zero in one block of an index (e.g. one waste category) can be initiated as block
+    flows, only this block is stored (see BlockFlow). Use get_flow_block and get_flow_sum to work on the block of
+    these flows, their dense values are built on every access of get_flowV.
     """
 
-    def init_flow(self, name, from_id, to_id, indices):
-        flow = Flow(Name=name, P_Start=from_id, P_End=to_id, Indices=indices, Values=None)
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.flow_table = {}  # (start process ID, end process ID) -> flow ID
+        self.flows = []  # flows by flow ID
+        self.flow_buffers = {}  # indices -> values of all flows with these indices
+        self.stock_buffers = {}  # indices -> values of all stocks with these indices
+
+    def init_flow(self, name, from_id, to_id, indices, block=None):
+        """
+        Adds a flow to the MFA system.
+
+        :param name:
+        :param from_id: Start process of flow.
+        :param to_id: End process of flow.
+        :param indices: Indices of the flow, e.g. 't,e,r,w,s'.
+        :param block: Optional (index, start, stop) if the flow is only non-zero for the items start to stop
+        (exclusive) of this index, e.g. ('w', 6, 7). Only this block is stored then.
+        :return:
+        """
+        if block is None:
+            flow = Flow(Name=name, P_Start=from_id, P_End=to_id, Indices=indices, Values=None)
+        else:
+            block_index, block_start, block_stop = block
+            n_items = self.get_shape(block_index)[0]
+            flow = BlockFlow(block_index, block_start, block_stop, n_items,
+                             Name=name, P_Start=from_id, P_End=to_id, Indices=indices, Values=None)
         self.FlowDict['F_' + str(from_id) + '_' + str(to_id)] = flow
+        self.flow_table[(from_id, to_id)] = len(self.flows)
+        self.flows.append(flow)
 
     def get_flow(self, from_id: int, to_id: int) -> Flow:
-        return self.FlowDict['F_' + str(from_id) + '_' + str(to_id)]
+        return self.flows[self.flow_table[(from_id, to_id)]]
 
     def get_flowV(self, from_id: int, to_id: int) -> np.ndarray:
         """
-        Returns ndarray of flow values to read AND edit.
+        Returns ndarray of flow values to read AND edit. For block flows, these are dense read-only values built
+        from the block, use get_flow_block or set_flowV to edit them.
         :param from_id: Start process of flow.
         :param to_id: End process of flow
         :return:
         """
         return self.get_flow(from_id, to_id).Values
 
+    def get_flow_block(self, from_id: int, to_id: int) -> np.ndarray:
+        """
+        Returns ndarray of the stored flow values to read AND edit: the block values of block flows (only the items
+        block_start to block_stop of their block index) and the values of all other flows.
+        :param from_id: Start process of flow.
+        :param to_id: End process of flow
+        :return:
+        """
+        flow = self.get_flow(from_id, to_id)
+        return flow.block_values if isinstance(flow, BlockFlow) else flow.Values
+
+    def get_flow_sum(self, from_id: int, to_id: int, indices: str) -> np.ndarray:
+        """
+        Returns the flow values summed to the given indices, e.g. 't,e,r,w,s' to sum over the in-use categories.
+        Block flows are summed from their block, dense values are only built for the summed indices.
+        :param from_id: Start process of flow.
+        :param to_id: End process of flow
+        :param indices: Indices to keep.
+        :return:
+        """
+        return sum_to_indices(self.get_flow(from_id, to_id), indices)
+
+    def set_flowV(self, from_id: int, to_id: int, values: np.ndarray, element_idx=0):
+        """
+        Sets the values of a flow for one element. Use this instead of editing the values returned by get_flowV,
+        as only the block of block flows is stored and their (dense) values can not be edited.
+        :param from_id: Start process of flow.
+        :param to_id: End process of flow.
+        :param values: Values indexed like the flow without the element index.
+        :param element_idx:
+        :return:
+        """
+        flow = self.get_flow(from_id, to_id)
+        if isinstance(flow, BlockFlow):
+            indices = ','.join(index for index in flow.Indices.split(',') if index != 'e')
+            flow.block_values[:, element_idx] = flow.get_block(values, indices)
+        else:
+            flow.Values[:, element_idx] = values
+
+    def Initialize_FlowValues(self):
+        self.flow_buffers = self._init_value_buffers(self.FlowDict.values())
+
+    def Initialize_StockValues(self):
+        self.stock_buffers = self._init_value_buffers(self.StockDict.values())
+
     def add_stock(self, p_id, name, indices, add_change_stock=True):
         name = name + '_stock'
         self.StockDict['S_' + str(p_id)] = Stock(Name=name,
@@ -47,6 +130,358 @@ class SimDiGraph_MFAsystem(MFAsystem):
     def get_stock_changeV(self, p_id):
         return self.StockDict['dS_' + str(p_id)].Values
 
+    def Consistency_Check(self):
+        # the ODYM checks only need the shapes of the flow values, so the dense values of block flows are replaced by
+        # zero-strided arrays of their shape instead of building them
+        flow_dict = self.FlowDict
+        self.FlowDict = {key: flow.get_shape_stand_in() if isinstance(flow, BlockFlow) else flow
+                         for key, flow in flow_dict.items()}
+        try:
+            return super().Consistency_Check()
+        finally:
+            self.FlowDict = flow_dict
+
     def calculate_stock_values_from_stock_change(self, p_id):
         stock_values = self.get_stock_changeV(p_id).cumsum(axis=0)
         self.get_stockV(p_id)[:] = stock_values
+
+    def calc_mass_balance(self, balance_indices='t,e,r,s', n_sample_years=None, seed=None):
+        """
+        Vectorised counterpart of MassBalance that keeps the given indices (e.g. regions and scenarios) instead
+        of only time and element. All flows and stock changes are summed to these indices and the balances of
+        all processes are calculated in one product with the sparse process incidence matrix. As in ODYM, stock
+        changes are also added to the balance of the environment (process 0).
+
+        :param balance_indices: Indices of the balance besides the process, need to be part of all flows and stocks.
+        :param n_sample_years: If given, only a random sample of this many years is checked.
+        :param seed: Seed of the random year sample.
+        :return: Balance of all processes ('p' + balance indices) and the time indices of the checked years.
+        """
+        n_years = len(self.Time_L)
+        time_idx = np.arange(n_years)
+        if n_sample_years is not None and n_sample_years < n_years:
+            time_idx = np.sort(np.random.default_rng(seed).choice(n_years, n_sample_years, replace=False))
+
+        flow_values, flows = _sum_buffers_to_indices(self.flow_buffers, self.FlowDict.values(), balance_indices,
+                                                     time_idx)
+        stock_values, stocks = _sum_buffers_to_indices(self.stock_buffers, self.StockDict.values(), balance_indices,
+                                                       time_idx)
+        values = np.concatenate([flow_values, stock_values])
+
+        incidence_matrix = self._get_incidence_matrix(flows, stocks)
+        balance = incidence_matrix @ values.reshape(values.shape[0], -1)
+        return balance.reshape((len(self.ProcessList),) + values.shape[1:]), time_idx
+
+    def get_worst_mass_balance_cells(self, balance, time_idx, balance_indices='t,e,r,s', n_cells=10,
+                                     skip_environment=True):
+        """
+        Finds the cells with the highest absolute mass balance.
+
+        :param balance: Balance of all processes as returned by calc_mass_balance.
+        :param time_idx: Time indices of the balance as returned by calc_mass_balance.
+        :param balance_indices: Indices of the balance besides the process.
+        :param n_cells: Number of cells to return.
+        :param skip_environment: The environment (process 0) always balances the other processes, hence it is
+        usually skipped.
+        :return: List of dictionaries with the process name, the items of all balance indices and the balance.
+        """
+        abs_balance = np.abs(balance)
+        if skip_environment:
+            abs_balance[0] = 0
+        n_cells = min(n_cells, abs_balance.size)
+        worst_flat_idx = np.argpartition(abs_balance.flatten(), -n_cells)[-n_cells:]
+        worst_flat_idx = worst_flat_idx[np.argsort(-abs_balance.flatten()[worst_flat_idx])]
+
+        index_table = self.IndexTable.reset_index().set_index('IndexLetter')
+        worst_cells = []
+        for cell_idx in zip(*np.unravel_index(worst_flat_idx, balance.shape)):
+            cell = {'Process': self.ProcessList[cell_idx[0]].Name}
+            for index, item_idx in zip(balance_indices.split(','), cell_idx[1:]):
+                if index == 't':
+                    item_idx = time_idx[item_idx]
+                cell[index_table.loc[index]['Aspect']] = index_table.loc[index]['Classification'].Items[item_idx]
+            cell['Balance'] = balance[cell_idx]
+            worst_cells.append(cell)
+        return worst_cells
+
+    def _get_incidence_matrix(self, flows, stocks):
+        """
+        Returns the sparse incidence matrix of processes and flows/stocks: a flow leaves its start process (-1)
+        and enters its end process (+1); stock changes leave (type 1) or enter (type 2) their process and are
+        balanced by the environment. Stocks themselves (type 0) are not part of the balance.
+        """
+        processes, columns, signs = [], [], []
+        for column, flow in enumerate(flows):
+            processes += [flow.P_Start, flow.P_End]
+            columns += [column, column]
+            signs += [-1, 1]
+        for column, stock in enumerate(stocks, start=len(flows)):
+            if stock.Type not in [1, 2]:
+                continue
+            sign = -1 if stock.Type == 1 else 1
+            processes += [stock.P_Res, 0]
+            columns += [column, column]
+            signs += [sign, -sign]
+        shape = (len(self.ProcessList), len(flows) + len(stocks))
+        return coo_matrix((signs, (processes, columns)), shape=shape).tocsr()  # duplicates (e.g. reuse) are summed
+
+    def get_shape(self, indices: str) -> tuple:
+        index_letters = self.IndexTable.set_index('IndexLetter')
+        return tuple(len(index_letters.loc[index]['Classification'].Items) for index in indices.split(','))
+
+    def _init_value_buffers(self, flows_or_stocks):
+        buffers = {}
+        for buffer_key, objects in _group_by_buffer(flows_or_stocks).items():
+            shape = self.get_shape(objects[0].Indices)
+            if isinstance(objects[0], BlockFlow):
+                shape = objects[0].get_block_shape(shape)
+            buffers[buffer_key] = np.zeros((len(objects),) + shape)
+        _link_values_to_buffers(flows_or_stocks, buffers)
+        return buffers
+
+    def __getstate__(self):
+        # values of flows and stocks are views of the buffers, hence they are only pickled once (within the buffers)
+        state = self.__dict__.copy()
+        if self.flow_buffers:
+            state['FlowDict'] = _copy_without_values(self.FlowDict)
+            state['flows'] = [state['FlowDict']['F_' + str(flow.P_Start) + '_' + str(flow.P_End)]
+                              for flow in self.flows]
+        if self.stock_buffers:
+            state['StockDict'] = _copy_without_values(self.StockDict)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.flow_buffers:
+            _link_values_to_buffers(self.FlowDict.values(), self.flow_buffers)
+        if self.stock_buffers:
+            _link_values_to_buffers(self.StockDict.values(), self.stock_buffers)
+
+
+class BlockFlow(Flow):
+    """
+    A flow that is only non-zero in one block of items of one index, e.g. the forming scrap that only has values
+    in the 'Form' waste category. Only the block is stored ('block_values', e.g. in the value buffers), the full
+    values are a dense read-only array created on access, so ODYM functions like MassBalance work as for other
+    flows. Values are edited via the block (see SimDiGraph_MFAsystem.set_flowV and get_flow_block), sums are taken
+    from the block (see sum_to_indices).
+    """
+
+    def __init__(self, block_index, block_start, block_stop, n_items, **kwargs):
+        self.block_index = block_index
+        self.block_start = block_start
+        self.block_stop = block_stop
+        self.n_items = n_items
+        self.block_values = None
+        super().__init__(**kwargs)
+
+    @property
+    def Values(self):
+        if self.block_values is None:
+            return None
+        values = self.to_dense(self.block_values, self.Indices)
+        values.flags.writeable = False  # changes would not reach the stored block
+        return values
+
+    @Values.setter
+    def Values(self, values):
+        if values is not None:
+            values = self.get_block(values, self.Indices)
+        self.block_values = values
+
+    @property
+    def block_axis(self):
+        return self.Indices.split(',').index(self.block_index)
+
+    @property
+    def shape(self):
+        """
+        Shape of the dense values.
+        """
+        shape = list(self.block_values.shape)
+        shape[self.block_axis] = self.n_items
+        return tuple(shape)
+
+    @property
+    def buffer_key(self):
+        return f'{self.Indices}:{self.block_index}{self.block_stop - self.block_start}'
+
+    def get_block_shape(self, shape):
+        block_shape = list(shape)
+        block_shape[self.block_axis] = self.block_stop - self.block_start
+        return tuple(block_shape)
+
+    def to_dense(self, block_values, indices):
+        """
+        Returns dense values of block values indexed by the given indices (e.g. a sum or a part of the block
+        values), which need to contain the block index.
+        """
+        block_axis = indices.split(',').index(self.block_index)
+        shape = list(block_values.shape)
+        shape[block_axis] = self.n_items
+        values = np.zeros(shape, dtype=block_values.dtype)
+        block_slice = (slice(None),) * block_axis + (slice(self.block_start, self.block_stop),)
+        values[block_slice] = block_values
+        return values
+
+    def get_shape_stand_in(self):
+        """
+        Returns a copy of the flow whose values are a zero-strided array of the dense shape, e.g. for checks that
+        only need the shape of the values.
+        """
+        return Flow(Name=self.Name, P_Start=self.P_Start, P_End=self.P_End, Indices=self.Indices,
+                    Values=np.broadcast_to(np.zeros((), dtype=self.block_values.dtype), self.shape))
+
+    def get_block(self, values, indices):
+        """
+        Returns the block of dense values indexed by the given indices. Raises a RuntimeError if the values are
+        not zero outside of the block, as these values would be lost.
+        """
+        block_axis = indices.split(',').index(self.block_index)
+        before_block = np.take(values, np.arange(self.block_start), axis=block_axis)
+        after_block = np.take(values, np.arange(self.block_stop, values.shape[block_axis]), axis=block_axis)
+        if np.any(before_block != 0) or np.any(after_block != 0):
+            raise RuntimeError(f'Flow {self.Name} is only stored for the items {self.block_start} to '
+                               f'{self.block_stop - 1} of index {self.block_index}, but has values outside of them.')
+        return np.take(values, np.arange(self.block_start, self.block_stop), axis=block_axis)
+
+
+def save_mfa_system_values(model: SimDiGraph_MFAsystem, store_path, fingerprint=None):
+    """
+    Saves the flow and stock values of an MFA system to an array store, one array per value buffer. The manifest
+    records where the values of each flow and stock are found, so single flows can be read on their own.
+    """
+    arrays = {}
+    metadata = {'version': MFA_VALUES_VERSION, 'flows': {}, 'stocks': {}}
+    for kind, buffers, flows_or_stocks in [('flows', model.flow_buffers, model.FlowDict),
+                                           ('stocks', model.stock_buffers, model.StockDict)]:
+        for buffer_key, buffer in buffers.items():
+            arrays[_get_buffer_name(kind, buffer_key)] = buffer
+        n_per_buffer = {}
+        for key, flow_or_stock in flows_or_stocks.items():
+            buffer_key = _get_buffer_key(flow_or_stock)
+            position = n_per_buffer.get(buffer_key, 0)  # same order as in _group_by_buffer
+            n_per_buffer[buffer_key] = position + 1
+            metadata[kind][key] = {'name': flow_or_stock.Name, 'indices': flow_or_stock.Indices,
+                                   'buffer_key': buffer_key, 'buffer': _get_buffer_name(kind, buffer_key),
+                                   'position': position}
+            if isinstance(flow_or_stock, BlockFlow):
+                metadata[kind][key]['block'] = [flow_or_stock.block_index, flow_or_stock.block_start,
+                                                flow_or_stock.block_stop, flow_or_stock.n_items]
+    save_array_store(store_path, arrays, metadata, fingerprint)
+
+
+def load_mfa_system_values(model: SimDiGraph_MFAsystem, store_path, mmap_mode='c'):
+    """
+    Links the flow and stock values of an MFA system with initiated flows and stocks to the value buffers of an
+    array store. By default, the buffers are memory mapped copy-on-write, so values can be edited in memory
+    without changing the store.
+    """
+    arrays, metadata = load_array_store(store_path, mmap_mode=mmap_mode)
+    if metadata.get('version') != MFA_VALUES_VERSION:
+        raise RuntimeError(f'The MFA system values at {store_path} were saved with another version, '
+                           f'they need to be recalculated.')
+    for kind, flows_or_stocks in [('flows', model.FlowDict), ('stocks', model.StockDict)]:
+        buffers = {}
+        for key, flow_or_stock in flows_or_stocks.items():
+            location = metadata[kind][key]
+            buffers[location['buffer_key']] = arrays[location['buffer']]
+            _set_buffer_values(flow_or_stock, arrays[location['buffer']][location['position']])
+        if kind == 'flows':
+            model.flow_buffers = buffers
+        else:
+            model.stock_buffers = buffers
+    return model
+
+
+def load_stored_flow(store_path, from_id: int, to_id: int, mmap_mode='r') -> Flow:
+    """
+    Reads a single flow from an array store written by save_mfa_system_values, without loading the MFA system.
+    Only the values of this flow are read from disk.
+    """
+    manifest = load_array_store_manifest(store_path)
+    location = manifest['metadata']['flows']['F_' + str(from_id) + '_' + str(to_id)]
+    values = load_array(store_path, location['buffer'], mmap_mode, manifest)[location['position']]
+    if 'block' in location:
+        flow = BlockFlow(*location['block'], Name=location['name'], P_Start=from_id, P_End=to_id,
+                         Indices=location['indices'], Values=None)
+        flow.block_values = values
+        return flow
+    return Flow(Name=location['name'], P_Start=from_id, P_End=to_id, Indices=location['indices'], Values=values)
+
+
+def sum_to_indices(flow_or_stock, indices):
+    """
+    Sums the values of a flow or stock to the given indices. Block flows are summed from their block, dense values
+    are only built if the block index is kept.
+    """
+    subscripts = flow_or_stock.Indices.replace(',', '') + '->' + indices.replace(',', '')
+    if not isinstance(flow_or_stock, BlockFlow):
+        return np.einsum(subscripts, flow_or_stock.Values)
+    summed_values = np.einsum(subscripts, flow_or_stock.block_values)
+    if flow_or_stock.block_index in indices.split(','):
+        summed_values = flow_or_stock.to_dense(summed_values, indices)
+    return summed_values
+
+
+def _get_buffer_name(kind, buffer_key):
+    return f"{kind}_{buffer_key.replace(',', '').replace(':', '_')}"
+
+
+def _get_buffer_key(flow_or_stock):
+    # flows and stocks share a buffer if they have the same indices (and the same block size for block flows)
+    return flow_or_stock.buffer_key if isinstance(flow_or_stock, BlockFlow) else flow_or_stock.Indices
+
+
+def _group_by_buffer(flows_or_stocks):
+    groups = {}
+    for flow_or_stock in flows_or_stocks:
+        groups.setdefault(_get_buffer_key(flow_or_stock), []).append(flow_or_stock)
+    return groups
+
+
+def _link_values_to_buffers(flows_or_stocks, buffers):
+    for buffer_key, objects in _group_by_buffer(flows_or_stocks).items():
+        for position, flow_or_stock in enumerate(objects):
+            _set_buffer_values(flow_or_stock, buffers[buffer_key][position])
+
+
+def _set_buffer_values(flow_or_stock, values):
+    if isinstance(flow_or_stock, BlockFlow):
+        flow_or_stock.block_values = values
+    else:
+        flow_or_stock.Values = values
+
+
+def _sum_buffers_to_indices(buffers, flows_or_stocks, indices, time_idx):
+    """
+    Sums the values of all flows or stocks of the buffers to the given indices, only taking the years of time_idx.
+    Works on whole buffers, so each index signature is only summed once.
+
+    :return: Summed values ('n' + indices, with 'n' denoting the flow or stock) and the flows or stocks in the
+    same order.
+    """
+    summed_values = []
+    ordered_flows_or_stocks = []
+    for buffer_key, objects in _group_by_buffer(flows_or_stocks).items():
+        values = buffers[buffer_key]
+        buffer_indices = objects[0].Indices
+        time_axis = buffer_indices.split(',').index('t') + 1
+        if len(time_idx) < values.shape[time_axis]:
+            values = np.take(values, time_idx, axis=time_axis)
+        subscripts = 'n' + buffer_indices.replace(',', '') + '->n' + indices.replace(',', '')
+        buffer_sum = np.einsum(subscripts, values)
+        if isinstance(objects[0], BlockFlow) and objects[0].block_index in indices.split(','):
+            # flows of one buffer have blocks of the same size, but not necessarily at the same items
+            buffer_sum = np.stack([flow.to_dense(flow_sum, indices) for flow, flow_sum in zip(objects, buffer_sum)])
+        summed_values.append(buffer_sum)
+        ordered_flows_or_stocks += objects
+    return np.concatenate(summed_values), ordered_flows_or_stocks
+
+
+def _copy_without_values(flow_or_stock_dict):
+    copied_dict = {}
+    for key, flow_or_stock in flow_or_stock_dict.items():
+        copied_dict[key] = copy.copy(flow_or_stock)
+        copied_dict[key].Values = None
+    return copied_dict
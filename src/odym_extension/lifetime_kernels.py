@@ -0,0 +1,149 @@
+import os
+import pickle
+import uuid
+from math import e, pi, sqrt
+import numpy as np
+from scipy.stats import norm
+from src.tools.config import cfg
+
+# Lifetime kernels only depend on distribution type, mean, standard deviation and number of years. They are stored
+# by these parameters in memory and on disk, so that survival functions and lifetime pdfs are only computed once.
+# Only kernels of lifetimes given by the data and config are stored. Lifetimes calculated during a model run (e.g. from
+# the past DSMs) use calc_lifetime_kernels or store=False instead, otherwise the store would grow with every run.
+
+_kernel_store = None
+_kernel_store_changed = False
+
+
+def get_lifetime_matrix(mean, std_dev, n_years, kernel_type='sf', distribution='Normal', store=True):
+    """
+    Returns a lower triangular lifetime matrix ('t,c' + lifetime axes) of all cohorts, e.g. the survival
+    function or lifetime pdf of cohort c in year t.
+
+    :param mean: Lifetime means with the cohort axis first (e.g. 'c,r,g').
+    :param std_dev: Lifetime standard deviations with the same shape as the means.
+    :param n_years: Number of years of the lifetime matrix.
+    :param kernel_type: Either 'sf' (survival function) or 'pdf' (lifetime probability density).
+    :param distribution: Lifetime distribution type, currently only 'Normal'.
+    :param store: Whether to take the kernels from the lifetime kernel store, False for lifetimes calculated from the
+    data.
+    :return:
+    """
+    get_kernels = get_lifetime_kernels if store else calc_lifetime_kernels
+    kernels = get_kernels(mean, std_dev, n_years, kernel_type, distribution)
+    kernels = np.moveaxis(kernels, -1, 0)  # 'a,c,...' with 'a' denoting the age of the cohort
+    age = np.subtract.outer(np.arange(n_years), np.arange(n_years))
+    cohorts = np.broadcast_to(np.arange(n_years), age.shape)
+    lifetime_matrix = kernels[np.maximum(age, 0), cohorts]
+    lifetime_matrix[age < 0] = 0
+    return lifetime_matrix
+
+
+def get_lifetime_kernels(mean, std_dev, n_years, kernel_type='sf', distribution='Normal'):
+    """
+    Returns the lifetime kernels of all given lifetimes by age, the age axis is added as last axis.
+    Kernels are taken from the lifetime kernel store if they were already computed.
+
+    :param mean: Lifetime means of any shape.
+    :param std_dev: Lifetime standard deviations with the same shape as the means.
+    :param n_years: Number of ages (years) of the kernels.
+    :param kernel_type: Either 'sf' (survival function) or 'pdf' (lifetime probability density).
+    :param distribution: Lifetime distribution type, currently only 'Normal'.
+    :return:
+    """
+    global _kernel_store_changed
+    mean = np.asarray(mean, dtype='float64')
+    std_dev = np.broadcast_to(np.asarray(std_dev, dtype='float64'), mean.shape)
+    lifetimes = np.stack([mean.flatten(), std_dev.flatten()], axis=1)
+    unique_lifetimes, inverse = np.unique(lifetimes, axis=0, return_inverse=True)
+
+    store = _get_kernel_store()
+    keys = [(kernel_type, distribution, lt_mean, lt_sd, n_years) for lt_mean, lt_sd in unique_lifetimes]
+    is_missing = np.array([key not in store for key in keys], dtype=bool)
+    if np.any(is_missing):
+        missing_lifetimes = unique_lifetimes[is_missing]
+        new_kernels = _calc_kernels(missing_lifetimes[:, 0], missing_lifetimes[:, 1], n_years,
+                                    kernel_type, distribution)
+        for key_idx, kernel in zip(np.flatnonzero(is_missing), new_kernels):
+            store[keys[key_idx]] = kernel
+        _kernel_store_changed = True
+
+    unique_kernels = np.array([store[key] for key in keys])
+    kernels = unique_kernels[inverse.flatten()]
+    return kernels.reshape(mean.shape + (n_years,))
+
+
+def calc_lifetime_kernels(mean, std_dev, n_years, kernel_type='sf', distribution='Normal'):
+    """
+    Computes the lifetime kernels of all given lifetimes like get_lifetime_kernels, but without the kernel store.
+    Used for lifetimes that are calculated from the data (e.g. at every time step), which would otherwise grow the
+    store with kernels that are hardly ever used again.
+
+    :param mean: Lifetime means of any shape.
+    :param std_dev: Lifetime standard deviations with the same shape as the means.
+    :param n_years: Number of ages (years) of the kernels.
+    :param kernel_type: Either 'sf' (survival function) or 'pdf' (lifetime probability density).
+    :param distribution: Lifetime distribution type, currently only 'Normal'.
+    :return:
+    """
+    mean = np.asarray(mean, dtype='float64')
+    std_dev = np.broadcast_to(np.asarray(std_dev, dtype='float64'), mean.shape)
+    kernels = _calc_kernels(mean.flatten(), std_dev.flatten(), n_years, kernel_type, distribution)
+    return kernels.reshape(mean.shape + (n_years,))
+
+
+def save_lifetime_kernels():
+    """
+    Saves the lifetime kernel store to disk if new kernels have been computed since it was loaded.
+    """
+    global _kernel_store_changed
+    if _kernel_store is not None and _kernel_store_changed:
+        file_path = _get_kernel_store_path()
+        temp_file_path = f'{file_path}.{uuid.uuid4().hex}.tmp'  # parallel processes and threads may save at once
+        with open(temp_file_path, 'wb') as file:
+            pickle.dump(_kernel_store, file)
+        os.replace(temp_file_path, file_path)
+        _kernel_store_changed = False
+
+
+def _calc_kernels(mean, std_dev, n_years, kernel_type, distribution):
+    if distribution != 'Normal':
+        raise RuntimeError(f"Lifetime distribution type {distribution} is not implemented for lifetime kernels.")
+    ages = np.arange(n_years)
+    mean = np.expand_dims(mean, axis=1)
+    std_dev = np.expand_dims(std_dev, axis=1)
+    has_lifetime = mean != 0  # as in ODYM, products with a lifetime of zero leave the stock immediately
+    if kernel_type == 'sf':
+        safe_std_dev = np.where(has_lifetime, std_dev, 1)
+        kernels = norm.sf(ages, loc=mean, scale=safe_std_dev)
+        return np.where(has_lifetime, kernels, 0)
+    elif kernel_type == 'pdf':
+        factor = np.divide(1, sqrt(2) * pi * std_dev, out=np.zeros_like(mean), where=has_lifetime)
+        exponent_divisor = np.divide(1, 2 * std_dev ** 2, out=np.zeros_like(mean), where=has_lifetime)
+        exponent = -(ages - mean) ** 2 * exponent_divisor
+        return factor * e ** exponent
+    else:
+        raise ValueError(f'{kernel_type} is not a valid lifetime kernel type.')
+
+
+def _get_kernel_store():
+    global _kernel_store
+    if _kernel_store is None:
+        file_path = _get_kernel_store_path()
+        _kernel_store = pickle.load(open(file_path, "rb")) if os.path.exists(file_path) else {}
+    return _kernel_store
+
+
+def _get_kernel_store_path():
+    return os.path.join(cfg.data_path, 'models', 'lifetime_kernels.p')
+
+
+def _test():
+    mean = np.array([[10., 20.], [10., 0.]])
+    sf = get_lifetime_matrix(np.expand_dims(mean, axis=0).repeat(5, axis=0), 0.3 * mean, 5)
+    print(sf[:, :, 0, 0])
+    print(f'Stored kernels: {len(_get_kernel_store())}')
+
+
+if __name__ == '__main__':
+    _test()
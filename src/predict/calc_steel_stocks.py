@@ -8,11 +8,19 @@ from src.tools.config import cfg
 from src.tools.tools import get_np_from_df
 from src.predict.prediction_tools import visualise_stock_results, copy_stocks_across_scenarios
 
+# Strategies that only need stock and GDP data by area and hence also work for single countries. Pauliuk needs
+# saturation levels by region and the LSTM models are trained for the regions of the region data source.
+COUNTRY_LEVEL_STRATEGIES = ['Pehl', 'Duerrwaechter']
+# Strategies whose prediction of a scenario only depends on the GDP of this scenario, so the scenarios can be
+# predicted separately. The LSTM predicts all scenarios with one batched call of the same model.
+SCENARIO_STRATEGIES = ['Pehl', 'Pauliuk', 'Duerrwaechter']
+
 
 def get_np_steel_stocks_with_prediction(country_specific, get_per_capita=False,
-                                        include_gdp_and_pop_scenarios=cfg.include_gdp_and_pop_scenarios_in_prediction,
+                                        include_gdp_and_pop_scenarios=None,
                                         strategy=None,
-                                        stocks=None):
+                                        stocks=None,
+                                        scenario_idx=None):
     """
     Calculates In-use steel stock per capita data based on GDP pC using approach given in
     config file (e.g. Pauliuk or Pehl).
@@ -23,26 +31,27 @@ def get_np_steel_stocks_with_prediction(country_specific, get_per_capita=False,
     :param include_gdp_and_pop_scenarios:
     :param strategy:
     :param stocks: The TOTAL (NOT! per capita past stocks)
+    :param scenario_idx: If given, only the stocks (t,r,g) of this GDP and population scenario are predicted, see
+    SCENARIO_STRATEGIES.
     :return: Steel data for the years 1900-2100, so BOTH present and past using predict
     approach given in config file.
     """
+    if include_gdp_and_pop_scenarios is None:
+        include_gdp_and_pop_scenarios = cfg.include_gdp_and_pop_scenarios_in_prediction
     if strategy is None:
         strategy = cfg.curve_strategy
     print(f'Curve Strategy: {strategy}')
-    if country_specific:
-        raise RuntimeError('Prediction strategy not defined for country_specific level.')
-
-    pop = get_np_pop_data(country_specific, include_gdp_and_pop_scenarios)
-    gdp = _get_np_gdp_data(country_specific, include_gdp_and_pop_scenarios)
-
-    if stocks is None:
-        stocks = _get_np_old_stocks_data(country_specific)
-    else:
-        # transfer stocks to per capita stocks
-        past_pop = pop[:109]
-        if include_gdp_and_pop_scenarios:
-            past_pop = past_pop[:, :, 0]  # in the past, all scenarios are the same
-        stocks = np.einsum('trg,tr->trg', stocks, 1 / past_pop)
+    if country_specific and strategy not in COUNTRY_LEVEL_STRATEGIES:
+        raise RuntimeError(f'Prediction strategy {strategy} not defined for country_specific level, '
+                           f'use one of {COUNTRY_LEVEL_STRATEGIES}.')
+
+    stocks, gdp, pop = get_np_prediction_inputs(country_specific, include_gdp_and_pop_scenarios, stocks)
+    if scenario_idx is not None and include_gdp_and_pop_scenarios:
+        if strategy not in SCENARIO_STRATEGIES:
+            raise RuntimeError(f'Prediction strategy {strategy} can not predict single scenarios, '
+                               f'use one of {SCENARIO_STRATEGIES}.')
+        gdp = gdp[..., scenario_idx]
+        pop = pop[..., scenario_idx]
 
     if strategy == "Pehl":
         stocks = predict_pehl(stocks, gdp)
@@ -56,19 +65,43 @@ def get_np_steel_stocks_with_prediction(country_specific, get_per_capita=False,
         raise RuntimeError(f"Prediction strategy {strategy} is not defined. "
                            f"It needs to be either 'Pauliuk', 'Pehl', 'Duerrwaechter' or 'LSTM'.")
 
-    if len(stocks.shape) != 4:
+    if len(stocks.shape) != 4 and scenario_idx is None:
         # scenario dimension is missing
         stocks = copy_stocks_across_scenarios(stocks)
 
     if not get_per_capita:
-        stock_dims = 'trgs'
+        stock_dims = 'trgs' if scenario_idx is None else 'trg'
         pop_dims = 'tr'
-        if include_gdp_and_pop_scenarios:
+        if pop.ndim == 3:
             pop_dims += 's'
         stocks = np.einsum(f'{stock_dims},{pop_dims}->{stock_dims}', stocks, pop)
     return stocks
 
 
+def get_np_prediction_inputs(country_specific, include_gdp_and_pop_scenarios, stocks=None):
+    """
+    Returns the past per capita stocks (t,r,g), GDP per capita and population (t,r or t,r,s with scenarios) the stock
+    prediction is based on.
+
+    :param country_specific:
+    :param include_gdp_and_pop_scenarios:
+    :param stocks: The TOTAL past stocks (t,r,g), the stock data is used if None.
+    :return:
+    """
+    pop = get_np_pop_data(country_specific, include_gdp_and_pop_scenarios)
+    gdp = _get_np_gdp_data(country_specific, include_gdp_and_pop_scenarios)
+
+    if stocks is None:
+        stocks = _get_np_old_stocks_data(country_specific)
+    else:
+        # transfer stocks to per capita stocks
+        past_pop = pop[:109]
+        if include_gdp_and_pop_scenarios:
+            past_pop = past_pop[:, :, 0]  # in the past, all scenarios are the same
+        stocks = np.einsum('trg,tr->trg', stocks, 1 / past_pop)
+    return stocks, gdp, pop
+
+
 def _get_np_old_stocks_data(country_specific):
     df_stocks = load_stocks(country_specific=country_specific, per_capita=True)
     stocks = get_np_from_df(df_stocks, data_split_into_categories=True)
@@ -79,6 +112,8 @@ def _get_np_old_stocks_data(country_specific):
 def get_np_pop_data(country_specific, include_gdp_and_pop_scenarios):
     pop_source = 'KC-Lutz' if include_gdp_and_pop_scenarios else cfg.pop_data_source
     df_pop = load_pop(pop_source, country_specific=country_specific)
+    if country_specific:
+        df_pop = _select_stock_countries(df_pop)
     pop = df_pop.to_numpy()
     pop = pop.transpose()
     if include_gdp_and_pop_scenarios:
@@ -90,6 +125,8 @@ def _get_np_gdp_data(country_specific, include_gdp_and_pop_scenarios, per_capita
     gdp_source = 'Koch-Leimbach' if include_gdp_and_pop_scenarios else cfg.gdp_data_source
     df_gdp = load_gdp(gdp_source=gdp_source, country_specific=country_specific, per_capita=per_capita,
                       get_scenarios=include_gdp_and_pop_scenarios)
+    if country_specific:
+        df_gdp = _select_stock_countries(df_gdp)
     gdp = df_gdp.to_numpy()
     gdp = gdp.transpose()
 
@@ -99,12 +136,24 @@ def _get_np_gdp_data(country_specific, include_gdp_and_pop_scenarios, per_capita
     return gdp
 
 
+def _select_stock_countries(df):
+    """
+    Selects the countries of the stock data in their order, as population and GDP data cover other countries.
+    """
+    stock_countries = list(load_stocks(country_specific=True, per_capita=True).index.unique(level=0))
+    missing_countries = sorted(set(stock_countries) - set(df.index.unique(level=0)))
+    if missing_countries:
+        raise RuntimeError(f'Population or GDP data is missing for the countries {missing_countries} '
+                           f'of the stock data.')
+    return df.loc[stock_countries]
+
+
 def _reshape_scenario_data(data):
     n_regions = int(data.shape[1] / cfg.n_scenarios)
     return data.reshape(data.shape[0], n_regions, cfg.n_scenarios)
 
 
-def test(strategy=cfg.curve_strategy, do_visualize=True):
+def test(strategy=None, do_visualize=True):
     """
     Calculates StockpC/GDPpC function based on approach given in config file (e.g. Pauliuk or Pehl).
     Optionally creates plot to show predict for Germany.
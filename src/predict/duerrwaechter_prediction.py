@@ -2,7 +2,6 @@ import numpy as np
 from scipy.optimize import least_squares
 from src.predict.prediction_tools import split_future_stocks_to_base_year_categories, \
     copy_stocks_across_scenarios
-from src.tools.config import cfg
 
 
 def predict_duerrwaechter(stocks, gdp_data):
@@ -11,9 +10,10 @@ def predict_duerrwaechter(stocks, gdp_data):
     past_stocks_by_category = stocks.copy()
     stocks = np.sum(stocks, axis=2)
 
+    is_with_scenarios = gdp_data.ndim == 3
     gdp_data_future = gdp_data[109:]
     gdp_data_past = gdp_data[:109]  # up until 2009 all scenarios are the same
-    if cfg.include_gdp_and_pop_scenarios_in_prediction:
+    if is_with_scenarios:
         # gdp data is equal in the past for all 5 scenarios, for calculation of A+b we just need one
         gdp_data_past = gdp_data_past[:, :, 0]
 
@@ -22,15 +22,15 @@ def predict_duerrwaechter(stocks, gdp_data):
     a = 17.4
     b_regions = -np.log(1 - (s_0 / a)) / g_0
 
-    if cfg.include_gdp_and_pop_scenarios_in_prediction:
+    if is_with_scenarios:
         gdp_data_future = np.moveaxis(gdp_data_future, -1, 0)
     future_stocks = _duerrwaechter_stock_curve(gdp_data_future, a, b_regions)
-    if cfg.include_gdp_and_pop_scenarios_in_prediction:
+    if is_with_scenarios:
         future_stocks = np.moveaxis(future_stocks, 0, -1)
 
     future_stocks = split_future_stocks_to_base_year_categories(past_stocks_by_category, future_stocks,
-                                                                is_future_stocks_with_scenarios=cfg.include_gdp_and_pop_scenarios_in_prediction)
-    if cfg.include_gdp_and_pop_scenarios_in_prediction:
+                                                                is_future_stocks_with_scenarios=is_with_scenarios)
+    if is_with_scenarios:
         past_stocks_by_category = copy_stocks_across_scenarios(past_stocks_by_category)
 
     stocks = np.concatenate([past_stocks_by_category, future_stocks], axis=0)
@@ -0,0 +1,200 @@
+import csv
+import itertools
+import math
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+import numpy as np
+from src.tools.config import cfg, create_config, use_config, get_config
+from src.modelling_approaches.load_model_dsms import load_model_dsms, get_dsm_data
+from src.predict.calc_steel_stocks import get_np_prediction_inputs
+from src.predict.lstm_prediction import get_normalized_series, get_training_series, get_train_dataset, \
+    create_new_model, save_model, set_torch_threads
+
+# The grid search trains the LSTM models of all trials in parallel worker processes, each trial with its own frozen
+# config (see config.use_config), which is the config of the caller with the values of the trial. Poor trials are
+# stopped early with successive halving: all trials are trained with few epochs first, only the best trials of each
+# data group (same data sources and model type) are trained again with reduction_factor times more epochs, until the
+# survivors are trained with the maximum number of epochs and saved. Trials are ranked by the backtest MAPE of
+# eval_model. The normalized training series and the training dataset of every data group are prepared once in the
+# main process and passed to the workers, the LSTM hyperparameters do not change them.
+
+LSTM_HYPERPARAMETERS = ['n_epochs', 'n_rnn_layers', 'hidden_dim']
+_LOG_COLUMNS = ['round', 'n_epochs', 'config', 'mape', 'wall_time', 'model_path', 'error']
+
+
+def run_grid_search(grid: dict, n_workers=None, min_epochs=None, max_epochs=None, reduction_factor=3):
+    """
+    Trains LSTM models for all combinations of the grid, every trial is logged with its MAPE and wall time to a csv
+    file in the output data directory.
+
+    :param grid: Dictionary of config attribute names and lists of values to combine, e.g.
+    {'model_type': ['stock', 'inflow'], 'n_rnn_layers': [3, 6], 'hidden_dim': [5, 15]}. The number of epochs is not
+    part of the grid, it is the budget of the successive halving.
+    :param n_workers: Number of worker processes, all CPU cores are used if None.
+    :param min_epochs: Number of epochs of the first round, max_epochs / reduction_factor ** 3 (at least 1) if None.
+    :param max_epochs: Number of epochs of the last round, cfg.n_epochs is used if None.
+    :param reduction_factor: In each round, only the best 1 / reduction_factor of the trials of a data group are kept
+    and the number of epochs is multiplied by it. 1 trains all trials once with max_epochs.
+    :return: List of the config dicts of the trials of the last round with their MAPE and model path, best first.
+    """
+    if 'n_epochs' in grid:
+        raise RuntimeError("The number of epochs is set by the successive halving, use 'min_epochs' and 'max_epochs' "
+                           "instead of putting 'n_epochs' into the grid.")
+    if max_epochs is None:
+        max_epochs = cfg.n_epochs
+    if min_epochs is None:
+        min_epochs = max(1, max_epochs // reduction_factor ** 3) if reduction_factor > 1 else max_epochs
+    if n_workers is None:
+        n_workers = os.cpu_count()
+    epochs_schedule = _get_epochs_schedule(min_epochs, max_epochs, reduction_factor)
+
+    trials = [dict(zip(grid.keys(), values)) for values in itertools.product(*grid.values())]
+    data_groups = _get_data_groups(trials)
+    training_series = {data_key: _prepare_training_series(group_trials[0])
+                       for data_key, group_trials in data_groups.items()}
+    log_path = _get_log_path()
+    print(f'Grid search of {len(trials)} trials with the epochs {epochs_schedule}, logged to {log_path}')
+
+    mp_context = multiprocessing.get_context('spawn')
+    n_threads = max(1, os.cpu_count() // n_workers)
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=mp_context, initializer=_init_worker,
+                             initargs=(n_threads,)) as executor:
+        for round_idx, n_epochs in enumerate(epochs_schedule):
+            is_last_round = round_idx == len(epochs_schedule) - 1
+            results = _run_round(executor, data_groups, training_series, n_epochs, is_last_round)
+            _log_results(log_path, round_idx, n_epochs, results)
+            if not is_last_round:
+                data_groups = {data_key: _select_best_trials(group_results, reduction_factor)
+                               for data_key, group_results in results.items()}
+
+    final_results = [dict(trial, n_epochs=max_epochs, mape=result['mape'], model_path=result['model_path'])
+                     for group_results in results.values() for trial, result in group_results
+                     if result['error'] is None]
+    return sorted(final_results, key=lambda trial: trial['mape'])
+
+
+def _get_epochs_schedule(min_epochs, max_epochs, reduction_factor):
+    if min_epochs < 1 or min_epochs > max_epochs:
+        raise RuntimeError(f'The minimum number of epochs needs to be between 1 and {max_epochs}, not {min_epochs}.')
+    epochs_schedule = [max_epochs]
+    while reduction_factor > 1 and epochs_schedule[0] // reduction_factor >= min_epochs:
+        epochs_schedule.insert(0, epochs_schedule[0] // reduction_factor)
+    return epochs_schedule
+
+
+def _get_data_groups(trials):
+    """
+    Groups the trials by the config attributes that are not LSTM hyperparameters, i.e. that change the training data.
+    """
+    data_groups = {}
+    for trial in trials:
+        data_key = tuple((name, repr(value)) for name, value in trial.items() if name not in LSTM_HYPERPARAMETERS)
+        data_groups.setdefault(data_key, []).append(trial)
+    return data_groups
+
+
+def _prepare_training_series(trial):
+    """
+    Loads the past stocks and GDP of the trial config and converts them to the normalized training series and
+    training dataset like lstm_prediction does when creating a new model.
+    """
+    with use_config(create_config(_get_trial_config_dict(trial, cfg.n_epochs))):
+        past_dsms = load_model_dsms(country_specific=False, do_past_not_future=True, recalculate=False)
+        _, past_stocks, _ = get_dsm_data(past_dsms)
+        stocks, gdp, _ = get_np_prediction_inputs(country_specific=False,
+                                                  include_gdp_and_pop_scenarios=
+                                                  cfg.include_gdp_and_pop_scenarios_in_prediction,
+                                                  stocks=past_stocks)
+        if gdp.ndim == 2:
+            gdp = np.expand_dims(gdp, axis=2)
+        _, ts_stocks_list, ts_gdp_lists, _ = get_normalized_series(np.sum(stocks, axis=2), gdp)
+        ts_stocks_list, ts_covariates = get_training_series(ts_stocks_list, ts_gdp_lists[0])
+        return ts_stocks_list, ts_covariates, get_train_dataset(ts_stocks_list, ts_covariates)
+
+
+def _run_round(executor, data_groups, training_series, n_epochs, do_save_models):
+    """
+    Trains the trials of all data groups with the number of epochs.
+
+    :return: Dictionary of data keys and lists of (trial, result) tuples.
+    """
+    futures = {executor.submit(_run_trial, _get_trial_config_dict(trial, n_epochs), training_series[data_key],
+                               do_save_models): (data_key, trial)
+               for data_key, group_trials in data_groups.items() for trial in group_trials}
+    results = {data_key: [] for data_key in data_groups}
+    for future in as_completed(futures):
+        data_key, trial = futures[future]
+        try:
+            result = future.result()
+        except Exception as exception:
+            print(f'LSTM trial {trial} failed: {exception!r}')
+            result = {'mape': None, 'wall_time': None, 'model_path': None, 'error': repr(exception)}
+        results[data_key].append((trial, result))
+    return results
+
+
+def _run_trial(config_dict, trial_training_series, do_save_model):
+    start_time = time.perf_counter()
+    with use_config(create_config(config_dict)):
+        model, model_mape = create_new_model(*trial_training_series)
+        model_path = save_model(model, model_mape) if do_save_model else None
+    return {'mape': model_mape, 'wall_time': time.perf_counter() - start_time, 'model_path': model_path,
+            'error': None}
+
+
+def _select_best_trials(group_results, reduction_factor):
+    """
+    Keeps the best 1 / reduction_factor of the trials of a data group, failed trials and trials without a finite MAPE
+    are stopped.
+    """
+    valid_results = [(trial, result) for trial, result in group_results
+                     if result['error'] is None and math.isfinite(result['mape'])]
+    valid_results.sort(key=lambda trial_result: trial_result[1]['mape'])
+    n_kept = math.ceil(len(group_results) / reduction_factor)
+    return [trial for trial, _ in valid_results[:n_kept]]
+
+
+def _get_trial_config_dict(trial, n_epochs):
+    # trials keep the settings of the calling run (e.g. its data sources), only the grid values are changed
+    trial_name = '_'.join(str(value) for value in trial.values())
+    return {**vars(get_config()), **trial, 'simulation_name': f'lstm_trial_{trial_name}', 'n_epochs': n_epochs}
+
+
+def _init_worker(n_threads):
+    # the workers share the CPU cores, by default every worker would use all of them
+    set_torch_threads(n_threads, n_interop_threads=1)
+
+
+def _get_log_path():
+    log_directory = os.path.join(cfg.data_path, 'output', 'lstm_grid_search')
+    os.makedirs(log_directory, exist_ok=True)
+    timestamp = datetime.now().strftime("%y%m%d_%H%M%S")
+    return os.path.join(log_directory, f'grid_search_{timestamp}.csv')
+
+
+def _log_results(log_path, round_idx, n_epochs, results):
+    is_new_log = not os.path.exists(log_path)
+    with open(log_path, 'a', newline='') as log_file:
+        writer = csv.DictWriter(log_file, fieldnames=_LOG_COLUMNS)
+        if is_new_log:
+            writer.writeheader()
+        for group_results in results.values():
+            for trial, result in group_results:
+                writer.writerow(dict(result, round=round_idx, n_epochs=n_epochs, config=repr(trial)))
+                if result['error'] is None:
+                    print(f'Round {round_idx} ({n_epochs} epochs) {trial}: MAPE {result["mape"]:.2f} %, '
+                          f'{result["wall_time"]:.1f} s')
+
+
+def _test():
+    results = run_grid_search({'model_type': ['stock'], 'n_rnn_layers': [3, 6], 'hidden_dim': [5, 25]},
+                              min_epochs=10, max_epochs=90)
+    for result in results:
+        print(result)
+
+
+if __name__ == '__main__':
+    _test()
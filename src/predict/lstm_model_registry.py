@@ -0,0 +1,191 @@
+import datetime
+import hashlib
+import os
+import sqlite3
+from contextlib import contextmanager
+from src.tools.config import cfg
+
+# LSTM models are registered with their metadata in a small SQLite database next to the model files, so the best
+# model for a data source, region source and model type is found with one indexed query instead of parsing all
+# file names. SQLite transactions make registrations of parallel grid search processes atomic.
+# Models saved before the registry existed are registered from their file names when the registry is created.
+
+MAX_MODEL_MAPE = 10  # models need an accuracy of at least 10 % to be used
+_REGISTRY_FILE_NAME = 'registry.sqlite'
+_CREATE_TABLE_STATEMENTS = [
+    '''CREATE TABLE IF NOT EXISTS models (
+           file_name TEXT PRIMARY KEY,
+           steel_data_source TEXT NOT NULL,
+           region_data_source TEXT NOT NULL,
+           model_type TEXT NOT NULL,
+           mape REAL NOT NULL,
+           n_epochs INTEGER,
+           n_rnn_layers INTEGER,
+           hidden_dim INTEGER,
+           input_chunk_length INTEGER,
+           output_chunk_length INTEGER,
+           checksum TEXT NOT NULL,
+           created TEXT NOT NULL)''',
+    '''CREATE INDEX IF NOT EXISTS best_model_index
+           ON models (steel_data_source, region_data_source, model_type, mape)''']
+_existing_registries = set()  # registry paths of this process whose tables are known to exist
+
+
+def get_lstm_models_path():
+    return os.path.join(cfg.data_path, 'models', 'lstm_models')
+
+
+def register_model(model_path, mape, hyperparameters: dict = None):
+    """
+    Registers a saved model with the current steel and region data source and model type.
+
+    :param model_path: Path of the saved model, it needs to be in the LSTM models directory.
+    :param mape: Backtest MAPE of the model in %.
+    :param hyperparameters: Dictionary with n_epochs, n_rnn_layers, hidden_dim, input_chunk_length and
+    output_chunk_length, missing values are registered as unknown.
+    :return:
+    """
+    if hyperparameters is None:
+        hyperparameters = {}
+    _check_is_in_models_path(model_path)
+    with _connect() as connection:
+        _insert_model(connection, os.path.basename(model_path), cfg.steel_data_source, cfg.region_data_source,
+                      cfg.model_type, mape, hyperparameters, _calc_checksum(model_path))
+
+
+def get_best_model_path(steel_data_source=None, region_data_source=None, model_type=None):
+    """
+    Looks up the model with the lowest backtest MAPE (below MAX_MODEL_MAPE) for the data sources and model type,
+    the current config is used for arguments that are None.
+
+    :return: Path of the model and its MAPE, (None, None) if there is no such model.
+    """
+    row = _get_best_model_row(steel_data_source, region_data_source, model_type)
+    if row is None:
+        return None, None
+    file_name, mape, checksum = row
+    model_path = os.path.join(get_lstm_models_path(), file_name)
+    if _calc_checksum(model_path) != checksum:
+        raise RuntimeError(f'The LSTM model {model_path} was changed after it was registered.')
+    return model_path, mape
+
+
+def get_best_model_checksum(steel_data_source=None, region_data_source=None, model_type=None):
+    """
+    Returns the registered checksum of the model get_best_model_path selects, e.g. for the fingerprints of results
+    predicted with it (see cache_fingerprint). None if there is no such model.
+    """
+    row = _get_best_model_row(steel_data_source, region_data_source, model_type)
+    return None if row is None else row[2]
+
+
+def _get_best_model_row(steel_data_source, region_data_source, model_type):
+    steel_data_source = cfg.steel_data_source if steel_data_source is None else steel_data_source
+    region_data_source = cfg.region_data_source if region_data_source is None else region_data_source
+    model_type = cfg.model_type if model_type is None else model_type
+    with _connect() as connection:
+        return connection.execute('''SELECT file_name, mape, checksum FROM models
+                                     WHERE steel_data_source = ? AND region_data_source = ? AND model_type = ?
+                                     AND mape < ?
+                                     ORDER BY mape, created DESC LIMIT 1''',
+                                  (steel_data_source, region_data_source, model_type, MAX_MODEL_MAPE)).fetchone()
+
+
+@contextmanager
+def _connect():
+    """
+    Opens the registry (creating it if needed), changes within the context are committed as one transaction.
+    """
+    models_path = get_lstm_models_path()
+    registry_path = os.path.join(models_path, _REGISTRY_FILE_NAME)
+    if registry_path not in _existing_registries:
+        _ensure_registry(models_path, registry_path)
+        _existing_registries.add(registry_path)
+    connection = sqlite3.connect(registry_path, timeout=60)
+    try:
+        with connection:  # deferred transaction, lookups do not block each other
+            yield connection
+    finally:
+        connection.close()
+
+
+def _ensure_registry(models_path, registry_path):
+    """
+    Creates the registry tables and registers the legacy models if the registry does not exist yet.
+    """
+    os.makedirs(models_path, exist_ok=True)
+    connection = sqlite3.connect(registry_path, timeout=60)
+    try:
+        if _has_models_table(connection):
+            return
+        with connection:
+            connection.execute('BEGIN EXCLUSIVE')  # only one process creates the registry
+            if _has_models_table(connection):
+                return
+            for statement in _CREATE_TABLE_STATEMENTS:
+                connection.execute(statement)
+            _register_legacy_models(connection, models_path)
+    finally:
+        connection.close()
+
+
+def _has_models_table(connection):
+    return connection.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'models'").fetchone() \
+        is not None
+
+
+def _register_legacy_models(connection, models_path):
+    """
+    Registers models saved before the registry existed, their file names are
+    '<MAPE>%_<date>_<time>_<steel source>_<region source>_<model type>[_<epochs>_<layers>_<hidden dim>_<input
+    chunk length>_<output chunk length>].pt'.
+    """
+    hyperparameter_names = ['n_epochs', 'n_rnn_layers', 'hidden_dim', 'input_chunk_length', 'output_chunk_length']
+    for file_name in sorted(os.listdir(models_path)):
+        if not file_name.endswith('.pt'):
+            continue
+        fields = file_name[:-len('.pt')].split('_')
+        try:
+            hyperparameters = dict(zip(hyperparameter_names, fields[6:]))
+            _insert_model(connection, file_name, fields[3], fields[4], fields[5], float(fields[0][:-1]),
+                          hyperparameters, _calc_checksum(os.path.join(models_path, file_name)))
+        except (IndexError, ValueError):
+            print(f'LSTM model {file_name} is not registered, its metadata can not be read from the file name.')
+
+
+def _insert_model(connection, file_name, steel_data_source, region_data_source, model_type, mape, hyperparameters,
+                  checksum):
+    connection.execute('''INSERT OR REPLACE INTO models VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                       (file_name, steel_data_source, region_data_source, model_type, float(mape),
+                        _to_int(hyperparameters.get('n_epochs')), _to_int(hyperparameters.get('n_rnn_layers')),
+                        _to_int(hyperparameters.get('hidden_dim')),
+                        _to_int(hyperparameters.get('input_chunk_length')),
+                        _to_int(hyperparameters.get('output_chunk_length')),
+                        checksum, datetime.datetime.now().isoformat()))
+
+
+def _check_is_in_models_path(model_path):
+    models_path = os.path.abspath(get_lstm_models_path())
+    if os.path.dirname(os.path.abspath(model_path)) != models_path:
+        raise RuntimeError(f'LSTM models need to be saved in {models_path} to be registered.')
+
+
+def _calc_checksum(model_path):
+    file_hash = hashlib.sha256()
+    with open(model_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def _to_int(value):
+    return None if value is None else int(value)
+
+
+def _test():
+    model_path, mape = get_best_model_path()
+    print(f'Best LSTM model: {model_path} (MAPE: {mape})')
+
+
+if __name__ == '__main__':
+    _test()
@@ -4,38 +4,50 @@ import numpy as np
 import pandas as pd
 from src.predict.prediction_tools import split_future_stocks_to_base_year_categories, \
     copy_stocks_across_scenarios
+from src.predict.lstm_model_registry import get_lstm_models_path, get_best_model_path, register_model
 from src.read_data.load_data import load_region_names_list
 from src.tools.config import cfg
 from darts.metrics import mape
 from darts.models import RNNModel
+from darts.utils.data import DualCovariatesShiftedDataset
 from darts import TimeSeries
+import torch
 from matplotlib import pyplot as plt
 import os
 import datetime
 
 do_normalize_stocks = True
-n_epochs = 700
 do_show_plot = False
 do_create_new_model = False
 input_chunk_length = 95  # 109-14 time steps for future
 output_chunk_length = 14  # or 92 ?
-n_rnn_layers = 8
+training_length = 24
+backtest_start = 95  # 2008-(2022-2009)=1995
 
-cfg.n_epochs = n_epochs
-cfg.n_rnn_layers = n_rnn_layers
+# CPU training mode: models are trained in float32 instead of the float64 of the data, optionally with bfloat16
+# autocast, and with a fixed number of torch threads (the torch defaults are kept if None).
+do_train_in_float32 = True
+do_use_bfloat16_autocast = False
+n_torch_threads = None
+n_torch_interop_threads = None
 
 
-def predict_lstm(stocks, gdp, pop, include_scenarios=cfg.include_gdp_and_pop_scenarios_in_prediction):
+_loaded_models = {}  # (models path, steel data source, region data source, model type) -> (model, MAPE)
+
+
+def predict_lstm(stocks, gdp, pop, include_scenarios=None):
+    if include_scenarios is None:
+        include_scenarios = cfg.include_gdp_and_pop_scenarios_in_prediction
     past_stocks_by_category = stocks.copy()
     stocks = np.sum(stocks, axis=2)
 
+    if gdp.ndim == 2:
+        gdp = np.expand_dims(gdp, axis=2)
+    elif not include_scenarios:
+        gdp = gdp[:, :, 1:2]  # SSP2
+    future_stocks = _lstm_stock_curves(stocks, gdp, do_create_new_model=do_create_new_model)
     if not include_scenarios:
-        future_stocks = _lstm_stock_curve(stocks, gdp[:, :, 1], pop[:, :, 1], do_create_new_model=do_create_new_model)
-    else:
-        future_stocks = np.array(
-            [_lstm_stock_curve(stocks, gdp[:, :, i], pop[:, :, i], do_create_new_model=do_create_new_model) for
-             i, scenario in enumerate(cfg.scenarios)])
-        future_stocks = np.moveaxis(future_stocks, 0, -1)
+        future_stocks = future_stocks[:, :, 0]
 
     future_stocks = split_future_stocks_to_base_year_categories(past_stocks_by_category, future_stocks,
                                                                 is_future_stocks_with_scenarios=include_scenarios)
@@ -47,17 +59,68 @@ def predict_lstm(stocks, gdp, pop, include_scenarios=cfg.include_gdp_and_pop_sce
     return stocks
 
 
-def _lstm_stock_curve(stocks, gdp, pop, do_create_new_model):
+def _lstm_stock_curves(stocks, gdp, do_create_new_model):
+    """
+    Predicts the future stocks (t,r,s) of all scenarios of the GDP (t,r,s) with one batched model prediction.
+    The series of all scenarios and regions are predicted together, the past stocks are the same in all scenarios.
+    """
     if not do_create_new_model:
         model, model_mape = _load_model()
         if model is None:
             do_create_new_model = True
 
+    stocks, ts_stocks_list, ts_gdp_lists, stock_range = get_normalized_series(stocks, gdp)
+    n_regions = len(ts_stocks_list)
+    n_scenarios = len(ts_gdp_lists)
+
+    if do_create_new_model:
+        # past GDP is the same in all scenarios, hence the model is trained once with the first scenario
+        model, model_mape = create_new_model(*get_training_series(ts_stocks_list, ts_gdp_lists[0]))
+
+    prediction = model.predict(n=92,
+                               series=_to_model_dtype(ts_stocks_list, model) * n_scenarios,
+                               future_covariates=_to_model_dtype([ts_gdp for ts_gdp_list in ts_gdp_lists
+                                                                  for ts_gdp in ts_gdp_list], model))
+    values = np.array([series.values()[:, 0] for series in prediction])  # scenario-major (s*r,t)
+    values = values.reshape(n_scenarios, n_regions, -1).transpose(2, 1, 0)
+    orig_times = np.concatenate([np.broadcast_to(np.expand_dims(stocks, axis=2), stocks.shape + (n_scenarios,)),
+                                 values], axis=0)
+    if stock_range is not None:
+        min_stocks, max_stocks = stock_range
+        orig_stocks = np.einsum('trs,r->trs', orig_times, max_stocks - min_stocks) + np.expand_dims(min_stocks, axis=1)
+    else:
+        orig_stocks = orig_times
+
+    if do_create_new_model or do_show_plot:
+        plt.plot(np.arange(1900, 2101), orig_stocks[:, :, 0])
+        plt.legend(load_region_names_list())
+        plt.xlabel('Time (y)')
+        plt.ylabel('Steel (t)')
+        plt.title('Steel stocks per capita with normal and smoothed (--) predictions \n'
+                  f'{cfg.region_data_source}_{cfg.steel_data_source}_{cfg.model_type}_{cfg.n_epochs}_{cfg.n_rnn_layers}_{cfg.hidden_dim}')
+    if do_create_new_model:
+        model_path = save_model(model, model_mape)
+        plt.savefig(f'{os.path.splitext(model_path)[0]}.png', dpi=300)
+    if do_show_plot:
+        plt.show()
+    plt.clf()  # clear figure if doing several tests
+    return orig_stocks[109:]
+
+
+def get_normalized_series(stocks, gdp):
+    """
+    Normalizes the past per capita stocks (t,r) and the GDP per capita (t,r,s) and converts them to time series.
+
+    :return: Normalized stocks, list of stock series by region, lists of GDP series by region for every scenario and
+    the minimum and maximum stocks used for the normalization (None if stocks are not normalized).
+    """
+    stock_range = None
     if do_normalize_stocks:
         # stocks are normalized to be within the range 0 and 1, with 'room' to rise up to 40 tonnes / capita
         min_stocks = np.min(stocks, axis=0)
         max_stocks = np.ones_like(min_stocks) * 40
         stocks = (stocks - min_stocks) / (max_stocks - min_stocks)
+        stock_range = (min_stocks, max_stocks)
 
         min_gdp = np.min(gdp, axis=0)
         max_gdp = np.max(gdp, axis=0)
@@ -65,101 +128,148 @@ def _lstm_stock_curve(stocks, gdp, pop, do_create_new_model):
 
     stock_times = pd.date_range("1900-01-01", periods=109, freq="Y")
     gdp_times = pd.date_range("1900-01-01", periods=201, freq="Y")
+    n_regions = stocks.shape[1]
 
-    regions = load_region_names_list()
+    ts_stocks_list = [TimeSeries.from_times_and_values(stock_times, stocks[:, r]) for r in range(n_regions)]
+    ts_gdp_lists = [[TimeSeries.from_times_and_values(gdp_times, gdp[:, r, s]) for r in range(n_regions)]
+                    for s in range(gdp.shape[2])]
+    return stocks, ts_stocks_list, ts_gdp_lists, stock_range
 
-    ts_stocks = TimeSeries.from_times_and_values(stock_times, stocks)
-    ts_stocks_train, _ = ts_stocks.split_before(0.8)
-    ts_stocks_list = [TimeSeries.from_times_and_values(stock_times, stocks[:, r]) for r, region in enumerate(regions)]
 
-    ts_gdp_list = [TimeSeries.from_times_and_values(gdp_times, gdp[:, r]) for r, region in enumerate(regions)]
+def get_training_series(ts_stocks_list, ts_covariates):
+    if cfg.model_type == 'inflow':  # the reference region is not used for training
+        return ts_stocks_list[:9] + ts_stocks_list[9 + 1:], ts_covariates[:9] + ts_covariates[9 + 1:]
+    return ts_stocks_list, ts_covariates
 
-    ts_covariates = ts_gdp_list
-    if do_create_new_model:
-        ts_stocks_list_without_ref = ts_stocks_list[:9] + ts_stocks_list[9 + 1:]
-        ts_covariates_without_ref = ts_covariates[:9] + ts_covariates[9 + 1:]
-        model, model_mape = _create_new_model(
-            ts_stocks_list_without_ref if cfg.model_type == 'inflow' else ts_stocks_list,
-            ts_covariates_without_ref if cfg.model_type == 'inflow' else ts_covariates)
 
-    prediction = model.predict(n=92,
-                               series=ts_stocks_list,
-                               future_covariates=ts_gdp_list)
-    values = np.array([prediction[r].values() for r, region in enumerate(regions)]).transpose()
-    orig_times = np.concatenate([stocks, values[0]], axis=0)
-    if do_normalize_stocks:
-        orig_stocks = orig_times * (max_stocks - min_stocks) + min_stocks
-    else:
-        orig_stocks = orig_times
+def save_model(model, model_mape):
+    """
+    Saves the model with the current config to the LSTM models directory and registers it.
 
+    :return: Path of the saved model.
+    """
     timestamp = datetime.datetime.now().strftime("%y%m%d_%H%M%S")
     f_name = f'{model_mape:.2f}%_{timestamp}_{cfg.steel_data_source}_{cfg.region_data_source}_' \
              f'{cfg.model_type}_{cfg.n_epochs}_{cfg.n_rnn_layers}_{cfg.hidden_dim}_{input_chunk_length}_{output_chunk_length}'
-    base_path = os.path.join(cfg.data_path, 'models', 'lstm_models')
-    pic_path = os.path.join(base_path, f'{f_name}.png')
-    model_path = os.path.join(base_path, f'{f_name}.pt')
-    if do_create_new_model or do_show_plot:
-        plt.plot(np.arange(1900, 2101), orig_stocks)
-        plt.legend(regions)
-        plt.xlabel('Time (y)')
-        plt.ylabel('Steel (t)')
-        plt.title('Steel stocks per capita with normal and smoothed (--) predictions \n'
-                  f'{cfg.region_data_source}_{cfg.steel_data_source}_{cfg.model_type}_{cfg.n_epochs}_{cfg.n_rnn_layers}_{cfg.hidden_dim}')
-    if do_create_new_model:
-        model.save(model_path)
-        plt.savefig(pic_path, dpi=300)
-    if do_show_plot:
-        plt.show()
-    plt.clf()  # clear figure if doing several tests
-    return orig_stocks[109:]
+    model_path = os.path.join(get_lstm_models_path(), f'{f_name}.pt')
+    model.save(model_path)
+    register_model(model_path, model_mape, {'n_epochs': cfg.n_epochs, 'n_rnn_layers': cfg.n_rnn_layers,
+                                            'hidden_dim': cfg.hidden_dim,
+                                            'input_chunk_length': input_chunk_length,
+                                            'output_chunk_length': output_chunk_length})
+    _loaded_models.clear()  # the new model might be the best one now
+    return model_path
 
 
 def _load_model():
-    base_path = os.path.join(cfg.data_path, 'models', 'lstm_models')
-    files = os.listdir(base_path)
-    models = [file.split('_') for file in files if file.endswith('.pt')]
-    models = [model for model in models if
-              model[3] == cfg.steel_data_source
-              and model[4] == cfg.region_data_source and model[5] == cfg.model_type and float(model[0][:-1]) < 10]
-    # model needs to match desired steel and region data source and model type and have an accuracy of at least 10 %
-
-    if len(models) == 0:
-        return None, None
-    models = ['_'.join(model) for model in models]
-    final = min(models)
-    final_path = os.path.join(base_path, final)
-    print(final_path)
-    model_mape = float(final.split('%')[0])
-    model = RNNModel.load(final_path)
-    return model, model_mape
+    """
+    Loads the best registered model for the current steel and region data source and model type, loaded models are
+    kept in memory.
+    """
+    model_key = (get_lstm_models_path(), cfg.steel_data_source, cfg.region_data_source, cfg.model_type)
+    if model_key not in _loaded_models:
+        model_path, model_mape = get_best_model_path()
+        model = None if model_path is None else RNNModel.load(model_path)
+        _loaded_models[model_key] = model, model_mape
+    return _loaded_models[model_key]
+
+
+def create_new_model(ts_stocks_list, ts_covariates, train_dataset=None):
+    """
+    Trains a new model with the hyperparameters of the current config and evaluates it with a backtest.
+
+    :param ts_stocks_list:
+    :param ts_covariates:
+    :param train_dataset: Precomputed training dataset of the series (see get_train_dataset), e.g. to share it
+    between several models, it is created if None.
+    :return: Model and its backtest MAPE in %.
+    """
+    if do_use_bfloat16_autocast and not do_train_in_float32:
+        raise RuntimeError('bfloat16 autocast is only possible when training in float32.')
+    set_torch_threads(n_torch_threads, n_torch_interop_threads)
+    ts_stocks_list = _to_training_dtype(ts_stocks_list)
+    ts_covariates = _to_training_dtype(ts_covariates)
+    if train_dataset is None:
+        train_dataset = get_train_dataset(ts_stocks_list, ts_covariates)
 
-
-def _create_new_model(ts_stocks_list, ts_covariates):
     print(
         f'Creating new model with {cfg.n_rnn_layers} rnn layers, {cfg.hidden_dim} hidden dim size and {cfg.n_epochs} epochs.')
     model = RNNModel(model='LSTM',
                      input_chunk_length=input_chunk_length,
                      output_chunk_length=output_chunk_length,
+                     training_length=training_length,
+                     hidden_dim=cfg.hidden_dim,
                      n_rnn_layers=cfg.n_rnn_layers)
-    model.fit(ts_stocks_list,
-              future_covariates=ts_covariates,
-              epochs=cfg.n_epochs,
-              verbose=True)
+    with torch.autocast(device_type='cpu', dtype=torch.bfloat16, enabled=do_use_bfloat16_autocast):
+        model.fit_from_dataset(train_dataset,
+                               epochs=cfg.n_epochs,
+                               verbose=True)
     model_mape = eval_model(model, ts_stocks_list,
                             future_covariates=ts_covariates)
 
     return model, model_mape
 
 
+def get_train_dataset(ts_stocks_list, ts_covariates):
+    """
+    Creates the training dataset of the series in the training dtype with all training samples precomputed.
+    """
+    return _PrecomputedShiftedDataset(_to_training_dtype(ts_stocks_list), _to_training_dtype(ts_covariates))
+
+
+class _PrecomputedShiftedDataset(DualCovariatesShiftedDataset):
+    """
+    Training dataset of the RNN model that slices the samples out of the series once. The darts dataset slices the
+    series anew for every sample in every epoch.
+    """
+
+    def __init__(self, ts_stocks_list, ts_covariates):
+        super().__init__(target_series=ts_stocks_list, covariates=ts_covariates, length=training_length, shift=1)
+        self._samples = [super(_PrecomputedShiftedDataset, self).__getitem__(idx) for idx in range(len(self))]
+
+    def __getitem__(self, idx):
+        return self._samples[idx]
+
+
+def set_torch_threads(n_threads=None, n_interop_threads=None):
+    """
+    Pins the number of torch intra-op and inter-op threads, e.g. so that parallel training processes do not compete
+    for the CPU cores. None keeps the current number.
+    """
+    if n_threads is not None:
+        torch.set_num_threads(n_threads)
+    if n_interop_threads is not None and torch.get_num_interop_threads() != n_interop_threads:
+        try:
+            torch.set_num_interop_threads(n_interop_threads)
+        except RuntimeError:  # only possible before torch started any inter-op parallel work
+            print(f'The number of torch inter-op threads stays {torch.get_num_interop_threads()}.')
+
+
+def _to_training_dtype(series_list):
+    if do_train_in_float32:
+        return [series.astype(np.float32) for series in series_list]
+    return series_list
+
+
+def _to_model_dtype(series_list, model):
+    # models trained in float32 can not predict float64 series and vice versa
+    np_dtype = np.float32 if model.model.dtype == torch.float32 else np.float64
+    return [series.astype(np_dtype) for series in series_list]
+
+
 def eval_model(model, stocks, past_covariates=None, future_covariates=None):
     # Past and future covariates are optional because they won't always be used in our tests
 
-    # We backtest the model on the last 20% of the flow series, with a horizon of 10 steps:
+    # We backtest the model on the last 20% of the flow series, with a horizon of 10 steps. Without retraining, the
+    # forecasts of all start points of all series are predicted in one batch.
+    n_forecasts = sum(len(series) - backtest_start for series in stocks)
     backtest = model.historical_forecasts(series=stocks,
                                           past_covariates=past_covariates,
                                           future_covariates=future_covariates,
-                                          start=95,  # 2008-(2022-2009)=1995))
+                                          start=backtest_start,
                                           retrain=False,
+                                          enable_optimization=True,
+                                          predict_kwargs={'batch_size': n_forecasts},
                                           verbose=True)
 
     # stocks[-len(backtest) - 100:].plot()
@@ -177,23 +287,11 @@ if __name__ == '__main__':
     if normal:
         test(strategy='LSTM', do_visualize=True)
     else:
-        region_tests = ['REMIND']  # Options: ['Pauliuk', 'REMIND']
-        data_tests = ['IEDatabase']  # Options: ['Mueller', 'IEDatabase', 'ScrapAge']
-        model_types = ['stock', 'inflow', 'change']
-        n_epochen = [1000]
-        n_rnn_layers = [3, 6, 9, 12]
-        hidden_dims = [5, 15, 25, 35]
-        for region in region_tests:
-            cfg.region_data_source = region
-            for data_set in data_tests:
-                cfg.steel_data_source = data_set
-                for model_type in model_types:
-                    cfg.model_type = model_type
-                    for n_epoch in n_epochen:
-                        cfg.n_epochs = n_epoch
-                        for n_rnn in n_rnn_layers:
-                            cfg.n_rnn_layers = n_rnn
-                            for hidden_dim in hidden_dims:
-                                cfg.hidden_dim = hidden_dim
-                                print(f'\n\nTest {region} {data_set} {model_type} {n_epoch} {n_rnn} {hidden_dim}\n\n')
-                                test(strategy='LSTM', do_visualize=False)
+        from src.predict.lstm_grid_search import run_grid_search
+
+        run_grid_search({'region_data_source': ['REMIND'],  # Options: ['Pauliuk', 'REMIND']
+                         'steel_data_source': ['IEDatabase'],  # Options: ['Mueller', 'IEDatabase', 'ScrapAge']
+                         'model_type': ['stock', 'inflow', 'change'],
+                         'n_rnn_layers': [3, 6, 9, 12],
+                         'hidden_dim': [5, 15, 25, 35]},
+                        max_epochs=1000)
@@ -1,24 +1,38 @@
 import numpy as np
-from scipy.optimize import least_squares
-from src.tools.config import cfg
-
-
-def predict_pehl(stock_data, gdp_data, do_subcategory_predictions=True):
+from scipy.special import expit
+from src.predict.prediction_tools import copy_stocks_across_scenarios
+
+
+def predict_pehl(stock_data, gdp_data, do_subcategory_predictions=True, do_fit_by_region=False):
+    """
+    Predicts the stocks per capita (t,r,g) with logistic curves of the GDP per capita.
+
+    :param stock_data: Past stocks per capita (t,r,g).
+    :param gdp_data: GDP per capita (t,r) or (t,r,s) with scenarios.
+    :param do_subcategory_predictions:
+    :param do_fit_by_region: Whether to fit one curve per region and category instead of one curve per category for
+    all regions together.
+    :return: Past and future stocks per capita (t,r,g), or (t,r,g,s) if the GDP has scenarios.
+    """
+    is_with_scenarios = gdp_data.ndim == 3
     gdp_data_future = gdp_data[109:]
     gdp_data_past = gdp_data[:109]  # up until 2009 all scenarios are the same
+    if is_with_scenarios:
+        gdp_data_past = gdp_data_past[:, :, 0]
 
-    initial_params = _calc_initial_params(stock_data, gdp_data_past)
+    initial_params = _calc_initial_params(stock_data, gdp_data_past, do_fit_by_region)
     x_0 = gdp_data_past[108]
     y_0 = stock_data[108]
     params = _calc_individual_params(initial_params, stock_data, x_0, y_0)
-    params = np.repeat(params[:, :, :, np.newaxis], 5, axis=3)
-    gdp_data_future = np.repeat(gdp_data_future[:, np.newaxis, :, :], 4, axis=1)
-    gdp_data_future = np.moveaxis(gdp_data_future, -1, 0)
+
+    # the parameters (r,g) are broadcast across the years and scenarios of the GDP (t,r[,s])
+    gdp_data_future = np.expand_dims(gdp_data_future, axis=2)
+    if is_with_scenarios:
+        params = np.expand_dims(params, axis=-1)
+        stock_data = copy_stocks_across_scenarios(stock_data)
     new_stocks = _pehl_stock_curve(params, gdp_data_future)
 
-    stock_data = np.moveaxis(stock_data, 2, 0)
-    stock_data = np.repeat(stock_data[:, :, :, np.newaxis], 5, axis=3)
-    stocks = np.append(stock_data, new_stocks, axis=0)
+    stocks = np.concatenate([stock_data, new_stocks], axis=0)
 
     return stocks
 
@@ -27,35 +41,94 @@ def _calc_individual_params(general_params, stock_data, x_0, y_0):
     initial_a_sym = general_params[0] * 1.1
     high_stock = np.quantile(stock_data, 0.99, axis=0) * 1.1
     a_sym = np.maximum(initial_a_sym, high_stock)
-    scal = np.tile(general_params[2], a_sym.shape[0]).reshape(a_sym.shape)
-    x_mid = ((np.log(a_sym / y_0 - 1) * scal).transpose() + x_0).transpose() * 0.99
+    scal = np.broadcast_to(general_params[2], a_sym.shape)
+    x_mid = (np.log(a_sym / y_0 - 1) * scal + np.expand_dims(x_0, axis=1)) * 0.99
     # make sure predict starts definitely higher than current stock
     final_params = np.array([a_sym, x_mid, scal])
 
     return final_params
 
 
-def _calc_initial_params(stock_data, gdp_data):
-    def func(params, gdp, stocks):
-        return _pehl_stock_curve(params, gdp) - stocks
+def _calc_initial_params(stock_data, gdp_data, do_fit_by_region):
+    """
+    Fits the curves to the past stocks (t,r,g) and GDP (t,r), all fits are solved together.
 
-    high_stock = np.quantile(stock_data, 0.99, axis=0)
-    low_stock = np.quantile(stock_data, 0.01, axis=0)
-    high_gdp = np.quantile(gdp_data, 0.99, axis=0)
-    low_gdp = np.quantile(gdp_data, 0.01, axis=0)
-    a_sym_estimate = 1.1 * high_stock
-    x_mid_estimate = (high_gdp - low_gdp) / 2
+    :return: Parameters (3,g) of one curve per category, or (3,r,g) of one curve per region and category.
+    """
+    if do_fit_by_region:
+        gdp_pc = np.broadcast_to(np.expand_dims(gdp_data, axis=2), stock_data.shape)
+        stocks = stock_data
+    else:
+        # the stocks of all regions are observations of the same curve of a category
+        gdp_pc = np.broadcast_to(gdp_data.reshape(-1, 1), (gdp_data.size, stock_data.shape[2]))
+        stocks = stock_data.reshape(-1, stock_data.shape[2])
 
-    x_mid_estimate = np.broadcast_to(np.expand_dims(x_mid_estimate, axis=1), a_sym_estimate.shape)
-    scal_estimate = np.einsum('r,rg->rg', (high_gdp - low_gdp), 1 / (high_stock - low_stock))
+    return fit_pehl_curves(gdp_pc, stocks, _calc_param_estimate(gdp_pc, stocks))
 
-    param_estimate = np.array([a_sym_estimate, x_mid_estimate, scal_estimate])
-    final_params = np.array(
-        [least_squares(func, param_estimate[:, :, i].flatten(),
-                       args=(gdp_data.flatten(), stock_data[:, :, i].flatten())).x for i in
-         range(cfg.n_use_categories)])  # scenario doesn't matter as all are the same until the beginning of the century
 
-    return final_params.transpose()
+def _calc_param_estimate(gdp_pc, stocks):
+    high_stock = np.quantile(stocks, 0.99, axis=0)
+    low_stock = np.quantile(stocks, 0.01, axis=0)
+    high_gdp = np.quantile(gdp_pc, 0.99, axis=0)
+    low_gdp = np.quantile(gdp_pc, 0.01, axis=0)
+    a_sym_estimate = 1.1 * high_stock
+    x_mid_estimate = (high_gdp - low_gdp) / 2
+    scal_estimate = (high_gdp - low_gdp) / (high_stock - low_stock)
+    return np.array([a_sym_estimate, x_mid_estimate, scal_estimate])
+
+
+def fit_pehl_curves(gdp_pc, stocks, initial_params, max_iterations=1000, tolerance=1e-10):
+    """
+    Fits logistic stock curves to many data sets at once with a batched Levenberg-Marquardt algorithm. The parameters
+    of every data set are fitted independently, but the steps of all fits are calculated together.
+
+    :param gdp_pc: GDP per capita with the observations of every data set along the first axis (m,...).
+    :param stocks: Stocks per capita of the same shape.
+    :param initial_params: Initial a_sym, x_mid and scal of every data set (3,...).
+    :param max_iterations:
+    :param tolerance: A fit is converged when a step reduces its sum of squared residuals by less than this share.
+    :return: Fitted parameters (3,...).
+    """
+    problem_shape = stocks.shape[1:]
+    gdp_pc = np.reshape(gdp_pc, (gdp_pc.shape[0], -1))
+    stocks = np.reshape(stocks, (stocks.shape[0], -1))
+    a_sym, x_mid, scal = np.reshape(initial_params, (3, -1))
+    # the curve is fitted as a_sym / (1 + exp(offset - slope * gdp)), which stays well conditioned for flat curves
+    params = np.array([a_sym, 1 / scal, x_mid / scal])
+
+    damping = np.full(params.shape[1], 1e-3)
+    cost = _calc_cost(params, gdp_pc, stocks)
+    is_active = np.isfinite(cost)
+    for _ in range(max_iterations):
+        active = np.flatnonzero(is_active)
+        if len(active) == 0:
+            break
+        active_params = params[:, active]
+        jacobian = _pehl_jacobian(active_params, gdp_pc[:, active])
+        residuals = _logistic_curve(active_params, gdp_pc[:, active]) - stocks[:, active]
+        jtj = np.einsum('pmn,qmn->npq', jacobian, jacobian)
+        gradient = np.einsum('pmn,mn->np', jacobian, residuals)
+        # Marquardt's scaling of the damping by the diagonal makes the steps independent of the parameter scales
+        damped_jtj = jtj + np.einsum('n,np,pq->npq', damping[active], np.einsum('npp->np', jtj), np.eye(3))
+        new_params = active_params - np.einsum('npq,nq->pn', np.linalg.pinv(damped_jtj), gradient)
+
+        new_cost = _calc_cost(new_params, gdp_pc[:, active], stocks[:, active])
+        new_cost[(new_params[0] <= 0) | (new_params[1] <= 0)] = np.inf  # asymptote and scale stay positive
+        is_improved = new_cost < cost[active]
+        improved = active[is_improved]
+        is_converged = cost[improved] - new_cost[is_improved] <= tolerance * cost[improved]
+        params[:, improved] = new_params[:, is_improved]
+        cost[improved] = new_cost[is_improved]
+        damping[active] = np.where(is_improved, damping[active] / 10, damping[active] * 10)
+        is_active[improved[is_converged]] = False
+        is_active[damping > 1e12] = False  # no step reduces the residuals anymore
+
+    a_sym, slope, offset = params
+    return np.array([a_sym, offset / slope, 1 / slope]).reshape((3,) + problem_shape)
+
+
+def _calc_cost(params, gdp_pc, stocks):
+    return np.sum((_logistic_curve(params, gdp_pc) - stocks) ** 2, axis=0)
 
 
 def _pehl_stock_curve(params, gdp_pc):
@@ -66,16 +139,52 @@ def _pehl_stock_curve(params, gdp_pc):
     return asym / (1 + np.exp((x_mid - gdp_pc) / scal))
 
 
-def _pehl_prime(params, gdp_pc):
-    a_sym = params[0]
-    x_mid = params[1]
-    scal = params[2]
-    x = np.exp((x_mid - gdp_pc) / scal)
-    pehl_prime = a_sym * x / (scal * (1 + x))
-    return pehl_prime
+def _logistic_curve(params, gdp_pc):
+    a_sym, slope, offset = params
+    return a_sym * expit(slope * gdp_pc - offset)
+
+
+def _pehl_jacobian(params, gdp_pc):
+    """
+    Derivatives of the logistic curve with respect to its parameters a_sym, slope and offset (3,...).
+    """
+    a_sym, slope, offset = params
+    share = expit(slope * gdp_pc - offset)
+    share_prime = a_sym * share * (1 - share)
+    return np.array([share, share_prime * gdp_pc, -share_prime])
+
+
+def _test(n_problems=200, tolerance=1e-3):
+    """
+    Compares the batched fits to scipy's Levenberg-Marquardt fits of the single curves, starting from the same
+    estimates. The curves are fitted to noisy logistic stocks whose GDP range covers the middle of the curve, so both
+    need to find the same minimum of the sum of squared residuals.
+    """
+    from scipy.optimize import least_squares
+
+    rng = np.random.default_rng(0)
+    gdp_pc = np.sort(rng.uniform(500, 60000, (109, n_problems)), axis=0)
+    true_params = np.array([rng.uniform(5, 15, n_problems), rng.uniform(10000, 30000, n_problems),
+                            rng.uniform(2000, 6000, n_problems)])
+    stocks = _pehl_stock_curve(true_params, gdp_pc) * (1 + 0.05 * rng.standard_normal(gdp_pc.shape))
+    initial_params = _calc_param_estimate(gdp_pc, stocks)
+
+    params = fit_pehl_curves(gdp_pc, stocks, initial_params)
+    costs = np.sum((_pehl_stock_curve(params, gdp_pc) - stocks) ** 2, axis=0)
+
+    def calc_residuals(problem_params, idx):
+        return _pehl_stock_curve(problem_params, gdp_pc[:, idx]) - stocks[:, idx]
+
+    reference_costs = np.array([2 * least_squares(calc_residuals, initial_params[:, idx], method='lm', args=(idx,)).cost
+                                for idx in range(n_problems)])
+    max_cost_ratio = np.max(costs / reference_costs)
+    print(f'Maximum ratio of the sums of squared residuals to scipy.optimize.least_squares: {max_cost_ratio:.6f}')
+    if max_cost_ratio > 1 + tolerance:
+        raise RuntimeError(f'The batched fits are worse than scipy\'s fits by a factor of {max_cost_ratio}.')
 
 
 if __name__ == "__main__":
     from src.predict.calc_steel_stocks import test
 
+    _test()
     test(strategy='Pehl', do_visualize=True)
@@ -21,7 +21,9 @@ def split_future_stocks_to_base_year_categories(past_stocks_by_category, future_
     return future_stocks
 
 
-def visualise_stock_results(stocks, is_category_data=True, curve_strategy=cfg.curve_strategy):
+def visualise_stock_results(stocks, is_category_data=True, curve_strategy=None):
+    if curve_strategy is None:
+        curve_strategy = cfg.curve_strategy
     if is_category_data:
         stocks = np.sum(stocks, axis=2)
 
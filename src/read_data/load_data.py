@@ -1,13 +1,139 @@
+import functools
+import inspect
 import os
+import threading
+from concurrent.futures import Future
 import pandas as pd
 import numpy as np
 from src.tools.config import cfg
-from src.tools.tools import read_processed_data, group_country_data_to_regions, transform_per_capita
+from src.tools.tools import read_processed_data, write_processed_data, read_processed_csv, \
+    set_object_columns_as_index, group_country_data_to_regions, transform_per_capita, clear_processed_data_memo
+
+
+# -- MEMO --
+
+# The results of the load functions are kept in memory, keyed by the function arguments (e.g. source and
+# country_specific) and the config attributes that choose default sources and paths, so every input is only read once
+# per process. Results are shared between callers and hence read-only: changing the values of a returned frame or
+# array raises an error, use .copy() to get an editable version. Lists are returned as copies. Loads with
+# recalculate=True always call the load function and replace the memorized result.
+
+_MEMO_CONFIG_ATTRIBUTES = ['data_path', 'start_year', 'end_year', 'region_data_source', 'steel_data_source',
+                           'pop_data_source', 'gdp_data_source', 'steel_price_data_source', 'scrap_price_data_source',
+                           'production_data_source', 'use_data_source', 'scrap_trade_data_source',
+                           'indirect_trade_source', 'lifetime_data_source', 'in_use_categories', 'scenarios']
+_memo = {}  # key -> future of the result, only the first caller of a key loads it, later callers wait for it
+_memo_counts = {}  # function name -> {'hits': ..., 'misses': ...}
+_memo_lock = threading.Lock()
+
+
+def invalidate(function_name=None):
+    """
+    Removes memorized results, e.g. after data files were changed by another process.
+
+    :param function_name: Name of the load function whose results are removed, all results (and their hit and miss
+    counts) are removed if None.
+    :return:
+    """
+    with _memo_lock:
+        if function_name is None:
+            _memo.clear()
+            _memo_counts.clear()
+            clear_processed_data_memo()
+        else:
+            for key in [key for key in _memo if key[0] == function_name]:
+                del _memo[key]
+
+
+def get_memo_counts():
+    """
+    Returns the number of memo hits and misses (i.e. actual loads) by load function since the last invalidate().
+    """
+    with _memo_lock:
+        return {name: dict(counts) for name, counts in _memo_counts.items()}
+
+
+def _memoized(source_attribute=None):
+    """
+    Memorizes the results of a load function.
+
+    :param source_attribute: Config attribute of the default source, used as source in the key if no source is given,
+    so that e.g. load_pop() and load_pop('UN') share one result.
+    :return:
+    """
+    return functools.partial(_memoize, source_attribute=source_attribute)
+
+
+def _memoize(load_function, source_attribute):
+    signature = inspect.signature(load_function)
+    source_argument = next((name for name in signature.parameters if name.endswith('_source')), None)
+
+    @functools.wraps(load_function)
+    def memoized_load_function(*args, **kwargs):
+        arguments = signature.bind(*args, **kwargs)
+        arguments.apply_defaults()
+        arguments = dict(arguments.arguments)
+        recalculate = arguments.pop('recalculate', False)
+        if source_argument is not None and arguments[source_argument] is None:
+            arguments[source_argument] = getattr(cfg, source_attribute)
+        config_values = tuple(repr(getattr(cfg, name)) for name in _MEMO_CONFIG_ATTRIBUTES)
+        key = (load_function.__name__, tuple(sorted(arguments.items())), config_values)
+
+        with _memo_lock:
+            counts = _memo_counts.setdefault(load_function.__name__, {'hits': 0, 'misses': 0})
+            future = None if recalculate else _memo.get(key)
+            is_hit = future is not None
+            counts['hits' if is_hit else 'misses'] += 1
+            if not is_hit:
+                future = Future()
+                _memo[key] = future
+        if is_hit:  # waits if another thread is still loading the result
+            return _copy_lists(future.result())
+
+        try:
+            result = _make_read_only(load_function(*args, **kwargs))
+        except BaseException as exception:
+            with _memo_lock:
+                if _memo.get(key) is future:  # failed loads are not memorized, the next caller tries again
+                    del _memo[key]
+            future.set_exception(exception)
+            raise
+        future.set_result(result)
+        return _copy_lists(result)
+
+    return memoized_load_function
+
+
+class _MemorizedList(tuple):
+    pass
+
+
+def _make_read_only(value):
+    if isinstance(value, list):
+        return _MemorizedList(value)
+    if isinstance(value, tuple):
+        return tuple(_make_read_only(item) for item in value)
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        for values in value._mgr.arrays:
+            if isinstance(values, np.ndarray):
+                values.flags.writeable = False
+    elif isinstance(value, np.ndarray):
+        value.flags.writeable = False
+    return value
+
+
+def _copy_lists(value):
+    if isinstance(value, _MemorizedList):
+        return list(value)
+    if isinstance(value, tuple):
+        return tuple(_copy_lists(item) for item in value)
+    return value
 
 
 # -- MAIN DATA LOADING FUNCTIONS BY DATA TYPE --
 
 
+@_memoized('steel_data_source')
 def load_stocks(stock_source=None, country_specific=False, per_capita=True, recalculate=False):
     if stock_source is None:
         stock_source = cfg.steel_data_source
@@ -21,6 +147,7 @@ def load_stocks(stock_source=None, country_specific=False, per_capita=True, reca
         raise ValueError(f'{stock_source} is not a valid stock data source.')
 
 
+@_memoized('pop_data_source')
 def load_pop(pop_source=None, country_specific=False, recalculate=False):
     if pop_source is None:
         pop_source = cfg.pop_data_source
@@ -32,6 +159,7 @@ def load_pop(pop_source=None, country_specific=False, recalculate=False):
         raise ValueError(f'{pop_source} is not a valid population data source.')
 
 
+@_memoized('gdp_data_source')
 def load_gdp(gdp_source=None, country_specific=False, per_capita=True, recalculate=False, get_scenarios=False):
     if gdp_source is None:
         gdp_source = cfg.gdp_data_source
@@ -52,6 +180,7 @@ def load_gdp(gdp_source=None, country_specific=False, per_capita=True, recalcula
         raise ValueError(f'{gdp_source} is not a valid GDP data source.')
 
 
+@_memoized('region_data_source')
 def load_regions(region_source=None, recalculate=False):
     if region_source is None:
         region_source = cfg.region_data_source
@@ -65,6 +194,7 @@ def load_regions(region_source=None, recalculate=False):
         raise ValueError(f'{region_source} is not a valid region data source.')
 
 
+@_memoized()
 def load_region_names_list():
     df_regions = load_regions()
     regions_list = list(df_regions[df_regions.columns[0]].unique())
@@ -72,6 +202,7 @@ def load_region_names_list():
     return regions_list
 
 
+@_memoized('steel_price_data_source')
 def load_steel_prices(steel_price_source=None, recalculate=False):
     if steel_price_source is None:
         steel_price_source = cfg.steel_price_data_source
@@ -81,6 +212,7 @@ def load_steel_prices(steel_price_source=None, recalculate=False):
         raise ValueError(f'{steel_price_source} is not a valid steel price data source.')
 
 
+@_memoized('scrap_price_data_source')
 def load_scrap_prices(scrap_price_source=None, recalculate=False):
     if scrap_price_source is None:
         scrap_price_source = cfg.scrap_price_data_source
@@ -90,6 +222,7 @@ def load_scrap_prices(scrap_price_source=None, recalculate=False):
         raise ValueError(f'{scrap_price_source} is not a valid scrap price data source.')
 
 
+@_memoized('production_data_source')
 def load_production(country_specific, production_source=None, recalculate=False):
     if production_source is None:
         production_source = cfg.production_data_source
@@ -99,6 +232,7 @@ def load_production(country_specific, production_source=None, recalculate=False)
         raise ValueError(f'{production_source} is not a valid production data source.')
 
 
+@_memoized('use_data_source')
 def load_use_1970_2021(country_specific, use_source=None, recalculate=False):
     if use_source is None:
         use_source = cfg.use_data_source
@@ -108,6 +242,7 @@ def load_use_1970_2021(country_specific, use_source=None, recalculate=False):
         raise ValueError(f'{use_source} is not a valid (apparent) use data source.')
 
 
+@_memoized('scrap_trade_data_source')
 def load_scrap_trade_1971_2022(country_specific, scrap_trade_source=None, recalculate=False):
     if scrap_trade_source is None:
         scrap_trade_source = cfg.scrap_trade_data_source
@@ -121,6 +256,7 @@ def load_scrap_trade_1971_2022(country_specific, scrap_trade_source=None, recalc
         raise ValueError(f'{scrap_trade_source} is not a valid (apparent) scrap trade source.')
 
 
+@_memoized('indirect_trade_source')
 def load_indirect_trade_2001_2019(country_specific, indirect_trade_source=None, recalculate=False):
     if indirect_trade_source is None:
         indirect_trade_source = cfg.indirect_trade_source
@@ -134,11 +270,13 @@ def load_indirect_trade_2001_2019(country_specific, indirect_trade_source=None,
         raise ValueError(f'{indirect_trade_source} is not a valid (apparent) scrap trade source.')
 
 
+@_memoized()
 def load_indirect_trade_category_quantities(country_specific, recalculate=False):
     df = _load_worldsteel_indirect_trade_category_quantities(country_specific, recalculate)
     return df
 
 
+@_memoized('lifetime_data_source')
 def load_lifetimes(lifetime_source=None):
     if lifetime_source is None:
         lifetime_source = cfg.lifetime_data_source
@@ -165,6 +303,7 @@ def load_lifetimes(lifetime_source=None):
     return mean, std_dev
 
 
+@_memoized('lifetime_data_source')
 def load_lifetimes_beta(lifetime_source=None):
     if lifetime_source is None:
         lifetime_source = cfg.lifetime_data_source
@@ -194,13 +333,13 @@ def _data_loader(file_base_name, recalculate_function, country_specific,
     file_name_end = '_countries' if country_specific else f'_{cfg.region_data_source}_regions'
     if country_specific is None:
         file_name_end = ""
-    file_name = f"{file_base_name}{file_name_end}.csv"
-    file_path = os.path.join(cfg.data_path, 'processed', file_name)
+    file_path = os.path.join(cfg.data_path, 'processed', f'{file_base_name}{file_name_end}.parquet')
+    csv_file_path = os.path.join(cfg.data_path, 'processed', f'{file_base_name}{file_name_end}.csv')
     if os.path.exists(file_path) and not recalculate:
         df = read_processed_data(file_path, is_yearly_data)
-        df = df.reset_index()
-        indices = list(df.select_dtypes(include='object'))  # select all columns that aren't numbers
-        df = df.set_index(indices)
+    elif os.path.exists(csv_file_path) and not recalculate:  # processed data of the former format is converted
+        df = read_processed_csv(csv_file_path, is_yearly_data)
+        write_processed_data(df, file_path)
     else:  # recalculate and store
         if country_specific or country_specific is None:
             df = recalculate_function()
@@ -213,7 +352,7 @@ def _data_loader(file_base_name, recalculate_function, country_specific,
                               is_yearly_data=is_yearly_data)
             df = group_country_data_to_regions(df, is_per_capita=data_stored_per_capita,
                                                data_split_into_categories=data_split_into_categories)
-        df.to_csv(file_path)
+        write_processed_data(set_object_columns_as_index(df), file_path)
 
     if country_specific is not None:
         if data_stored_per_capita and not return_per_capita:
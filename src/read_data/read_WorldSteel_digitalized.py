@@ -3,7 +3,9 @@ import pandas as pd
 from src.tools.config import cfg
 from src.tools.country_mapping import map_iso3_codes, split_joint_country_data, join_split_country_data
 
-WS_DIGITALIZED_PATH = os.path.join(cfg.data_path, 'original', 'worldsteel', 'WS_digitalized')
+
+def get_ws_digitalized_path():
+    return os.path.join(cfg.data_path, 'original', 'worldsteel', 'WS_digitalized')
 
 
 def get_worldsteel_original(yearbook_filenames, database_filename, skiprows, nrows, usecols):
@@ -28,7 +30,7 @@ def get_worldsteel_original(yearbook_filenames, database_filename, skiprows, nro
 
 
 def read_worldsteel_database_file(filename, skiprows, nrows, usecols):
-    path = os.path.join(WS_DIGITALIZED_PATH, filename)
+    path = os.path.join(get_ws_digitalized_path(), filename)
     df = pd.read_excel(path,
                        skiprows=skiprows,
                        nrows=nrows,
@@ -38,7 +40,7 @@ def read_worldsteel_database_file(filename, skiprows, nrows, usecols):
 
 
 def read_worldsteel_yearbook_data(filename: str):
-    path = os.path.join(WS_DIGITALIZED_PATH, filename)
+    path = os.path.join(get_ws_digitalized_path(), filename)
     df = pd.read_excel(path)
     df.iloc[:, 1:] *= 1000  # as data is given in thousand metric tons
     return df
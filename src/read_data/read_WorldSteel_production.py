@@ -1,6 +1,6 @@
 import os
 import pandas as pd
-from src.read_data.read_WorldSteel_digitalized import get_worldsteel_original, WS_DIGITALIZED_PATH
+from src.read_data.read_WorldSteel_digitalized import get_worldsteel_original, get_ws_digitalized_path
 
 
 def get_worldsteel_production_1900_2022():
@@ -24,7 +24,7 @@ def _extrapolate_production_to_past(df):
 
 def _read_worldsteel_world_production_1900_1969():
     filename = 'world_production_1900-1979.xlsx'
-    world_production_path = os.path.join(WS_DIGITALIZED_PATH, filename)
+    world_production_path = os.path.join(get_ws_digitalized_path(), filename)
     df = pd.read_excel(world_production_path,
                        skiprows=3,
                        nrows=70)
@@ -0,0 +1,107 @@
+import json
+import os
+import uuid
+import numpy as np
+
+# An array store is a directory with one .npy file per array and a small json manifest describing the arrays and
+# additional metadata. Arrays are loaded as memory maps, so loading is (nearly) free and single arrays can be read
+# without touching the rest of the store. The manifest is written last, a store without it is incomplete.
+# Every save writes new array files and atomically replaces the manifest, so processes that still have memory maps of
+# an older version of the store (e.g. parallel simulation runs) are not affected by it being overwritten. The files of
+# the replaced version are kept until the next save, readers that loaded its manifest can still open them.
+
+ARRAY_STORE_VERSION = 1
+_MANIFEST_FILE_NAME = 'manifest.json'
+
+
+def array_store_exists(store_path, fingerprint=None):
+    """
+    Checks if a complete array store of the current version exists. If a fingerprint is given, the store also
+    needs to have been saved with the same fingerprint, otherwise it is outdated.
+    """
+    manifest_path = os.path.join(store_path, _MANIFEST_FILE_NAME)
+    if not os.path.exists(manifest_path):
+        return False
+    manifest = load_array_store_manifest(store_path)
+    if manifest['version'] != ARRAY_STORE_VERSION:
+        return False
+    return fingerprint is None or manifest.get('fingerprint') == fingerprint
+
+
+def save_array_store(store_path, arrays: dict, metadata: dict = None, fingerprint=None):
+    """
+    Saves arrays and metadata to an array store, replacing an existing store at the same path.
+
+    :param store_path: Directory of the store.
+    :param arrays: Dictionary of array names and arrays, array names are used as file names.
+    :param metadata: Dictionary of json serializable metadata, e.g. describing how to assemble the arrays.
+    :param fingerprint: Fingerprint of the inputs the arrays were calculated from, see cache_fingerprint.
+    :return:
+    """
+    os.makedirs(store_path, exist_ok=True)
+    manifest_path = os.path.join(store_path, _MANIFEST_FILE_NAME)
+    old_manifest = _load_manifest_if_valid(store_path) if os.path.exists(manifest_path) else None
+
+    save_id = uuid.uuid4().hex[:12]
+    manifest = {'version': ARRAY_STORE_VERSION, 'fingerprint': fingerprint, 'arrays': {}, 'metadata': metadata or {},
+                'superseded_files': _get_array_files(old_manifest)}
+    for name, values in arrays.items():
+        file_name = f'{name}_{save_id}.npy'
+        np.save(os.path.join(store_path, file_name), np.ascontiguousarray(values))
+        manifest['arrays'][name] = {'file': file_name, 'shape': list(np.shape(values)),
+                                    'dtype': str(np.asarray(values).dtype)}
+
+    temp_manifest_path = f'{manifest_path}.{save_id}.tmp'
+    with open(temp_manifest_path, 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+    os.replace(temp_manifest_path, manifest_path)
+
+    # only the files replaced by the previous save are removed, they are no longer referenced by any manifest
+    old_superseded_files = old_manifest.get('superseded_files', []) if old_manifest is not None else []
+    for file_name in old_superseded_files:
+        try:
+            os.remove(os.path.join(store_path, file_name))
+        except OSError:  # already removed or still opened by a reader (on Windows)
+            pass
+
+
+def load_array_store(store_path, names=None, mmap_mode='r'):
+    """
+    Loads arrays of an array store as memory maps.
+
+    :param store_path: Directory of the store.
+    :param names: Names of the arrays to load, all arrays are loaded if None.
+    :param mmap_mode: Memory map mode, 'r' for read only, 'c' to allow (not saved) changes of the loaded arrays.
+    :return: Dictionary of array names and arrays, metadata of the store.
+    """
+    manifest = load_array_store_manifest(store_path)
+    if names is None:
+        names = manifest['arrays'].keys()
+    arrays = {name: load_array(store_path, name, mmap_mode, manifest) for name in names}
+    return arrays, manifest['metadata']
+
+
+def load_array(store_path, name, mmap_mode='r', manifest=None):
+    if manifest is None:
+        manifest = load_array_store_manifest(store_path)
+    if name not in manifest['arrays']:
+        raise RuntimeError(f"Array '{name}' is not part of the array store at {store_path}.")
+    return np.load(os.path.join(store_path, manifest['arrays'][name]['file']), mmap_mode=mmap_mode)
+
+
+def _load_manifest_if_valid(store_path):
+    try:
+        return load_array_store_manifest(store_path)
+    except (OSError, ValueError):
+        return None
+
+
+def _get_array_files(manifest):
+    if manifest is None:
+        return []
+    return [array_info['file'] for array_info in manifest['arrays'].values()]
+
+
+def load_array_store_manifest(store_path):
+    with open(os.path.join(store_path, _MANIFEST_FILE_NAME)) as manifest_file:
+        return json.load(manifest_file)
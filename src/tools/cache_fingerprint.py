@@ -0,0 +1,165 @@
+import hashlib
+import json
+import os
+import uuid
+import numpy as np
+from src.tools.config import cfg
+from src.predict.lstm_model_registry import get_best_model_checksum
+
+# Cached results (e.g. DSMs and models in data/models) are only reused if the fingerprint they were saved with
+# matches the current one. It hashes the config attributes the result depends on together with the content of the
+# original input data, so changing e.g. the curve strategy or an input file leads to a recalculation. Data written by
+# the runs themselves (processed data, LSTM models) is not hashed, the runs would invalidate their own results
+# otherwise. Results of LSTM predictions depend on the checksum of the selected LSTM model and the LSTM
+# hyperparameters instead, which are only part of the fingerprint if the curve strategy is LSTM.
+
+STOCK_CONFIG_ATTRIBUTES = ['start_year', 'end_year', 'include_gdp_and_pop_scenarios_in_prediction', 'curve_strategy',
+                           'steel_data_source', 'pop_data_source', 'gdp_data_source', 'region_data_source',
+                           'lifetime_data_source', 'default_lifetime_sd_pct_of_mean', 'in_use_categories',
+                           'scenarios', 'do_change_inflow', 'inflow_change_base_year', 'inflow_change_by_scenario',
+                           'inflow_change_by_category']
+
+LSTM_CONFIG_ATTRIBUTES = ['n_epochs', 'n_rnn_layers', 'hidden_dim']
+
+BASE_MODEL_CONFIG_ATTRIBUTES = STOCK_CONFIG_ATTRIBUTES + \
+                               ['trade_data_source', 'production_data_source', 'use_data_source',
+                                'scrap_trade_data_source', 'indirect_trade_source', 'recycling_categories',
+                                'do_model_approaches', 'model_type', 'max_scrap_share_production_base_model',
+                                'scrap_in_BOF_rate', 'forming_yield', 'do_change_reuse', 'reuse_change_base_year',
+                                'reuse_change_by_category', 'reuse_change_by_scenario']
+
+STEEL_PRICE_CONFIG_ATTRIBUTES = ['steel_price_data_source', 'scrap_price_data_source', 'econ_base_year',
+                                 'steel_price_change_by_scenario']
+
+ECON_CONFIG_ATTRIBUTES = ['exog_eaf_USD98', 'elasticity_steel', 'elasticity_scrap_recovery_rate',
+                          'elasticity_dissassembly', 'r_free_recov', 'r_free_diss']
+
+MODEL_CONFIG_ATTRIBUTES = BASE_MODEL_CONFIG_ATTRIBUTES + STEEL_PRICE_CONFIG_ATTRIBUTES + ECON_CONFIG_ATTRIBUTES + \
+                          ['do_model_economy']
+
+# the past DSMs of the inflow and change driven model are calculated from the past production and trade, the model
+# type is given with the DSMs
+MODEL_DSMS_CONFIG_ATTRIBUTES = STOCK_CONFIG_ATTRIBUTES + \
+                               ['trade_data_source', 'production_data_source', 'use_data_source',
+                                'indirect_trade_source', 'forming_yield']
+
+_FILE_HASHES_FILE_NAME = 'input_file_hashes.json'
+_file_hashes = None
+
+
+def get_cache_fingerprint(config_attributes, input_paths=None, extra=None) -> str:
+    """
+    Calculates the fingerprint of a cached result.
+
+    :param config_attributes: Names of the config attributes the result depends on.
+    :param input_paths: Input files or directories (searched recursively) the result depends on. By default, the
+    original data is used.
+    :param extra: Further json serializable parameters the result depends on, e.g. function arguments.
+    :return: Hexadecimal hash string.
+    """
+    if input_paths is None:
+        input_paths = get_default_input_paths()
+    fingerprint_data = {'config': {name: _to_json_value(getattr(cfg, name)) for name in sorted(config_attributes)},
+                        'inputs': _get_input_files_hashes(input_paths),
+                        'lstm_model': _get_lstm_model_fingerprint_data(config_attributes),
+                        'extra': _to_json_value(extra)}
+    fingerprint_string = json.dumps(fingerprint_data, sort_keys=True)
+    return hashlib.sha256(fingerprint_string.encode()).hexdigest()
+
+
+def get_default_input_paths():
+    return [os.path.join(cfg.data_path, 'original')]
+
+
+def _get_lstm_model_fingerprint_data(config_attributes):
+    if 'curve_strategy' not in config_attributes or cfg.curve_strategy != 'LSTM':
+        return None
+    hyperparameters = {name: _to_json_value(getattr(cfg, name)) for name in LSTM_CONFIG_ATTRIBUTES}
+    return {'checksum': get_best_model_checksum(), 'hyperparameters': hyperparameters}
+
+
+def _get_input_files_hashes(input_paths):
+    """
+    Returns the content hashes of all input files. Hashes are stored with the modification time and size of the
+    file, a file is only read and hashed again if one of these changed.
+    """
+    file_hashes = _get_file_hashes()
+    has_new_hashes = False
+    input_hashes = {}
+    for file_path in _list_files(input_paths):
+        file_stat = os.stat(file_path)
+        file_hash = file_hashes.get(file_path)
+        is_outdated = file_hash is None or file_hash['mtime'] != file_stat.st_mtime_ns or \
+            file_hash['size'] != file_stat.st_size
+        if is_outdated:
+            file_hash = {'mtime': file_stat.st_mtime_ns, 'size': file_stat.st_size, 'hash': _hash_file(file_path)}
+            file_hashes[file_path] = file_hash
+            has_new_hashes = True
+        input_hashes[file_path] = file_hash['hash']
+    if has_new_hashes:
+        _save_file_hashes(file_hashes)
+    return input_hashes
+
+
+def _list_files(paths):
+    files = []
+    for path in paths:
+        if os.path.isfile(path):
+            files.append(path)
+        for dir_path, dir_names, file_names in os.walk(path):
+            dir_names.sort()
+            files += [os.path.join(dir_path, file_name) for file_name in sorted(file_names)]
+    return files
+
+
+def _hash_file(file_path):
+    file_hash = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def _get_file_hashes():
+    global _file_hashes
+    if _file_hashes is None:
+        file_path = _get_file_hashes_path()
+        _file_hashes = {}
+        if os.path.exists(file_path):
+            with open(file_path) as file:
+                _file_hashes = json.load(file)
+    return _file_hashes
+
+
+def _save_file_hashes(file_hashes):
+    file_path = _get_file_hashes_path()
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    temp_file_path = f'{file_path}.{uuid.uuid4().hex}.tmp'  # parallel processes and threads may save at once
+    with open(temp_file_path, 'w') as file:
+        json.dump(file_hashes, file)
+    os.replace(temp_file_path, file_path)
+
+
+def _get_file_hashes_path():
+    return os.path.join(cfg.data_path, 'models', _FILE_HASHES_FILE_NAME)
+
+
+def _to_json_value(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (list, tuple)):
+        return [_to_json_value(item) for item in value]
+    if isinstance(value, dict):
+        return {str(key): _to_json_value(item) for key, item in value.items()}
+    return value
+
+
+def _test():
+    print(get_cache_fingerprint(STOCK_CONFIG_ATTRIBUTES))
+    print(get_cache_fingerprint(MODEL_CONFIG_ATTRIBUTES, extra={'country_specific': False}))
+
+
+if __name__ == '__main__':
+    _test()
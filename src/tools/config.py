@@ -1,3 +1,6 @@
+import copy
+from contextlib import contextmanager
+from contextvars import ContextVar
 from os.path import join
 import yaml
 import numpy as np
@@ -7,15 +10,18 @@ class Config:
     """
     Class of SIMSON configurations. Contains both general configurations like SSP scenarios
     and product categories to use as well as adaptable parameters like steel price change.
-    A common instance of this class ('cfg') is used by most other files, its attributes can be
-    adapted with the 'customize' method.
+    Most other files use the config of the current run through 'cfg'. Outside of a run this is a common
+    default instance whose attributes can be adapted with the 'customize' method. A run installs its own
+    frozen instance with 'use_config', so that several runs can be calculated concurrently.
     """
+    __slots__ = ('_is_frozen', '__dict__')
 
     def __init__(self):
         """
         Creates instance of config class with default parameters. These can :func:`print`
         modified through :py:func:`src.tools.config.Config#customize` method.
         """
+        self._is_frozen = False
         self.data_path = 'data'
         self.recalculate_data = False
         self.include_gdp_and_pop_scenarios_in_prediction = True
@@ -50,6 +56,11 @@ class Config:
         self.exog_eaf_USD98 = 76
         self.default_lifetime_sd_pct_of_mean = 0.3
 
+        self.n_mass_balance_check_years = None  # None checks all years, otherwise only a random sample of years
+        self.mass_balance_check_seed = 0  # seed of the sample of years, so repeated checks of a run are the same
+        self.do_calc_country_model = False  # also calculate the country level model in run_simson, see country_model
+        self.n_countries_per_chunk = 25  # countries calculated at once in the country level model
+
         self.do_model_approaches = True
         self.model_type = 'change'
         # Options: ['change', 'stock', 'inflow']
@@ -57,7 +68,7 @@ class Config:
 
         # LSTM Configurations
 
-        self.n_epochs = 10
+        self.n_epochs = 700
         self.n_rnn_layers = 8
         self.hidden_dim = 25
 
@@ -112,6 +123,38 @@ class Config:
             setattr(self, prm_name, prm_value)
         return self
 
+    def reset(self):
+        """
+        Sets all attributes back to their defaults, e.g. before customizing the config for the next simulation run
+        so that no parameters of the previous run are kept.
+
+        :return:
+        """
+        if self._is_frozen:
+            raise RuntimeError('The config of a run is frozen, it can not be reset.')
+        self.__dict__.clear()
+        self.__init__()
+        return self
+
+    def __setattr__(self, name, value):
+        if getattr(self, '_is_frozen', False):
+            raise RuntimeError(f"The config of a run is frozen, '{name}' can not be changed. "
+                               f"Create a new config with 'create_config' instead.")
+        super().__setattr__(name, value)
+
+    def freeze(self):
+        """
+        Makes the config immutable, it can then be shared by concurrent runs and used as a cache key.
+
+        :return:
+        """
+        object.__setattr__(self, '_is_frozen', True)
+        return self
+
+    @property
+    def is_frozen(self):
+        return self._is_frozen
+
     def generate_yml(self, filename: str = 'yaml_test.yml'):
         """ Written by Dr. Jakob Dürrwächter, adapted by Merlin Hosak.
         Generates and saves yaml file with current config file settings in
@@ -142,7 +185,7 @@ class Config:
         if isinstance(self.steel_price_change_by_scenario, list):
             return self.steel_price_change_by_scenario
         else:
-            return [self.steel_price_change_by_scenario] * len(cfg.scenarios)
+            return [self.steel_price_change_by_scenario] * len(self.scenarios)
 
     @property
     def price_change_factor(self):
@@ -187,7 +230,64 @@ class Config:
         # Reuse factor needs to be at least one, as it is deducted by one later and needs to be positive
 
 
-cfg = Config()
+class _CurrentConfig:
+    """
+    Forwards all attribute access to the config of the current context, see 'use_config'.
+    """
+    __slots__ = ()
+
+    def __getattr__(self, name):
+        return getattr(get_config(), name)
+
+    def __setattr__(self, name, value):
+        setattr(get_config(), name, value)
+
+    def __dir__(self):
+        return dir(get_config())
+
+
+_default_config = Config()
+_run_config = ContextVar('run_config', default=None)
+cfg = _CurrentConfig()
+
+
+def get_config() -> Config:
+    """
+    Returns the config installed for the current run (see 'use_config') or the default config outside of runs.
+    """
+    run_config = _run_config.get()
+    return _default_config if run_config is None else run_config
+
+
+def create_config(config_dict: dict = None) -> Config:
+    """
+    Creates a frozen config with the defaults, customized by the config dict.
+
+    :param config_dict: A dictionary of attribute names and values like for 'customize'.
+    :return:
+    """
+    config = Config()
+    if config_dict is not None:
+        config.customize(copy.deepcopy(config_dict))
+    return config.freeze()
+
+
+@contextmanager
+def use_config(config: Config):
+    """
+    Installs the config for the current context, i.e. the current thread or asyncio task, e.g.
+    'with use_config(create_config(config_dict)): ...'. Threads started within the context need to copy it with
+    'contextvars.copy_context'.
+
+    :param config: Config of the run, it is frozen if it is not already.
+    :return:
+    """
+    token = _run_config.set(config.freeze())
+    try:
+        yield config
+    finally:
+        _run_config.reset(token)
+
 
 if __name__ == '__main__':
     cfg.generate_yml()
@@ -0,0 +1,171 @@
+import contextvars
+import hashlib
+import json
+import time
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from src.tools.cache_fingerprint import get_cache_fingerprint
+
+
+class PipelineStage:
+    """
+    A named step of a pipeline. The stage function is called with its inputs as keyword arguments and returns its
+    outputs (a single value for one output, a tuple otherwise). The config attributes a stage depends on are
+    declared, so that the stage is only recalculated if one of them (or one of its inputs) changed.
+    """
+
+    def __init__(self, name, function, inputs=(), outputs=None, config_attributes=()):
+        self.name = name
+        self.function = function
+        self.inputs = list(inputs)
+        self.outputs = [name] if outputs is None else list(outputs)
+        self.config_attributes = list(config_attributes)
+
+
+class Pipeline:
+    """
+    Runs stages as a dependency graph: each stage runs as soon as all of its inputs are available, independent
+    stages run in parallel threads. The outputs of every stage are kept in memory with a fingerprint of the config
+    attributes, input data (see cache_fingerprint) and inputs they were calculated from, and reused if the
+    fingerprint of a later run is the same.
+    The wall time of each stage of the last run is stored in 'timings' (None for reused stages).
+    """
+
+    def __init__(self, stages, n_workers=4):
+        self.stages = {stage.name: stage for stage in stages}
+        self.n_workers = n_workers
+        self.timings = {}
+        self._producers = {}  # output name -> stage name
+        for stage in stages:
+            for output in stage.outputs:
+                if output in self._producers:
+                    raise RuntimeError(f"Output '{output}' is produced by both stage '{self._producers[output]}' "
+                                       f"and stage '{stage.name}'.")
+                self._producers[output] = stage.name
+        self._cache = {}  # stage name -> (fingerprint, outputs)
+
+    def run(self, targets, **pipeline_inputs):
+        """
+        Runs all stages needed for the targets.
+
+        :param targets: Names of the outputs to calculate.
+        :param pipeline_inputs: Inputs that are not produced by a stage, e.g. 'country_specific'.
+        :return: Dictionary of the target outputs.
+        """
+        stage_names = self._get_needed_stages(targets, pipeline_inputs)
+        values = dict(pipeline_inputs)
+        fingerprints = {name: _hash(value) for name, value in pipeline_inputs.items()}
+        self.timings = {}
+
+        remaining = list(stage_names)
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.n_workers) as executor:
+            while remaining or running:
+                self._start_ready_stages(remaining, running, executor, values, fingerprints)
+                if not running:
+                    if remaining:
+                        raise RuntimeError(f'Pipeline stages {remaining} can not run, their inputs are missing.')
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage, fingerprint = running.pop(future)
+                    outputs, duration = future.result()
+                    outputs = _to_output_dict(stage, outputs)
+                    self._cache[stage.name] = (fingerprint, outputs)
+                    self.timings[stage.name] = duration
+                    self._set_outputs(stage, outputs, fingerprint, values, fingerprints)
+
+        return {target: values[target] for target in targets}
+
+    def _start_ready_stages(self, remaining, running, executor, values, fingerprints):
+        """
+        Submits all stages whose inputs are available. Stages with an unchanged fingerprint take their outputs from
+        the cache instead, which can make further stages ready, hence this is repeated until no stage is ready.
+        """
+        ready_stages = [name for name in remaining if self._is_ready(name, values)]
+        while ready_stages:
+            for stage_name in ready_stages:
+                remaining.remove(stage_name)
+                stage = self.stages[stage_name]
+                fingerprint = self._get_stage_fingerprint(stage, fingerprints)
+                cached_fingerprint, cached_outputs = self._cache.get(stage_name, (None, None))
+                if cached_fingerprint == fingerprint:
+                    self.timings[stage_name] = None
+                    self._set_outputs(stage, cached_outputs, fingerprint, values, fingerprints)
+                else:
+                    inputs = {name: values[name] for name in stage.inputs}
+                    # stages run with the config of the calling context, see config.use_config
+                    future = executor.submit(contextvars.copy_context().run, _run_timed, stage.function, inputs)
+                    running[future] = (stage, fingerprint)
+            ready_stages = [name for name in remaining if self._is_ready(name, values)]
+
+    def print_timings(self):
+        for stage_name, duration in self.timings.items():
+            duration_string = 'reused' if duration is None else f'{duration:.2f} s'
+            print(f'{stage_name}: {duration_string}')
+
+    def invalidate(self, stage_name=None):
+        if stage_name is None:
+            self._cache = {}
+        else:
+            self._cache.pop(stage_name, None)
+
+    def _get_needed_stages(self, targets, pipeline_inputs):
+        needed = []
+
+        def add_stage_of(output):
+            if output in pipeline_inputs:
+                return
+            if output not in self._producers:
+                raise RuntimeError(f"'{output}' is neither a pipeline input nor produced by any stage.")
+            stage_name = self._producers[output]
+            if stage_name in needed:
+                return
+            for stage_input in self.stages[stage_name].inputs:
+                add_stage_of(stage_input)
+            needed.append(stage_name)
+
+        for target in targets:
+            add_stage_of(target)
+        return needed
+
+    def _is_ready(self, stage_name, values):
+        return all(stage_input in values for stage_input in self.stages[stage_name].inputs)
+
+    @staticmethod
+    def _get_stage_fingerprint(stage, fingerprints):
+        # the cache fingerprint also covers the input files and the selected LSTM model the stage depends on
+        config_fingerprint = get_cache_fingerprint(stage.config_attributes)
+        input_fingerprints = {name: fingerprints[name] for name in stage.inputs}
+        return _hash({'stage': stage.name, 'config': config_fingerprint, 'inputs': input_fingerprints})
+
+    @staticmethod
+    def _set_outputs(stage, outputs, fingerprint, values, fingerprints):
+        for name, value in outputs.items():
+            values[name] = value
+            fingerprints[name] = _hash([fingerprint, name])
+
+
+def _run_timed(function, inputs):
+    start_time = time.perf_counter()
+    outputs = function(**inputs)
+    return outputs, time.perf_counter() - start_time
+
+
+def _to_output_dict(stage, outputs):
+    if len(stage.outputs) == 1:
+        return {stage.outputs[0]: outputs}
+    if len(outputs) != len(stage.outputs):
+        raise RuntimeError(f"Stage '{stage.name}' returned {len(outputs)} outputs instead of {len(stage.outputs)}.")
+    return dict(zip(stage.outputs, outputs))
+
+
+def _hash(value):
+    value_string = json.dumps(value, sort_keys=True, default=_to_json_value)
+    return hashlib.sha256(value_string.encode()).hexdigest()
+
+
+def _to_json_value(value):
+    if isinstance(value, (np.ndarray, np.generic)):
+        return value.tolist()
+    return str(value)
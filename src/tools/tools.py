@@ -1,3 +1,5 @@
+import os
+import uuid
 from matplotlib import pyplot as plt
 import numpy as np
 import pandas as pd
@@ -11,12 +13,60 @@ def show_and_save(filename_base: str = None):
         plt.show()
 
 
+# Processed data is stored as Parquet, which keeps index and dtypes, and kept in memory once it was read. The memo is
+# keyed by the file path and checks modification time and size, so files changed since are read again.
+_processed_data_memo = {}  # path -> (modification time and size, DataFrame)
+
+
 def read_processed_data(path, is_yearly_data=True):
+    """
+    Reads a processed dataset saved with write_processed_data, repeated reads of an unchanged file come from memory.
+    A copy is returned as callers may change it.
+    """
+    file_stat = os.stat(path)
+    file_version = (file_stat.st_mtime_ns, file_stat.st_size)
+    memo_entry = _processed_data_memo.get(path)
+    if memo_entry is None or memo_entry[0] != file_version:
+        df = pd.read_parquet(path)
+        if is_yearly_data:
+            df = _make_year_column_names_integers(df)
+        memo_entry = (file_version, df)
+        _processed_data_memo[path] = memo_entry
+    return memo_entry[1].copy()
+
+
+def write_processed_data(df, path):
+    """
+    Saves a processed dataset as Parquet. Parquet only allows string column names, year columns are converted back
+    to integers by read_processed_data.
+    """
+    df_to_write = df.copy(deep=False)
+    df_to_write.columns = df_to_write.columns.map(str)
+    temp_path = f'{path}.{uuid.uuid4().hex}.tmp'  # parallel processes and threads may save at the same time
+    df_to_write.to_parquet(temp_path)
+    os.replace(temp_path, path)
+    _processed_data_memo.pop(path, None)
+
+
+def clear_processed_data_memo():
+    _processed_data_memo.clear()
+
+
+def read_processed_csv(path, is_yearly_data=True):
+    """
+    Reads processed data of the former CSV format, see _data_loader in load_data.
+    """
     df = pd.read_csv(path)
     df = df.set_index(list(df.columns)[0])
     if is_yearly_data:
         df = _make_year_column_names_integers(df)
-    return df
+    return set_object_columns_as_index(df)
+
+
+def set_object_columns_as_index(df):
+    df = df.reset_index()
+    indices = list(df.select_dtypes(include='object'))  # select all columns that aren't numbers
+    return df.set_index(indices)
 
 
 def _make_year_column_names_integers(df):
@@ -38,7 +88,9 @@ def _make_year_column_names_integers(df):
     return df
 
 
-def fill_missing_values_linear(df, start_year=cfg.start_year, end_year=cfg.end_year):
+def fill_missing_values_linear(df, start_year=None, end_year=None):
+    start_year = cfg.start_year if start_year is None else start_year
+    end_year = cfg.end_year if end_year is None else end_year
     years = np.arange(start_year, end_year + 1)
     df = df.apply(pd.to_numeric)
     df = df.reindex(columns=years)
@@ -1,10 +1,13 @@
 import numpy as np
 from matplotlib import pyplot as plt
-from src.base_model.simson_base_model import load_simson_base_model, ENV_PID, BOF_PID, EAF_PID, FORM_PID, FABR_PID, \
-    USE_PID, SCRAP_PID, RECYCLE_PID, WASTE_PID, DISNOTCOL_PID
+from src.base_model.simson_base_model import load_simson_base_model, get_base_model_store_path, \
+    get_model_fingerprint, ENV_PID, BOF_PID, EAF_PID, FORM_PID, FABR_PID, USE_PID, SCRAP_PID, RECYCLE_PID, \
+    WASTE_PID, DISNOTCOL_PID
 from src.tools.config import cfg
+from src.tools.array_store import array_store_exists
 from src.read_data.load_data import load_region_names_list
-from src.economic_model.simson_econ_model import load_simson_econ_model
+from src.economic_model.simson_econ_model import load_simson_econ_model, get_econ_model_store_path
+from src.odym_extension.SimDiGraph_MFAsystem import load_stored_flow, sum_to_indices
 from src.predict.calc_steel_stocks import get_np_pop_data
 
 # MAIN PARAMETERS
@@ -39,14 +42,13 @@ limit_time = False
 start_year = 2000
 end_year = 2050
 
-# If getting wrong results it might be that recalculating base_model and dsms help.
-# This is especially relevant when config has been changed after last load of base_model.
-force_recalculate = True
+# Stored models and dsms are recalculated automatically if the config or input data changed since they were saved,
+# this forces a recalculation regardless.
+force_recalculate = False
 
 
 def visualise():
-    model = _get_model_for_visualisation()
-    flow_or_stock = _get_flow_or_stock(model)
+    flow_or_stock = _get_flow_or_stock_for_visualisation()
     name = flow_or_stock.Name
     regions = load_region_names_list()
     legend = _get_legend(regions)
@@ -105,10 +107,12 @@ def _prepare_values(flow, name, regions):
         raise RuntimeError(
             f"Dimension '{dimension}' with index '{wanted_dim}' not in {name} flow indices ('{flow_dims}')."
             f"\nChoose one of 'region', 'scenario', 'good' or 'waste' depending on flow indices.")
-    flow_dims = flow_dims.replace(",", "")
+    # all other indices are summed up, which is done first, so the dense values of block flows are not built
+    kept_dims = [dim for dim in flow_dims.split(',') if dim in ['t', 'e', 'r', 's', wanted_dim]]
+    values = sum_to_indices(flow, ','.join(kept_dims))
+    flow_dims = ''.join(kept_dims)
     n_dims = len(flow_dims)
     dim_idx = flow_dims.index(wanted_dim)
-    values = flow.Values
 
     # if per_capita:
     #    values = _transfer_flows_to_per_capita(values, flow_dims, cfg.include_gdp_and_pop_scenarios_in_prediction)
@@ -172,25 +176,34 @@ def _transfer_flows_to_per_capita(values, flow_dims, include_gdp_and_pop_scenari
     return values
 
 
-def _get_model_for_visualisation():
-    recalculate = force_recalculate
-    cfg.region_data_source = region_data_source
-    if not steel_data_source == cfg.steel_data_source:
-        cfg.steel_data_source = steel_data_source
-        recalculate = True
-    if not curve_strategy == cfg.curve_strategy:
-        cfg.curve_strategy = curve_strategy
-        recalculate = True
-    if not model_type == cfg.model_type:
-        cfg.model_type = model_type
-        recalculate = True
+def _get_flow_or_stock_for_visualisation():
+    recalculate = _update_config_for_visualisation()
+    store_path = get_econ_model_store_path(country_specific=False) if do_load_econ_model \
+        else get_base_model_store_path(country_specific=False)
+    if do_flow_not_stock and not recalculate and \
+            array_store_exists(store_path, get_model_fingerprint(do_econ_model=do_load_econ_model)):
+        # only the visualised flow is read from the stored model
+        return load_stored_flow(store_path, flow_origin_process, flow_destination_process)
+    model = _get_model_for_visualisation(recalculate)
+    return _get_flow_or_stock(model)
+
 
+def _get_model_for_visualisation(recalculate):
     if do_load_econ_model:
         return load_simson_econ_model(recalculate=recalculate, recalculate_dsms=recalculate)
     else:
         return load_simson_base_model(recalculate=recalculate, recalculate_dsms=recalculate)
 
 
+def _update_config_for_visualisation():
+    # changed config attributes lead to a recalculation via the fingerprints of the stored models and dsms
+    cfg.region_data_source = region_data_source
+    cfg.steel_data_source = steel_data_source
+    cfg.curve_strategy = curve_strategy
+    cfg.model_type = model_type
+    return force_recalculate
+
+
 def _get_legend(regions):
     if dimension == 'region':
         return regions